@@ -0,0 +1,90 @@
+# Microbenchmark for the footprint timelines Scalene keeps (one for the
+# whole program and one per line that allocates).
+#
+# Compares the old list-backed Adaptive (which sorted lists of three
+# to take medians on every decimation) with the array-backed one, for
+# the cost of each add and the memory held per tracked line.
+#
+# Run with:  python3 benchmarks/adaptive_bench.py
+
+import os
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scalene.adaptive import Adaptive
+
+
+class OldAdaptive:
+    """The Adaptive Scalene used to have."""
+
+    def __init__(self, size: int):
+        self.max_samples = size
+        self.current_index = 0
+        self.sample_array = [0.0] * size
+
+    def add(self, value: float, _timestamp: float = 0.0) -> None:
+        if self.current_index >= self.max_samples:
+            new_array = [0.0] * self.max_samples
+            for i in range(0, self.max_samples // 3):
+                arr = [self.sample_array[i * 3 + j] for j in range(0, 3)]
+                arr.sort()
+                new_array[i] = arr[1]
+            self.current_index = self.max_samples // 3
+            self.sample_array = new_array
+        self.sample_array[self.current_index] = value
+        self.current_index += 1
+
+
+def bytes_per_line(make: Callable[[], Any], adds: int) -> float:
+    """Memory held by 1000 timelines with adds samples each."""
+    lines = 1000
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    timelines: List[Any] = []
+    for _ in range(lines):
+        timeline = make()
+        for i in range(adds):
+            timeline.add(float(i))
+        timelines.append(timeline)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / lines
+
+
+def cost_per_add(make: Callable[[], Any], adds: int) -> float:
+    """Nanoseconds per add, filling fresh timelines with adds samples."""
+    values = [float(i) for i in range(adds)]
+
+    def fill() -> None:
+        timeline = make()
+        for value in values:
+            timeline.add(value, 0.0)
+
+    number = max(1, 100000 // adds)
+    return timeit.timeit(fill, number=number) / (number * adds) * 1e9
+
+
+def main() -> None:
+    print(
+        f"{'size':>6} {'adds':>8} {'old add (ns)':>14} {'new add (ns)':>14}"
+    )
+    for size in (9, 27, 243):
+        for adds in (100, 10000):
+            old = cost_per_add(lambda: OldAdaptive(size), adds)
+            new = cost_per_add(lambda: Adaptive(size), adds)
+            print(f"{size:>6} {adds:>8} {old:>14.0f} {new:>14.0f}")
+    print()
+    print(f"{'adds':>6} {'old bytes/line':>16} {'new bytes/line':>16}")
+    for adds in (0, 1, 9, 100):
+        print(
+            f"{adds:>6} {bytes_per_line(lambda: OldAdaptive(9), adds):>16.0f}"
+            f" {bytes_per_line(lambda: Adaptive(9), adds):>16.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+// Microbenchmark for include/samplefile.hpp: how many sample records
+// per second can N threads publish?
+//
+// Compares the writer Scalene used before the lock-free ring (each
+// record formatted as a line of text and appended to the file under
+// one global lock, as in SampleFile::writeToFile) with lock-free
+// reservation in the ring. A consumer thread drains the ring the way
+// scalene/samplefile.py does. Records the ring had no room for are
+// dropped and counted; the old writer never drops records (it appends
+// until the file is full; here, it starts over at the beginning).
+//
+// Throughput only says something about scaling when the machine has at
+// least as many cores as threads: with more threads than cores, a
+// writer preempted between reserving its slot and publishing it holds
+// up the consumer (and, once the ring fills up, every other writer).
+//
+// Build and run with:  make samplefile-bench && ./samplefile-bench
+
+#include <heaplayers.h>
+
+#include <atomic>
+#include <chrono>
+#include <thread>
+#include <vector>
+
+#include <stdio.h>
+#include <string.h>
+#include <sys/mman.h>
+
+#include "samplefile.hpp"
+
+HL::PosixLock SampleFile::lock;
+int SampleFile::notifyFd = -1;
+
+struct BenchRecord {
+  char action;
+  char padding[7];
+  uint64_t sequence;
+  uint64_t count;
+  double pythonFraction;
+  uint64_t threadId;
+  uint64_t codeAddress;
+  int32_t lineNumber;
+  int32_t lasti;
+};
+
+static constexpr int RecordsPerThread = 200000;
+
+// The old writer: SampleHeap::writeCount formatted each sample with
+// snprintf, and SampleFile::writeToFile appended it under a global lock.
+class OldSampleFile {
+  static constexpr int MAX_FILE_SIZE = 4096 * 65536;
+  static constexpr int MAX_BUFSIZE = 1024;
+
+public:
+  OldSampleFile()
+      : _mmap(reinterpret_cast<char *>(mmap(0, MAX_FILE_SIZE,
+                                            PROT_READ | PROT_WRITE,
+                                            MAP_SHARED | MAP_ANONYMOUS, -1,
+                                            0))),
+        _lastpos(0) {}
+  ~OldSampleFile() { munmap(_mmap, MAX_FILE_SIZE); }
+
+  void writeCount(char action, uint64_t sequence, uint64_t count,
+                  float pythonFraction) {
+    char buf[MAX_BUFSIZE];
+    snprintf(buf, MAX_BUFSIZE, "%c,%lu,%lu,%f\n\n", action,
+             (unsigned long)sequence, (unsigned long)count, pythonFraction);
+    writeToFile(buf);
+  }
+
+private:
+  void writeToFile(char *line) {
+    _lock.lock();
+    if (_lastpos > MAX_FILE_SIZE - MAX_BUFSIZE) {
+      _lastpos = 0;
+    }
+    strncpy(_mmap + _lastpos, (const char *)line, MAX_BUFSIZE);
+    _lastpos += strlen(_mmap + _lastpos) - 1;
+    _lock.unlock();
+  }
+
+  char *_mmap;
+  int _lastpos;
+  HL::PosixLock _lock;
+};
+
+enum class Mode { OldLocked, LockFree };
+
+static const char *modeName(Mode mode) {
+  switch (mode) {
+  case Mode::OldLocked:
+    return "old writer (text, global lock)";
+  default:
+    return "lock-free ring";
+  }
+}
+
+// Advance the tail past every published record, like the Python reader.
+static void drain(SampleFileHeader *header, char *ring,
+                  std::atomic<bool> &done) {
+  while (true) {
+    auto finished = done.load();
+    auto tail = header->tail;
+    auto head = __atomic_load_n(&header->head, __ATOMIC_ACQUIRE);
+    while (tail < head) {
+      auto slot = reinterpret_cast<BenchRecord *>(
+          ring + (tail % header->capacity) * sizeof(BenchRecord));
+      if (__atomic_load_n(&slot->sequence, __ATOMIC_ACQUIRE) != tail + 1) {
+        break;
+      }
+      tail++;
+    }
+    __atomic_store_n(&header->tail, tail, __ATOMIC_RELEASE);
+    if (finished && tail == head) {
+      return;
+    }
+  }
+}
+
+struct Result {
+  double recordsPerSecond; // records written (not dropped) per second
+  uint64_t dropped;
+};
+
+static Result run(Mode mode, int nthreads) {
+  SampleFile file((char *)"/tmp/scalene-bench-signal@",
+                  (char *)"/tmp/scalene-bench-lock@", sizeof(BenchRecord));
+  OldSampleFile oldFile;
+  std::atomic<bool> done{false};
+  std::thread consumer(drain, file.header(), file.ring(), std::ref(done));
+  auto start = std::chrono::steady_clock::now();
+  std::vector<std::thread> producers;
+  for (int t = 0; t < nthreads; t++) {
+    producers.emplace_back([&]() {
+      BenchRecord record{};
+      record.action = 'M';
+      record.threadId = (uint64_t)pthread_self();
+      for (int i = 0; i < RecordsPerThread; i++) {
+        record.count = i;
+        switch (mode) {
+        case Mode::OldLocked:
+          oldFile.writeCount('M', i, record.count, 0.5);
+          break;
+        case Mode::LockFree:
+          file.writeRecord(record);
+          break;
+        }
+      }
+    });
+  }
+  for (auto &p : producers) {
+    p.join();
+  }
+  auto elapsed = std::chrono::duration<double>(
+                     std::chrono::steady_clock::now() - start)
+                     .count();
+  done = true;
+  consumer.join();
+  auto dropped = file.header()->overflows;
+  auto written = (double)nthreads * RecordsPerThread - dropped;
+  return {written / elapsed, dropped};
+}
+
+int main() {
+  printf("%u cores\n", std::thread::hardware_concurrency());
+  printf("%-32s %8s %16s %12s\n", "mode", "threads", "records/sec",
+         "dropped");
+  for (auto mode : {Mode::OldLocked, Mode::LockFree}) {
+    for (auto nthreads : {1, 4, 16, 64}) {
+      auto result = run(mode, nthreads);
+      printf("%-32s %8d %16.0f %12lu\n", modeName(mode), nthreads,
+             result.recordsPerSecond, (unsigned long)result.dropped);
+    }
+  }
+  return 0;
+}
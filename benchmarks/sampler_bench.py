@@ -0,0 +1,110 @@
+# Compares Scalene's two CPU sampling engines (--sampler=signal and
+# --sampler=thread) on a program whose main thread spends most of its
+# time blocked in native code (hashing, which releases the GIL but
+# doesn't check for signals) while a worker thread splits its time
+# evenly between two Python lines.
+#
+# The signal engine can only sample when the main thread comes back to
+# the interpreter, so it takes few samples and the worker's split is
+# noisy; the sampler thread keeps sampling throughout. For each engine
+# this prints the samples taken, the share of time reported for each
+# of the worker's two lines (ideally equal), the profiler's overhead,
+# and the run time.
+#
+# Run with:  python3 benchmarks/sampler_bench.py
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Tuple
+
+WORKLOAD = """\
+import hashlib
+import threading
+
+done = threading.Event()
+
+def worker():
+    x = 0
+    while not done.is_set():
+        for i in range(20000):
+            x += i
+        for i in range(20000):
+            x -= i
+
+thread = threading.Thread(target=worker)
+thread.start()
+data = bytes(256 * 1024 * 1024)
+for _ in range(4):
+    hashlib.sha256(data).digest()
+done.set()
+thread.join()
+"""
+# The worker's two lines.
+LINES = (10, 12)
+
+ROW = re.compile(r"^\s*(\d+)\s*│\s*(\d*)%?\s*│\s*(\d*)%?\s*│")
+CALLS = re.compile(r"CPU handler: (\d+) calls")
+OVERHEAD = re.compile(r"Scalene overhead: ([\d.]+)s")
+
+
+def profile(program: str, sampler: str) -> Tuple[Dict[int, int], int, float, float]:
+    """Per-line CPU %, CPU samples, overhead and run time for sampler."""
+    with tempfile.NamedTemporaryFile("r", suffix=".txt") as out:
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "scalene",
+                "--cpu-only",
+                "--sampler=" + sampler,
+                "--outfile",
+                out.name,
+                program,
+            ],
+            check=True,
+            cwd=os.path.join(os.path.dirname(__file__), ".."),
+        )
+        elapsed = time.perf_counter() - start
+        report = out.read()
+    percents: Dict[int, int] = {}
+    for line in report.splitlines():
+        match = ROW.match(line)
+        if match:
+            python, native = match.group(2), match.group(3)
+            percents[int(match.group(1))] = int(python or 0) + int(native or 0)
+    calls = CALLS.search(report)
+    overhead = OVERHEAD.search(report)
+    return (
+        percents,
+        int(calls.group(1)) if calls else 0,
+        float(overhead.group(1)) if overhead else 0.0,
+        elapsed,
+    )
+
+
+def main() -> None:
+    with tempfile.NamedTemporaryFile("w", suffix=".py") as program:
+        program.write(WORKLOAD)
+        program.flush()
+        print(
+            f"{'sampler':>8} {'samples':>8} {'line %d' % LINES[0]:>8}"
+            f" {'line %d' % LINES[1]:>8} {'overhead':>9} {'run time':>9}"
+        )
+        for sampler in ("signal", "thread"):
+            percents, calls, overhead, elapsed = profile(
+                program.name, sampler
+            )
+            print(
+                f"{sampler:>8} {calls:>8}"
+                f" {percents.get(LINES[0], 0):>7}% {percents.get(LINES[1], 0):>7}%"
+                f" {overhead:>8.3f}s {elapsed:>8.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
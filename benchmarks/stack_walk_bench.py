@@ -0,0 +1,81 @@
+# Microbenchmark for the stack walk Scalene does on every sample: from
+# the innermost frame of a thread, find the first frame in code being
+# profiled.
+#
+# Compares the old walk (a should_trace() lookup by filename on every
+# frame, plus the eval/compile check) with the walk that caches the
+# decision per code object, for stacks with 10, 100 and 500 library
+# frames above the profiled code.
+#
+# Run with:  python3 benchmarks/stack_walk_bench.py
+
+import os
+import sys
+import timeit
+from types import FrameType
+from typing import Optional, cast
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scalene.scalene_profiler import Scalene
+
+# Library code: recurses to the requested depth, then hands back the
+# innermost frame.
+LIBRARY = compile(
+    """
+def descend(depth):
+    if depth:
+        return descend(depth - 1)
+    return sys._getframe()
+""",
+    "/usr/lib/python3/site-packages/library.py",
+    "exec",
+)
+library = {"sys": sys}
+exec(LIBRARY, library)
+
+
+def old_walk(frame: Optional[FrameType]) -> Optional[FrameType]:
+    """The walk compute_frames_to_record used to do."""
+    if not frame:
+        return None
+    fname = frame.f_code.co_filename
+    if not fname:
+        back = cast(FrameType, frame.f_back)
+        fname = back.f_code.co_filename
+    while not Scalene.should_trace(fname):
+        if frame:
+            frame = frame.f_back
+            if frame:
+                fname = frame.f_code.co_filename
+                continue
+        else:
+            break
+    return frame
+
+
+def profiled_code(depth: int) -> FrameType:
+    return cast(FrameType, library["descend"](depth))
+
+
+def main() -> None:
+    Scalene._Scalene__program_path = os.path.dirname(  # type: ignore
+        os.path.abspath(__file__)
+    )
+    number = 10000
+    print(f"{'depth':>8} {'old walk (us)':>16} {'cached walk (us)':>18}")
+    for depth in (10, 100, 500):
+        leaf = profiled_code(depth)
+        assert old_walk(leaf) is Scalene.find_traced_frame(leaf)
+        assert Scalene.find_traced_frame(leaf) is not None
+        old = timeit.timeit(lambda: old_walk(leaf), number=number)
+        new = timeit.timeit(
+            lambda: Scalene.find_traced_frame(leaf), number=number
+        )
+        print(
+            f"{depth:>8} {old / number * 1e6:>16.2f} {new / number * 1e6:>18.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
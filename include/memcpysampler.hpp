@@ -170,6 +170,13 @@ void *memcpy_musl(void *dest, const void *src, size_t n) {
 #endif
 #include "samplefile.hpp"
 
+// A single memcpy sample, as written to the signal file.
+// Things that need to be in sync with scalene/samplefile.py.
+struct MemcpyRecord {
+  uint64_t sequence; // position in the ring plus one (set by SampleFile)
+  uint64_t count;    // bytes copied since the last sample
+};
+
 template <uint64_t MemcpySamplingRateBytes> class MemcpySampler {
   enum { MemcpySignal = SIGPROF };
   static constexpr auto flags =
@@ -179,8 +186,9 @@ template <uint64_t MemcpySamplingRateBytes> class MemcpySampler {
 
 public:
   MemcpySampler()
-      : _samplefile((char *)"/tmp/scalene-memcpy-signal@",
-                    (char *)"/tmp/scalene-memcpy-lock@"),
+      : _memcpySampler("SCALENE_MEMCPY_SAMPLING_RATE"),
+        _samplefile((char *)"/tmp/scalene-memcpy-signal@",
+                    (char *)"/tmp/scalene-memcpy-lock@", sizeof(MemcpyRecord)),
         _interval(MemcpySamplingRateBytes), _memcpyOps(0), _memcpyTriggered(0) {
     signal(MemcpySignal, SIG_IGN);
     auto pid = getpid();
@@ -266,12 +274,18 @@ private:
     _memcpyOps += n;
     auto sampleMemop = _memcpySampler.sample(n);
     if (unlikely(sampleMemop)) {
+      auto rate = _samplefile.requestedSamplingRate();
+      if (rate && rate != _memcpySampler.rate()) {
+        _memcpySampler.setRate(rate);
+      }
       writeCount();
       _memcpyTriggered++;
       _memcpyOps = 0;
+      if (_samplefile.shouldSignal() && !SampleFile::notify()) {
 #if !SCALENE_DISABLE_SIGNALS
-      raise(MemcpySignal);
+        raise(MemcpySignal);
 #endif
+      }
     }
   }
 
@@ -281,9 +295,9 @@ private:
   char scalene_memcpy_signal_filename[255];
 
   void writeCount() {
-    char buf[255];
-    stprintf::stprintf(buf, "@,@\n\n", _memcpyTriggered, _memcpyOps);
-    _samplefile.writeToFile(buf);
+    MemcpyRecord record;
+    record.count = _memcpyOps;
+    _samplefile.writeRecord(record);
   }
 };
 
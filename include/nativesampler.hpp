@@ -0,0 +1,191 @@
+#pragma once
+#ifndef NATIVESAMPLER_HPP
+#define NATIVESAMPLER_HPP
+
+#include <dlfcn.h>
+#include <errno.h>
+#include <execinfo.h>
+#include <pthread.h>
+#include <signal.h>
+#include <stdint.h>
+#include <time.h>
+
+#include "common.hpp"
+#include "open_addr_hashtable.hpp"
+#include "samplefile.hpp"
+
+// How many return addresses we keep per sample, innermost first.
+enum { NativeStackDepth = 16 };
+
+// A native call stack, as written to the signal file.
+// Things that need to be in sync with scalene/samplefile.py.
+struct NativeRecord {
+  uint64_t sequence; // position in the ring plus one (set by SampleFile)
+  uint64_t threadId; // pthread_self() of the sampled thread
+  uint64_t depth;    // number of return addresses in frames
+  uint64_t frames[NativeStackDepth];
+};
+
+// Samples the native call stack of whichever thread is on the CPU,
+// every so often (in process CPU time), so scalene can say which C
+// functions a line's "native" time went to. The signal handler only
+// walks the stack (with backtrace) and publishes the raw return
+// addresses; scalene reads them when it takes its own CPU samples and
+// asks us to name them (symbolize), outside of any signal handler.
+//
+// The timer's signal goes to the process, and the kernel may hand it
+// to any thread that doesn't block it, including one that is asleep.
+// So the handler drops the sample unless the thread it landed on has
+// used CPU since the last sample it received (the first one a thread
+// receives only records where it stands).
+
+class NativeSampler {
+public:
+  static NativeSampler &instance() {
+    static NativeSampler sampler;
+    return sampler;
+  }
+
+  // Start sampling every interval seconds of CPU time (or change the
+  // interval). Returns false if we can't.
+  bool start(double interval) {
+#if !defined(__linux__)
+    // No POSIX per-process CPU timers (e.g., macOS).
+    (void)interval;
+    return false;
+#else
+    if (!_timerCreated) {
+      struct sigaction action {};
+      action.sa_sigaction = handler;
+      action.sa_flags = SA_SIGINFO | SA_RESTART;
+      sigemptyset(&action.sa_mask);
+      if (sigaction(signalNumber(), &action, nullptr) != 0) {
+        return false;
+      }
+      struct sigevent event {};
+      event.sigev_notify = SIGEV_SIGNAL;
+      event.sigev_signo = signalNumber();
+      if (timer_create(CLOCK_PROCESS_CPUTIME_ID, &event, &_timer) != 0) {
+        return false;
+      }
+      _timerCreated = true;
+    }
+    struct itimerspec spec {};
+    spec.it_value.tv_sec = (time_t)interval;
+    spec.it_value.tv_nsec = (long)((interval - (time_t)interval) * 1e9);
+    if (spec.it_value.tv_sec == 0 && spec.it_value.tv_nsec == 0) {
+      spec.it_value.tv_nsec = 1;
+    }
+    spec.it_interval = spec.it_value;
+    return timer_settime(_timer, 0, &spec, nullptr) == 0;
+#endif
+  }
+
+  void stop() {
+#if defined(__linux__)
+    if (_timerCreated) {
+      struct itimerspec spec {};
+      timer_settime(_timer, 0, &spec, nullptr);
+    }
+#endif
+  }
+
+  // The function and shared object containing address (either may be
+  // null if unknown). Looked up with dladdr once per address.
+  bool symbolize(void *address, const char **symbol, const char **object) {
+    auto name = _symbols.get(address);
+    if (name != nullptr) {
+      *symbol = (name == unnamed()) ? nullptr : (const char *)name;
+      *object = (const char *)_objects.get(address);
+      return true;
+    }
+    Dl_info info;
+    if (!dladdr(address, &info)) {
+      return false;
+    }
+    *symbol = info.dli_sname;
+    *object = info.dli_fname;
+    // Open addressing needs some empty slots to terminate probes.
+    if (_cached < CacheSize / 2) {
+      _symbols.put(address,
+                   info.dli_sname ? (void *)info.dli_sname : unnamed());
+      _objects.put(address, (void *)info.dli_fname);
+      _cached++;
+    }
+    return true;
+  }
+
+private:
+  enum { CacheSize = 65536 };
+  // The return addresses of the handler itself and of the signal
+  // trampoline, which aren't the sampled code.
+  enum { SkippedFrames = 2 };
+  // Cached for addresses that dladdr found no symbol for.
+  static void *unnamed() {
+    static char marker;
+    return &marker;
+  }
+
+  NativeSampler()
+      : _samplefile((char *)"/tmp/scalene-native-signal@",
+                    (char *)"/tmp/scalene-native-lock@",
+                    sizeof(NativeRecord)),
+        _timerCreated(false), _cached(0) {}
+
+  // Prevent copying and assignment.
+  NativeSampler(const NativeSampler &) = delete;
+  NativeSampler &operator=(const NativeSampler &) = delete;
+
+#if defined(__linux__)
+  static int signalNumber() { return SIGRTMIN + 3; }
+#endif
+
+  // Has the calling thread used any CPU since it last asked?
+  static bool threadRanSinceLastSample() {
+#if defined(__linux__)
+    // initial-exec, so that reaching it never allocates.
+    static __thread uint64_t lastCpuTime
+        __attribute__((tls_model("initial-exec"))) = 0;
+    struct timespec now;
+    if (clock_gettime(CLOCK_THREAD_CPUTIME_ID, &now) != 0) {
+      return true;
+    }
+    auto cpuTime = (uint64_t)now.tv_sec * 1000000000 + (uint64_t)now.tv_nsec;
+    auto ran = (lastCpuTime != 0) && (cpuTime != lastCpuTime);
+    lastCpuTime = cpuTime;
+    return ran;
+#else
+    return true;
+#endif
+  }
+
+  static void handler(int, siginfo_t *, void *) {
+    auto savedErrno = errno;
+    if (!threadRanSinceLastSample()) {
+      errno = savedErrno;
+      return;
+    }
+    void *callstack[NativeStackDepth + SkippedFrames];
+    auto frames = backtrace(callstack, NativeStackDepth + SkippedFrames);
+    NativeRecord record;
+    record.threadId = (uint64_t)pthread_self();
+    record.depth = 0;
+    for (auto i = (int)SkippedFrames; i < frames; i++) {
+      record.frames[record.depth++] = (uint64_t)callstack[i];
+    }
+    instance()._samplefile.writeRecord(record);
+    errno = savedErrno;
+  }
+
+  SampleFile _samplefile;
+#if defined(__linux__)
+  timer_t _timer;
+#endif
+  bool _timerCreated;
+  // Address -> function name and shared object name.
+  open_addr_hashtable<CacheSize> _symbols;
+  open_addr_hashtable<CacheSize> _objects;
+  unsigned long _cached;
+};
+
+#endif
@@ -0,0 +1,164 @@
+#pragma once
+#ifndef PYTHONFRAME_HPP
+#define PYTHONFRAME_HPP
+
+#include <dlfcn.h>
+#include <stdint.h>
+
+// Only the version macros (PY_VERSION_HEX); the build passes Python's
+// include directory (see GNUmakefile).
+#if defined(__has_include)
+#if __has_include(<patchlevel.h>)
+#include <patchlevel.h>
+#endif
+#endif
+
+// Finds the Python code object, line and bytecode offset that the
+// calling thread is running, so samples can be attributed to the line
+// that actually allocated rather than wherever the interpreter happens
+// to be when the signal handler runs. libscalene is not linked against
+// Python, so we look up the C API with dlsym; without it (or without
+// the GIL), capture() finds nothing.
+//
+// We are in the middle of an allocation, so capture() must not
+// allocate or run any Python code. Before 3.11, every running frame is
+// already a frame object, and the public API just reads it. From 3.11
+// on, frame objects are only created on demand (which allocates), so
+// we read the interpreter's own frame instead. Its layout is private
+// and changes between minor versions, so we only do that when we were
+// built against 3.11's headers and are running in a 3.11 interpreter;
+// otherwise (including on 3.12 and later), capture() finds nothing and
+// scalene charges allocations to the line it sees when it reads them.
+
+class PythonFrame {
+public:
+  static bool capture(uint64_t &code, int32_t &line, int32_t &lasti) {
+    auto &api = getAPI();
+    if (!api.available || !api.Py_IsInitialized() ||
+        !api.PyGILState_Check()) {
+      return false;
+    }
+    auto tstate = api.PyGILState_GetThisThreadState();
+    if (!tstate) {
+      return false;
+    }
+    if (!api.Py_Version) {
+      return captureFrameObject(api, tstate, code, line, lasti);
+    }
+#if defined(PY_VERSION_HEX) && (PY_VERSION_HEX >> 16) == 0x030B
+    // Built for 3.11: check we are running in 3.11 too.
+    if ((*api.Py_Version >> 16) == (PY_VERSION_HEX >> 16)) {
+      return captureInterpreterFrame311(api, tstate, code, line, lasti);
+    }
+#endif
+    return false;
+  }
+
+private:
+  // The parts of the C API we use (PyObject * is void * here).
+  class API {
+  public:
+    API() {
+      Py_IsInitialized = (int (*)())dlsym(RTLD_DEFAULT, "Py_IsInitialized");
+      PyGILState_Check = (int (*)())dlsym(RTLD_DEFAULT, "PyGILState_Check");
+      PyGILState_GetThisThreadState =
+          (void *(*)())dlsym(RTLD_DEFAULT, "PyGILState_GetThisThreadState");
+      PyThreadState_GetFrame =
+          (void *(*)(void *))dlsym(RTLD_DEFAULT, "PyThreadState_GetFrame");
+      PyFrame_GetCode =
+          (void *(*)(void *))dlsym(RTLD_DEFAULT, "PyFrame_GetCode");
+      PyFrame_GetLineNumber =
+          (int (*)(void *))dlsym(RTLD_DEFAULT, "PyFrame_GetLineNumber");
+      PyCode_Addr2Line =
+          (int (*)(void *, int))dlsym(RTLD_DEFAULT, "PyCode_Addr2Line");
+      Py_DecRef = (void (*)(void *))dlsym(RTLD_DEFAULT, "Py_DecRef");
+      // Only in 3.11+.
+      Py_Version = (const unsigned long *)dlsym(RTLD_DEFAULT, "Py_Version");
+      available = Py_IsInitialized && PyGILState_Check &&
+                  PyGILState_GetThisThreadState && PyThreadState_GetFrame &&
+                  PyFrame_GetCode && PyFrame_GetLineNumber &&
+                  PyCode_Addr2Line && Py_DecRef;
+    }
+    bool available;
+    int (*Py_IsInitialized)();
+    int (*PyGILState_Check)();
+    void *(*PyGILState_GetThisThreadState)();
+    void *(*PyThreadState_GetFrame)(void *);
+    void *(*PyFrame_GetCode)(void *);
+    int (*PyFrame_GetLineNumber)(void *);
+    int (*PyCode_Addr2Line)(void *, int);
+    void (*Py_DecRef)(void *);
+    const unsigned long *Py_Version;
+  };
+
+  static API &getAPI() {
+    static API api;
+    return api;
+  }
+
+  // 3.9 and 3.10: these calls only take new references to objects that
+  // already exist.
+  static bool captureFrameObject(API &api, void *tstate, uint64_t &code,
+                                 int32_t &line, int32_t &lasti) {
+    auto frame = api.PyThreadState_GetFrame(tstate);
+    if (!frame) {
+      return false;
+    }
+    auto co = api.PyFrame_GetCode(frame);
+    code = (uint64_t)co;
+    line = api.PyFrame_GetLineNumber(frame);
+    lasti = -1;
+    api.Py_DecRef(co);
+    api.Py_DecRef(frame);
+    return true;
+  }
+
+  // 3.11: tstate->cframe->current_frame, skipping incomplete frames the
+  // way PyThreadState_GetFrame does (but without making a frame object).
+  // Offsets are from 3.11's Include/cpython/pystate.h,
+  // Include/internal/pycore_frame.h and Include/cpython/code.h (64-bit).
+  struct Layout311 {
+    enum {
+      ThreadStateCFrame = 56,
+      CFrameCurrentFrame = 8,
+      FrameCode = 32,
+      FramePrevious = 48,
+      FramePrevInstr = 56,
+      FrameOwner = 69,
+      CodeFirstTraceable = 168,
+      CodeAdaptive = 184,
+      OwnedByGenerator = 1,
+      CodeUnitSize = 2,
+    };
+  };
+
+  template <class T> static inline T field(void *base, int offset) {
+    return *reinterpret_cast<T *>(reinterpret_cast<char *>(base) + offset);
+  }
+
+  static bool captureInterpreterFrame311(API &api, void *tstate,
+                                         uint64_t &code, int32_t &line,
+                                         int32_t &lasti) {
+    typedef Layout311 L;
+    auto cframe = field<void *>(tstate, L::ThreadStateCFrame);
+    auto frame = cframe ? field<void *>(cframe, L::CFrameCurrentFrame)
+                        : nullptr;
+    while (frame) {
+      auto co = field<char *>(frame, L::FrameCode);
+      auto prevInstr = field<char *>(frame, L::FramePrevInstr);
+      auto first = co + L::CodeAdaptive +
+                   L::CodeUnitSize * field<int>(co, L::CodeFirstTraceable);
+      if (field<char>(frame, L::FrameOwner) == L::OwnedByGenerator ||
+          prevInstr >= first) {
+        code = (uint64_t)co;
+        lasti = (int32_t)(prevInstr - (co + L::CodeAdaptive));
+        line = api.PyCode_Addr2Line(co, lasti);
+        return true;
+      }
+      frame = field<void *>(frame, L::FramePrevious);
+    }
+    return false;
+  }
+};
+
+#endif
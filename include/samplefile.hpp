@@ -4,24 +4,60 @@
 
 #include <heaplayers.h>
 #include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
 #include <sys/file.h>
 #include <sys/mman.h>
+#include <time.h>
 #include <unistd.h>
 
+#include "common.hpp"
 #include "rtememcpy.h"
 #include "stprintf.h"
 #include "tprintf.h"
 
+// Header stored at the start of the lock file. Readers check the
+// magic number, version and record size before decoding any records.
+// The signal file is a ring of `capacity` records: writers reserve
+// slots by advancing `head`, and the Python side advances `tail` after
+// reading. Things that need to be in sync with scalene/samplefile.py.
+struct SampleFileHeader {
+  uint32_t magic;      // SampleFile::Magic once initialized
+  uint32_t version;    // SampleFile::Version
+  uint32_t recordSize; // size in bytes of every record in the signal file
+  uint32_t capacity;   // number of records the ring holds
+  uint64_t head;       // slots reserved by writers so far
+  uint64_t tail;       // records consumed so far (written by the reader)
+  uint64_t overflows;  // records dropped because the ring was full
+  uint64_t signals;    // signals raised to announce new records
+  uint64_t samplingRate; // set by the reader to change the sampling rate
+                         // at runtime (0: as configured at startup)
+};
+
 // Handles creation, deletion, and concurrency control
 // signal files in memory
 
 class SampleFile {
   static constexpr int LOCK_FD_SIZE = 4096;
-  static constexpr int MAX_FILE_SIZE = 4096 * 65536;
-  static constexpr int MAX_BUFSIZE = 1024;
+  static constexpr int MAX_FILE_SIZE = 4096 * 1024;
 
 public:
-  SampleFile(char *filename_template, char *lockfilename_template) {
+  static constexpr uint32_t Magic = 0x4e4c4353; // "SCLN"
+  static constexpr uint32_t Version = 6;
+
+  SampleFile(char *filename_template, char *lockfilename_template,
+             uint32_t recordSize)
+      : _recordSize(recordSize), _batchSize(1), _batchNanos(0),
+        _lastSignal(0) {
+    // Signal coalescing (see shouldSignal), configured by scalene.
+    auto batchSize = getenv("SCALENE_SIGNAL_BATCH_SIZE");
+    if (batchSize) {
+      _batchSize = strtoull(batchSize, nullptr, 10);
+    }
+    auto batchTime = getenv("SCALENE_SIGNAL_BATCH_TIME");
+    if (batchTime) {
+      _batchNanos = (uint64_t)(strtod(batchTime, nullptr) * 1e9);
+    }
     auto pid = getpid();
     // tprintf::tprintf("SampleFile: pid = @, tid=@, this=@\n", pid,
     // pthread_self(), (void*) this);
@@ -38,7 +74,7 @@ public:
     ftruncate(lock_fd, LOCK_FD_SIZE);
     _mmap = reinterpret_cast<char *>(mmap(
         0, MAX_FILE_SIZE, PROT_READ | PROT_WRITE, MAP_SHARED, signal_fd, 0));
-    _lastpos = reinterpret_cast<int *>(
+    _header = reinterpret_cast<SampleFileHeader *>(
         mmap(0, LOCK_FD_SIZE, PROT_READ | PROT_WRITE, MAP_SHARED, lock_fd, 0));
     close(signal_fd);
     close(lock_fd);
@@ -47,45 +83,161 @@ public:
                        __LINE__);
       abort();
     }
-    if (_lastpos == MAP_FAILED) {
+    if (_header == MAP_FAILED) {
       tprintf::tprintf("Scalene: internal error = @ (@:@)\n", errno, __FILE__,
                        __LINE__);
       abort();
     }
-    *_lastpos = 0;
+    // Every thread-specific heap maps the same files, so only the
+    // first one to get here initializes the header.
+    lock.lock();
+    if (_header->magic != Magic) {
+      _header->version = Version;
+      _header->recordSize = _recordSize;
+      _header->capacity = MAX_FILE_SIZE / _recordSize;
+      _header->head = 0;
+      _header->tail = 0;
+      _header->overflows = 0;
+      _header->signals = 0;
+      _header->samplingRate = 0;
+      __atomic_store_n(&_header->magic, Magic, __ATOMIC_RELEASE);
+    }
+    lock.unlock();
   }
   ~SampleFile() {
     munmap(_mmap, MAX_FILE_SIZE);
-    munmap(_lastpos, LOCK_FD_SIZE);
+    munmap(_header, LOCK_FD_SIZE);
     unlink(_signalfile);
     unlink(_lockfile);
     //    tprintf::tprintf("~SampleFile: pid = @, tid=@, this=@\n", getpid(),
     //    pthread_self(), (void*) this);
   }
-  void writeToFile(char *line) {
-    lock.lock();
-    strncpy(_mmap + *_lastpos, (const char *)line, MAX_BUFSIZE); // FIXME
-    *_lastpos += strlen(_mmap + *_lastpos) - 1;
-    lock.unlock();
+  // Copy a record a word at a time: memcpy is interposed on, so we
+  // can't call it here.
+  template <class Record>
+  static inline void copyRecord(Record *dst, const Record *src) {
+    static_assert(sizeof(Record) % sizeof(uint64_t) == 0,
+                  "Records must be a whole number of words.");
+    auto s = reinterpret_cast<const uint64_t *>(src);
+    auto d = reinterpret_cast<uint64_t *>(dst);
+    for (size_t i = 0; i < sizeof(Record) / sizeof(uint64_t); i++) {
+      d[i] = s[i];
+    }
+  }
+
+  // Publish n records. Writers never take a lock: each one reserves a
+  // run of slots by advancing head with a compare-and-swap, fills them
+  // in, and then stores each record's sequence number (its position in
+  // the ring, plus one) last. The reader stops at the first slot whose
+  // sequence number is not the one it expects, so it never sees a
+  // partially written record. (That also means a writer preempted
+  // between reserving its slots and publishing them holds up the reader
+  // until it runs again; if the ring fills up meanwhile, everyone's
+  // records are dropped, and counted in overflows.)
+  template <class Record> void writeRecords(Record *records, uint32_t n) {
+    assert(sizeof(Record) == _recordSize);
+    const auto capacity = _header->capacity;
+    auto head = __atomic_load_n(&_header->head, __ATOMIC_RELAXED);
+    do {
+      auto tail = __atomic_load_n(&_header->tail, __ATOMIC_ACQUIRE);
+      if (unlikely(head + n - tail > capacity)) {
+        // The reader is too far behind: drop these records, but count them.
+        __atomic_fetch_add(&_header->overflows, n, __ATOMIC_RELAXED);
+        return;
+      }
+    } while (!__atomic_compare_exchange_n(&_header->head, &head, head + n,
+                                          true, __ATOMIC_ACQ_REL,
+                                          __ATOMIC_RELAXED));
+    for (uint32_t i = 0; i < n; i++) {
+      auto ticket = head + i;
+      auto slot = reinterpret_cast<Record *>(
+          _mmap + (ticket % capacity) * sizeof(Record));
+      records[i].sequence = 0;
+      copyRecord(slot, &records[i]);
+      __atomic_store_n(&slot->sequence, ticket + 1, __ATOMIC_RELEASE);
+    }
+  }
+
+  template <class Record> void writeRecord(Record &record) {
+    writeRecords(&record, 1);
+  }
+
+  // Should the writer raise a signal to announce the records it just
+  // published? Ordinarily, yes. When batching is enabled
+  // (SCALENE_SIGNAL_BATCH_SIZE > 1), only once that many records are
+  // waiting to be read, or once SCALENE_SIGNAL_BATCH_TIME seconds have
+  // passed since this writer last raised one; the reader drains every
+  // waiting record each time.
+  bool shouldSignal() {
+    if (_batchSize > 1) {
+      auto pending = __atomic_load_n(&_header->head, __ATOMIC_RELAXED) -
+                     __atomic_load_n(&_header->tail, __ATOMIC_RELAXED);
+      auto now = nanoseconds();
+      if ((pending < _batchSize) && (now - _lastSignal < _batchNanos)) {
+        return false;
+      }
+      _lastSignal = now;
+    }
+    __atomic_fetch_add(&_header->signals, 1, __ATOMIC_RELAXED);
+    return true;
   }
 
+  // The sampling rate the reader has asked for, or 0 for no change.
+  uint64_t requestedSamplingRate() const {
+    return __atomic_load_n(&_header->samplingRate, __ATOMIC_RELAXED);
+  }
+
+  // Wake up the reader's collector thread, if it has one waiting on a
+  // pipe (see scalene_set_notify_fd in libscalene.cpp). Returns false if
+  // the caller should raise a signal instead.
+  static bool notify() {
+    auto fd = __atomic_load_n(&notifyFd, __ATOMIC_ACQUIRE);
+    if (fd < 0) {
+      return false;
+    }
+    // The pipe is non-blocking; if it is full, the collector already
+    // has wakeups pending.
+    char c = 0;
+    auto r = write(fd, &c, 1);
+    (void)r;
+    return true;
+  }
+
+  // The write end of the collector's pipe, or -1 to use signals.
+  // Note: initialized in libscalene.cpp
+  static int notifyFd;
+
+  // For readers in this process (see benchmarks/samplefile_bench.cpp).
+  SampleFileHeader *header() const { return _header; }
+  char *ring() const { return _mmap; }
+
 private:
   // Prevent copying and assignment.
   SampleFile(const SampleFile &) = delete;
   SampleFile &operator=(const SampleFile &) = delete;
 
+  static inline uint64_t nanoseconds() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+  }
+
   // Flags for the mmap regions
   static constexpr auto flags = O_RDWR | O_CREAT;
   static constexpr auto perms = S_IRUSR | S_IWUSR;
 
   char _signalfile[256]; // Name of log file that signals are written to
-  char _lockfile[256];   // Name of file that _lastpos is persisted in
+  char _lockfile[256];   // Name of file that _header is persisted in
   //  int _signal_fd; // fd of log file that signals are written to
-  //  int _lock_fd; // fd of file that _lastpos is persisted in
-  char *_mmap;   // address of first byte of log
-  int *_lastpos; // address of first byte of _lastpos
+  //  int _lock_fd; // fd of file that _header is persisted in
+  char *_mmap;               // address of first byte of log
+  SampleFileHeader *_header; // address of first byte of the header
+  uint32_t _recordSize;      // size of each record in the log
+  uint64_t _batchSize;       // records to wait for before signaling
+  uint64_t _batchNanos;      // ...or how long to wait at most
+  uint64_t _lastSignal;      // when this writer last signaled (ns)
 
-  // Note: initialized in libscalene.cpp
+  // Only guards header initialization. Note: initialized in libscalene.cpp
   static HL::PosixLock lock;
 };
 
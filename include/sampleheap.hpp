@@ -16,6 +16,7 @@
 
 #include "common.hpp"
 #include "open_addr_hashtable.hpp"
+#include "pythonframe.hpp"
 #include "samplefile.hpp"
 #include "sampler.hpp"
 #include "stprintf.h"
@@ -29,6 +30,20 @@ typedef std::atomic<uint64_t> counterType;
 typedef uint64_t counterType;
 #endif
 
+// A single malloc or free sample, as written to the signal file.
+// Things that need to be in sync with scalene/samplefile.py.
+struct AllocationRecord {
+  char action; // 'M' (malloc) or 'F' (free)
+  char padding[7];
+  uint64_t sequence;     // position in the ring plus one (set by SampleFile)
+  uint64_t count;        // bytes represented by this sample
+  double pythonFraction; // fraction of sampled bytes allocated by Python
+  uint64_t threadId;     // pthread_self() of the allocating thread
+  uint64_t codeAddress;  // Python code object running when sampled, or 0
+  int32_t lineNumber;    // ...the line it was on
+  int32_t lasti;         // ...and its bytecode offset (-1 if unknown)
+};
+
 template <uint64_t MallocSamplingRateBytes, class SuperHeap>
 class SampleHeap : public SuperHeap {
 
@@ -40,14 +55,24 @@ public:
   enum {
     CallStackSamplingRate = MallocSamplingRateBytes * 10
   }; // 10 here just to reduce overhead
+  // Overrides MallocSamplingRateBytes (see --malloc-sampling-rate).
+  static constexpr auto MallocSamplingRateVariable =
+      "SCALENE_MALLOC_SAMPLING_RATE";
 
   SampleHeap()
-      : _samplefile((char *)"/tmp/scalene-malloc-signal@",
-                    (char *)"/tmp/scalene-malloc-lock@"),
+      : _mallocSampler(MallocSamplingRateVariable),
+        _freeSampler(MallocSamplingRateVariable),
+        _callStackSampler(MallocSamplingRateVariable,
+                          CallStackSamplingRate / MallocSamplingRateBytes),
+        _samplefile((char *)"/tmp/scalene-malloc-signal@",
+                    (char *)"/tmp/scalene-malloc-lock@",
+                    sizeof(AllocationRecord)),
         _mallocTriggered(0), _freeTriggered(0), _pythonCount(0), _cCount(0) {
-    // Ignore these signals until they are replaced by a client.
-    signal(MallocSignal, SIG_IGN);
-    signal(FreeSignal, SIG_IGN);
+    // Ignore these signals until they are replaced by a client. Every
+    // thread gets its own heap, so don't clobber a handler that the
+    // client has already installed.
+    ignoreUnlessHandled(MallocSignal);
+    ignoreUnlessHandled(FreeSignal);
   }
 
   ~SampleHeap() {
@@ -114,22 +139,48 @@ private:
   SampleHeap(const SampleHeap &) = delete;
   SampleHeap &operator=(const SampleHeap &) = delete;
 
+  static void ignoreUnlessHandled(int sig) {
+    struct sigaction action;
+    if ((sigaction(sig, nullptr, &action) == 0) &&
+        (action.sa_handler == SIG_DFL)) {
+      signal(sig, SIG_IGN);
+    }
+  }
+
+  // Follow the rate scalene asks for (see --max-overhead). Sample counts
+  // are in bytes, so changing the rate doesn't bias them.
+  void updateSamplingRate() {
+    auto rate = _samplefile.requestedSamplingRate();
+    if (unlikely(rate && rate != _mallocSampler.rate())) {
+      _mallocSampler.setRate(rate);
+      _freeSampler.setRate(rate);
+    }
+  }
+
   void handleMalloc(size_t sampleMalloc) {
+    updateSamplingRate();
     writeCount(MallocSignal, sampleMalloc);
     _pythonCount = 0;
     _cCount = 0;
     _mallocTriggered++;
-#if !SCALENE_DISABLE_SIGNALS
-    raise(MallocSignal);
-#endif
+    publish(MallocSignal);
   }
 
   void handleFree(size_t sampleFree) {
+    updateSamplingRate();
     writeCount(FreeSignal, sampleFree);
     _freeTriggered++;
+    publish(FreeSignal);
+  }
+
+  // Tell the Python side about the record we just wrote (possibly
+  // along with later ones).
+  void publish(AllocSignal sig) {
+    if (_samplefile.shouldSignal() && !SampleFile::notify()) {
 #if !SCALENE_DISABLE_SIGNALS
-    raise(FreeSignal);
+      raise(sig);
 #endif
+    }
   }
 
   Sampler<MallocSamplingRateBytes> _mallocSampler;
@@ -254,31 +305,21 @@ private:
   static constexpr auto perms = S_IRUSR | S_IWUSR;
 
   void writeCount(AllocSignal sig, uint64_t count) {
-    const auto MAX_BUFSIZE = 1024;
-    char buf[MAX_BUFSIZE];
     if (_pythonCount == 0) {
       _pythonCount = 1; // prevent 0/0
     }
-#if 0
-    stprintf::stprintf(_mmap + _lastpos,
-		       "@,@,@,@\n\n",
-		       ((sig == MallocSignal) ? 'M' : 'F'),
-		       _mallocTriggered + _freeTriggered,
-		       count,
-		       (float) _pythonCount / (_pythonCount + _cCount));
-#else
-    //    tprintf::tprintf("count = @\n", count);
-    snprintf(buf, MAX_BUFSIZE,
-#if defined(__APPLE__)
-             "%c,%llu,%llu,%f\n\n",
-#else
-             "%c,%lu,%lu,%f\n\n",
-#endif
-             ((sig == MallocSignal) ? 'M' : 'F'),
-             _mallocTriggered + _freeTriggered, count,
-             (float)_pythonCount / (_pythonCount + _cCount));
-#endif
-    _samplefile.writeToFile(buf);
+    AllocationRecord record{};
+    record.action = (sig == MallocSignal) ? 'M' : 'F';
+    record.count = count;
+    record.pythonFraction = (double)_pythonCount / (_pythonCount + _cCount);
+    record.threadId = (uint64_t)pthread_self();
+    if (!PythonFrame::capture(record.codeAddress, record.lineNumber,
+                              record.lasti)) {
+      record.codeAddress = 0;
+      record.lineNumber = 0;
+      record.lasti = -1;
+    }
+    _samplefile.writeRecord(record);
   }
 };
 
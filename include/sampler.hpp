@@ -15,6 +15,7 @@
 
 #include <pthread.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <time.h>
 #include <unistd.h>
 
@@ -22,11 +23,12 @@
 #include "lowdiscrepancy.hpp"
 #endif
 
+// Samples on average once every SAMPLE_RATE bytes, unless the
+// environment variable passed to the constructor (set by scalene from
+// its command line) says otherwise.
 template <uint64_t SAMPLE_RATE> class Sampler {
 private:
-  static constexpr double SAMPLE_PROBABILITY =
-      (double)1.0 / (double)SAMPLE_RATE;
-
+  uint64_t _rate;
   uint64_t _lastSampleSize;
   uint64_t _next;
 #if !SAMPLER_DETERMINISTIC
@@ -39,19 +41,49 @@ private:
   LowDiscrepancy rng{1234567890UL + (uint64_t)getpid() +
                      (uint64_t)pthread_self()};
 #endif
-  std::geometric_distribution<uint64_t> geom{SAMPLE_PROBABILITY};
+  std::geometric_distribution<uint64_t> geom;
 #endif
 
+  static uint64_t rateFromEnvironment(const char *name, uint64_t scale) {
+    auto value = name ? getenv(name) : nullptr;
+    if (value) {
+      auto rate = strtoull(value, nullptr, 10);
+      if (rate > 0) {
+        return rate * scale;
+      }
+    }
+    return SAMPLE_RATE;
+  }
+
 public:
-  Sampler() {
+  // The rate, if set, is scaled by scale (for samplers that run at a
+  // multiple of another one's rate).
+  explicit Sampler(const char *rateVariable = nullptr, uint64_t scale = 1)
+      : _rate(rateFromEnvironment(rateVariable, scale))
+#if !SAMPLER_DETERMINISTIC
+        ,
+        geom((double)1.0 / (double)_rate)
+#endif
+  {
 #if !SAMPLER_DETERMINISTIC
     _next = geom(rng); // SAMPLE_RATE;
 #else
-    _next = SAMPLE_RATE;
+    _next = _rate;
 #endif
     _lastSampleSize = _next;
   }
 
+  uint64_t rate() const { return _rate; }
+
+  // Change the rate from the next sample on.
+  void setRate(uint64_t rate) {
+    _rate = rate;
+#if !SAMPLER_DETERMINISTIC
+    geom.param(
+        std::geometric_distribution<uint64_t>::param_type(1.0 / (double)rate));
+#endif
+  }
+
   inline ATTRIBUTE_ALWAYS_INLINE uint64_t sample(uint64_t sz) {
     if (unlikely(_next <= sz)) {
       return updateSample(sz - _next);
@@ -63,7 +95,7 @@ public:
 private:
   uint64_t updateSample(uint64_t sz) {
 #if SAMPLER_DETERMINISTIC
-    _next = SAMPLE_RATE;
+    _next = _rate;
 #else
     while (true) {
       _next = geom(rng);
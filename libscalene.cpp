@@ -13,6 +13,7 @@
 #include "tprintf.h"
 
 #include "memcpysampler.hpp"
+#include "nativesampler.hpp"
 #include "sampleheap.hpp"
 #include "staticbufferheap.hpp"
 
@@ -58,6 +59,7 @@ public:
 
 static volatile InitializeMe initme;
 HL::PosixLock SampleFile::lock;
+int SampleFile::notifyFd = -1;
 
 CustomHeapType &getTheCustomHeap() {
   static CustomHeapType thang;
@@ -139,6 +141,30 @@ extern "C" ATTRIBUTE_EXPORT size_t xxmalloc_usable_size(void *ptr) {
   return getTheCustomHeap().getSize(ptr); // TODO FIXME adjust for ptr offset?
 }
 
+// Called (through ctypes) by a collector thread in scalene that wants
+// to be woken up through this pipe instead of by signals; -1 restores
+// signals.
+extern "C" ATTRIBUTE_EXPORT void scalene_set_notify_fd(int fd) {
+  __atomic_store_n(&SampleFile::notifyFd, fd, __ATOMIC_RELEASE);
+}
+
+// Called (through ctypes) by scalene --native-symbols to sample native
+// call stacks every interval seconds of CPU time; returns 0 if we can't.
+extern "C" ATTRIBUTE_EXPORT int scalene_start_native_sampling(double interval) {
+  return NativeSampler::instance().start(interval);
+}
+
+extern "C" ATTRIBUTE_EXPORT void scalene_stop_native_sampling() {
+  NativeSampler::instance().stop();
+}
+
+// Name the function and shared object containing a sampled address;
+// returns 0 if dladdr doesn't know it.
+extern "C" ATTRIBUTE_EXPORT int
+scalene_symbolize(uint64_t address, const char **symbol, const char **object) {
+  return NativeSampler::instance().symbolize((void *)address, symbol, object);
+}
+
 extern "C" ATTRIBUTE_EXPORT void xxmalloc_lock() { getTheCustomHeap().lock(); }
 
 extern "C" ATTRIBUTE_EXPORT void xxmalloc_unlock() {
@@ -2,6 +2,12 @@ import sys
 
 
 def main():
+    if sys.argv[1:2] == ["diff"]:
+        from scalene import profilediff
+        sys.exit(profilediff.main(sys.argv[2:]))
+    if sys.argv[1:2] == ["merge"]:
+        from scalene import profilemerge
+        sys.exit(profilemerge.main(sys.argv[2:]))
     try:
         from scalene import scalene_profiler
         scalene_profiler.Scalene.main()
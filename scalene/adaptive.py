@@ -1,43 +1,109 @@
-from typing import List
+import heapq
+import time
+from array import array
+from typing import List, Optional, Tuple
+
+
+def _median(data: "array[float]", i: int) -> Tuple[float, float]:
+    """The median of the three (time, value) pairs interleaved in data
+    from i on, dated at the middle one's time."""
+    a, b, c = data[i + 1], data[i + 3], data[i + 5]
+    return (data[i + 2], max(min(a, b), min(max(a, b), c)))
 
 
 class Adaptive:
-    """Implements sampling to achieve the effect of a uniform random sample."""
+    """Implements sampling to achieve the effect of a uniform random sample.
+
+    Keeps at most size (time, value) samples. Once full, it replaces
+    each run of three samples by their median, and from then on takes
+    every stride-th added sample and keeps the median of each three of
+    those, so the samples it keeps stay evenly spread over the whole
+    timeline."""
+
+    __slots__ = ("max_samples", "data", "group", "stride", "skipped")
 
     def __init__(self, size: int):
-        # size must be a power of two
         self.max_samples = size
-        self.current_index = 0
-        self.sample_array = [0.0] * size
+        # The kept samples, as interleaved time, value pairs.
+        self.data = array("d")
+        # Samples waiting for the rest of their group of three.
+        self.group = array("d")
+        # Each kept sample summarizes 3 * stride added ones (once
+        # we have decimated; 0 before).
+        self.stride = 0
+        self.skipped = 0
 
     def __add__(self: "Adaptive", other: "Adaptive") -> "Adaptive":
         n = Adaptive(self.max_samples)
-        for i in range(0, self.max_samples):
-            n.sample_array[i] = self.sample_array[i] + other.sample_array[i]
-        n.current_index = max(self.current_index, other.current_index)
+        n.__merge(self, other)
         return n
 
     def __iadd__(self: "Adaptive", other: "Adaptive") -> "Adaptive":
-        for i in range(0, self.max_samples):
-            self.sample_array[i] += other.sample_array[i]
-        self.current_index = max(self.current_index, other.current_index)
+        mine = Adaptive(self.max_samples)
+        mine.data, mine.group = self.data, self.group
+        mine.stride, mine.skipped = self.stride, self.skipped
+        self.data, self.group = array("d"), array("d")
+        self.stride, self.skipped = 0, 0
+        self.__merge(mine, other)
         return self
 
-    def add(self, value: float) -> None:
-        if self.current_index >= self.max_samples:
-            # Decimate
-            new_array = [0.0] * self.max_samples
-            for i in range(0, self.max_samples // 3):
-                arr = [self.sample_array[i * 3 + j] for j in range(0, 3)]
-                arr.sort()
-                new_array[i] = arr[1]  # Median
-            self.current_index = self.max_samples // 3
-            self.sample_array = new_array
-        self.sample_array[self.current_index] = value
-        self.current_index += 1
+    def __merge(self, a: "Adaptive", b: "Adaptive") -> None:
+        """Add the timelines a and b: at each time either one changes,
+        the sum of their latest values (0 before their first sample)."""
+        last = [0.0, 0.0]
+        for (t, value, which) in heapq.merge(
+            ((t, v, 0) for (t, v) in a.samples()),
+            ((t, v, 1) for (t, v) in b.samples()),
+        ):
+            last[which] = value
+            self.add(last[0] + last[1], t)
+
+    def add(self, value: float, timestamp: Optional[float] = None) -> None:
+        if self.stride:
+            self.skipped += 1
+            if self.skipped < self.stride:
+                return
+            self.skipped = 0
+            if timestamp is None:
+                timestamp = time.perf_counter()
+            group = self.group
+            group.append(timestamp)
+            group.append(value)
+            if len(group) < 6:
+                return
+            timestamp, value = _median(group, 0)
+            del group[:]
+        elif timestamp is None:
+            timestamp = time.perf_counter()
+        data = self.data
+        data.append(timestamp)
+        data.append(value)
+        if len(data) >= 2 * self.max_samples:
+            self.__decimate()
+
+    def __decimate(self) -> None:
+        """Replace each run of three kept samples by its median."""
+        data = self.data
+        n = len(data) - len(data) % 6
+        decimated = array("d")
+        for i in range(0, n, 6):
+            decimated.extend(_median(data, i))
+        self.data = decimated
+        # Start the next group with the first sample left over.
+        self.group = data[n : n + 2]
+        self.stride = 3 * self.stride if self.stride else 1
+        self.skipped = 0
+
+    def samples(self) -> List[Tuple[float, float]]:
+        """Every (time, value) held, kept or grouped, in time order."""
+        held = self.data + self.group
+        return list(zip(held[::2], held[1::2]))
 
     def get(self) -> List[float]:
-        return self.sample_array
+        return self.data[1::2].tolist()
+
+    def get_times(self) -> List[float]:
+        return self.data[::2].tolist()
 
     def len(self) -> int:
-        return self.current_index
+        return len(self.data) // 2
@@ -0,0 +1,39 @@
+"""The memory footprint over a batch of allocation samples.
+
+The allocation handler reads every malloc/free record written since it
+last ran, computes the footprint after each one with a single prefix
+sum (in NumPy, if it's installed and the batch is big enough to be
+worth it), and keeps only the lowest, highest and last footprints of
+the batch (and of each line's share of it) for the timelines.
+"""
+import itertools
+from types import ModuleType
+from typing import List, Optional, Sequence, cast
+
+np: Optional[ModuleType]
+try:
+    import numpy
+
+    np = numpy
+except ImportError:
+    np = None
+
+# Below this many records, a NumPy round trip costs more than it saves.
+NUMPY_MIN_RECORDS = 256
+
+
+def running_footprint(start: float, deltas: Sequence[float]) -> List[float]:
+    """The footprint after each of deltas, starting from start."""
+    if np is not None and len(deltas) >= NUMPY_MIN_RECORDS:
+        footprints = np.cumsum(np.asarray(deltas, dtype=np.float64))
+        footprints += start
+        return cast(List[float], footprints.tolist())
+    return list(itertools.accumulate(itertools.chain([start], deltas)))[1:]
+
+
+def extremes(footprints: Sequence[float], indices: Sequence[int]) -> List[int]:
+    """The indices (among indices, which are in order) of the lowest,
+    highest and last of footprints, in the order they happened."""
+    lowest = min(indices, key=footprints.__getitem__)
+    highest = max(indices, key=footprints.__getitem__)
+    return sorted({lowest, highest, indices[-1]})
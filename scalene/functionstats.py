@@ -0,0 +1,90 @@
+"""Totals for each function, for the function summary above each file's
+line table.
+
+We add to a function's totals as we charge its lines, naming it by the
+code object we find on the stack (its name and first line), so we never
+have to work out from the source which lines belong to which function.
+"""
+from array import array
+from collections import defaultdict
+from types import CodeType
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (co_name, co_firstlineno)
+Function = Tuple[str, int]
+
+# What we total for each function.
+PYTHON_TIME = 0  # seconds
+NATIVE_TIME = 1  # seconds
+NET_MEMORY = 2  # MB allocated minus MB freed
+COPY_VOLUME = 3  # bytes copied
+METRICS = 4
+
+
+class FunctionStats:
+    def __init__(self) -> None:
+        self.totals: Dict[
+            str, Dict[Function, "array[float]"]
+        ] = defaultdict(dict)
+        # The function each line with samples was in (the first one we
+        # saw, for lines with more than one, like lambdas).
+        self.lines: Dict[str, Dict[int, Function]] = defaultdict(dict)
+
+    def add(
+        self, fname: str, line: int, code: CodeType, metric: int, v: float
+    ) -> None:
+        """Add v to metric for the function whose code is code (which
+        was at line)."""
+        functions = self.totals[fname]
+        key = (code.co_name, code.co_firstlineno)
+        totals = functions.get(key)
+        if totals is None:
+            totals = functions[key] = array("d", [0.0] * METRICS)
+        totals[metric] += v
+        self.lines[fname].setdefault(line, key)
+
+    def function_of(self, fname: str, line: int) -> Optional[Function]:
+        return self.lines.get(fname, {}).get(line)
+
+    def get(self, fname: str, function: Function) -> "array[float]":
+        totals = self.totals.get(fname, {}).get(function)
+        if totals is None:
+            return array("d", [0.0] * METRICS)
+        return totals
+
+    def top(
+        self, fname: str, metrics: Iterable[int], n: int
+    ) -> List[Function]:
+        """The functions in fname that are among the n with the largest
+        (positive) total of any of metrics, by total time and then by
+        net memory."""
+        functions = self.totals.get(fname, {})
+        chosen = set()
+        for metric in metrics:
+            ranked = sorted(
+                (f for f in functions if functions[f][metric] > 0),
+                key=lambda f: -functions[f][metric],
+            )
+            chosen.update(ranked[:n])
+        return sorted(
+            chosen,
+            key=lambda f: (
+                -(functions[f][PYTHON_TIME] + functions[f][NATIVE_TIME]),
+                -functions[f][NET_MEMORY],
+                f,
+            ),
+        )
+
+    def merge(self, other: "FunctionStats") -> None:
+        for fname, functions in other.totals.items():
+            mine = self.totals[fname]
+            for function, totals in functions.items():
+                if function in mine:
+                    for metric, v in enumerate(totals):
+                        mine[function][metric] += v
+                else:
+                    mine[function] = array("d", totals)
+        for fname, lines in other.lines.items():
+            mine_lines = self.lines[fname]
+            for line, function in lines.items():
+                mine_lines.setdefault(line, function)
@@ -0,0 +1,122 @@
+"""Scalene's JSON profile format (--json).
+
+A profile is one JSON document:
+
+    {"schema": "scalene-profile", "version": 1,
+     "metadata": {...},
+     "files": [{...}, {...}, ...]}
+
+We write it out one source file at a time, and the header, each file
+and the closing brackets each go on a line of their own, so that a
+profile can be read back one file at a time too (read_profile), without
+holding the whole document in memory. Any JSON tool can still read it
+as a whole.
+
+metadata:
+    program, argv, pid, children (the pids of the child processes
+    whose profiles were merged in), python, platform, elapsed_s,
+    cpu_sampling_rate_s, malloc_sampling_rate_bytes,
+    memcpy_sampling_rate_bytes, memory_profiled, total_cpu_s,
+    total_malloc_mb, total_free_mb, max_footprint_mb, footprint (the
+    footprint timeline: [seconds since start, MB] pairs), samples
+    (records, signals, dropped) and overhead (for each of Scalene's
+    timers: count and total_s).
+
+files[]:
+    filename, cpu_s (all the CPU time charged to the file),
+    malloc_samples, functions[] and lines[].
+
+functions[]:
+    name, first_line, python_s, native_s, net_mb, copy_bytes.
+
+lines[] (only lines with samples):
+    lineno, function ([name, first_line] of the function the samples
+    were in, or null), python_s, native_s, utilization (samples, mean
+    and sem of the fraction of wall-clock time on the CPU), malloc_mb,
+    python_malloc_mb, free_mb, malloc_count, free_count, copy_bytes,
+    leak_score, footprint (timeline, as above), bytecode[] (offset,
+    malloc_mb, python_malloc_mb, free_mb, malloc_count, free_count) and
+    native_symbols[] (symbol, object, samples).
+
+Profiles merged by scalene merge (see scalene/profilemerge.py) also
+have runs and sources (path, program, pid, children and elapsed_s of
+each run) in their metadata, and runs and across_runs (mean and
+variance of cpu_s, net_mb and copy_bytes) in each line.
+
+Times are in seconds and memory in MB unless the name says otherwise.
+New keys may be added within a version; keys are never renamed or
+removed without bumping it.
+"""
+import json
+from typing import IO, Any, Dict, Iterator, Tuple
+
+SCHEMA = "scalene-profile"
+VERSION = 1
+
+
+class ProfileWriter:
+    def __init__(self, out: IO[str], metadata: Dict[str, Any]) -> None:
+        self.__out = out
+        self.__files = 0
+        header = {"schema": SCHEMA, "version": VERSION, "metadata": metadata}
+        # Leave the header open for the files.
+        out.write(json.dumps(header)[:-1] + ', "files": [\n')
+
+    def add_file(self, profile: Dict[str, Any]) -> None:
+        self.__out.write((", " if self.__files else "") + json.dumps(profile))
+        self.__out.write("\n")
+        self.__files += 1
+
+    def close(self) -> None:
+        self.__out.write("]}\n")
+        self.__out.flush()
+
+
+def check_header(document: Dict[str, Any], path: str) -> None:
+    if document.get("schema") != SCHEMA:
+        raise ValueError("%s is not a Scalene JSON profile" % path)
+    if document.get("version") != VERSION:
+        raise ValueError(
+            "%s is a version %s Scalene profile; this Scalene reads version %d"
+            % (path, document.get("version"), VERSION)
+        )
+
+
+def read_profile(
+    path: str,
+) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """The metadata of the profile in path, and its files, which are
+    read one at a time as they are consumed."""
+    profile = open(path, "r")
+    header = profile.readline()
+    try:
+        document = json.loads(header.rstrip() + "]}")
+    except ValueError:
+        # Not laid out the way we write it (reformatted, say): read it
+        # all at once.
+        profile.seek(0)
+        try:
+            document = json.load(profile)
+        except ValueError:
+            profile.close()
+            raise ValueError("%s is not a Scalene JSON profile" % path)
+        profile.close()
+        check_header(document, path)
+        return (document["metadata"], iter(document["files"]))
+    try:
+        check_header(document, path)
+    except ValueError:
+        profile.close()
+        raise
+
+    def files() -> Iterator[Dict[str, Any]]:
+        with profile:
+            for line in profile:
+                line = line.strip()
+                if line == "]}":
+                    return
+                if line.startswith(","):
+                    line = line[1:]
+                yield json.loads(line)
+
+    return (document["metadata"], files())
@@ -0,0 +1,43 @@
+import bisect
+import dis
+from types import CodeType
+from typing import List, Tuple
+
+
+class LineRanges:
+    """A set of ranges of line numbers, for quick membership tests."""
+
+    def __init__(self) -> None:
+        # Disjoint, sorted ranges: [starts[i], ends[i]] (inclusive).
+        self.__starts: List[int] = []
+        self.__ends: List[int] = []
+
+    def add(self, first: int, last: int) -> None:
+        """Add the lines from first to last (inclusive)."""
+        ranges = list(zip(self.__starts, self.__ends)) + [(first, last)]
+        ranges.sort()
+        self.__starts, self.__ends = [], []
+        for (start, end) in ranges:
+            if self.__ends and start <= self.__ends[-1] + 1:
+                # Overlaps or abuts the previous range.
+                self.__ends[-1] = max(self.__ends[-1], end)
+            else:
+                self.__starts.append(start)
+                self.__ends.append(end)
+
+    def __contains__(self, line: int) -> bool:
+        i = bisect.bisect_right(self.__starts, line) - 1
+        return i >= 0 and line <= self.__ends[i]
+
+
+def code_lines(code: CodeType) -> Tuple[int, int]:
+    """The first and last lines of code, including any functions,
+    classes, lambdas or comprehensions nested inside it."""
+    last = code.co_firstlineno
+    for (_offset, line) in dis.findlinestarts(code):
+        if line is not None and line > last:
+            last = line
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            last = max(last, code_lines(const)[1])
+    return (code.co_firstlineno, last)
@@ -0,0 +1,135 @@
+import operator
+from array import array
+from typing import Dict, Iterator, List, Tuple
+
+
+class FileIds:
+    """Small integer ids for filenames, shared by the columns of a
+    profile so that each name is stored (and hashed) once."""
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.__ids: Dict[str, int] = {}
+
+    def id(self, fname: str) -> int:
+        """The id of fname (assigning one if needed)."""
+        fid = self.__ids.get(fname)
+        if fid is None:
+            fid = len(self.names)
+            self.__ids[fname] = fid
+            self.names.append(fname)
+        return fid
+
+    def find(self, fname: str) -> int:
+        """The id of fname, or -1 if it doesn't have one."""
+        return self.__ids.get(fname, -1)
+
+
+class LineColumn:
+    """One statistic for every line of every file: a growable array per
+    file, indexed by line number.
+
+    Reads of lines (or files) without samples give 0. Merging adds
+    another column's arrays to ours element-wise."""
+
+    def __init__(self, files: FileIds) -> None:
+        self.files = files
+        # by file id
+        self.__lines: List["array[float]"] = []
+
+    def __lines_of(self, fid: int, length: int) -> "array[float]":
+        """The array for file fid, at least length long."""
+        while len(self.__lines) <= fid:
+            self.__lines.append(array("d"))
+        lines = self.__lines[fid]
+        if len(lines) < length:
+            lines.extend(array("d", bytes(8 * (length - len(lines)))))
+        return lines
+
+    def add(self, fname: str, line: int, value: float) -> None:
+        """Add value to the statistic for line in fname."""
+        self.__lines_of(self.files.id(fname), line + 1)[line] += value
+
+    def get(self, fname: str, line: int) -> float:
+        fid = self.files.find(fname)
+        if 0 <= fid < len(self.__lines) and line < len(self.__lines[fid]):
+            return self.__lines[fid][line]
+        return 0.0
+
+    def __getitem__(self, fname: str) -> "FileLines":
+        return FileLines(self, fname)
+
+    def lines(self, fname: str) -> Iterator[Tuple[int, float]]:
+        """The lines in fname with samples, and their values."""
+        fid = self.files.find(fname)
+        if 0 <= fid < len(self.__lines):
+            for line, value in enumerate(self.__lines[fid]):
+                if value:
+                    yield (line, value)
+
+    def fnames(self) -> List[str]:
+        """The files with samples."""
+        return [
+            self.files.names[fid]
+            for fid, lines in enumerate(self.__lines)
+            if any(lines)
+        ]
+
+    def merge(self, other: "LineColumn") -> None:
+        for fid, theirs in enumerate(other.__lines):
+            if not theirs:
+                continue
+            mine = self.__lines_of(
+                self.files.id(other.files.names[fid]), len(theirs)
+            )
+            mine[: len(theirs)] = array("d", map(operator.add, mine, theirs))
+
+
+class FileLines:
+    """A LineColumn's values for one file, indexed by line number."""
+
+    def __init__(self, column: LineColumn, fname: str) -> None:
+        self.__column = column
+        self.__fname = fname
+
+    def __getitem__(self, line: int) -> float:
+        return self.__column.get(self.__fname, line)
+
+    def __setitem__(self, line: int, value: float) -> None:
+        self.__column.add(self.__fname, line, value - self[line])
+
+    def __contains__(self, line: int) -> bool:
+        return bool(self[line])
+
+    def values(self) -> List[float]:
+        return [value for (_line, value) in self.__column.lines(self.__fname)]
+
+
+class ByteCodeColumn(LineColumn):
+    """A LineColumn that also keeps each line's values by bytecode
+    offset, in a sparse side-table (most lines have only one offset
+    with samples, and most have none)."""
+
+    def __init__(self, files: FileIds) -> None:
+        super().__init__(files)
+        # by file id, then (line, offset)
+        self.__offsets: Dict[int, Dict[Tuple[int, int], float]] = {}
+
+    def add_at(self, fname: str, line: int, bytei: int, value: float) -> None:
+        """Add value to the statistic for the offset bytei in line."""
+        self.add(fname, line, value)
+        offsets = self.__offsets.setdefault(self.files.id(fname), {})
+        offsets[(line, bytei)] = offsets.get((line, bytei), 0.0) + value
+
+    def at(self, fname: str, line: int, bytei: int) -> float:
+        offsets = self.__offsets.get(self.files.find(fname), {})
+        return offsets.get((line, bytei), 0.0)
+
+    def merge(self, other: LineColumn) -> None:
+        super().merge(other)
+        if isinstance(other, ByteCodeColumn):
+            for fid, theirs in other.__offsets.items():
+                fname = other.files.names[fid]
+                offsets = self.__offsets.setdefault(self.files.id(fname), {})
+                for key, value in theirs.items():
+                    offsets[key] = offsets.get(key, 0.0) + value
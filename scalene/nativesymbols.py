@@ -0,0 +1,89 @@
+"""Names the native code that a line's "native" time went to.
+
+With --native-symbols, libscalene samples the native call stack of
+whichever thread is on the CPU (see include/nativesampler.hpp). We
+charge each sample to the function and shared object it landed in,
+unless that is the interpreter itself (which means the thread was
+running Python). libscalene caches its dladdr lookups, and we cache
+the names we get back by address.
+"""
+import ctypes
+import os
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+# (function, shared object): what a sample is charged to.
+NativeSymbol = Tuple[str, str]
+
+
+class NativeSymbols:
+    def __init__(self) -> None:
+        self.__lib: Optional[Any] = None
+        self.__names: Dict[int, Optional[NativeSymbol]] = {}
+        self.__interpreter = ""
+
+    def start(self, interval: float) -> bool:
+        """Ask libscalene to sample native stacks every interval seconds
+        of CPU time. Returns false if this libscalene can't."""
+        try:
+            lib = ctypes.CDLL(None)
+            lib.scalene_start_native_sampling.argtypes = [ctypes.c_double]
+            lib.scalene_symbolize.argtypes = [
+                ctypes.c_uint64,
+                ctypes.POINTER(ctypes.c_char_p),
+                ctypes.POINTER(ctypes.c_char_p),
+            ]
+            if not lib.scalene_start_native_sampling(interval):
+                return False
+        except (AttributeError, OSError):
+            return False
+        self.__lib = lib
+        # Samples that land here are Python time, not native.
+        interpreter = self.__lookup(
+            ctypes.cast(ctypes.pythonapi.Py_IsInitialized, ctypes.c_void_p)
+            .value
+            or 0
+        )
+        self.__interpreter = interpreter[1] if interpreter else ""
+        return True
+
+    def set_interval(self, interval: float) -> None:
+        """Sample every interval seconds of CPU time from now on."""
+        if self.__lib:
+            self.__lib.scalene_start_native_sampling(interval)
+
+    def stop(self) -> None:
+        if self.__lib:
+            self.__lib.scalene_stop_native_sampling()
+
+    def leaf(self, frames: Sequence[int]) -> Optional[NativeSymbol]:
+        """What a sampled stack (innermost first) is charged to, or None
+        if it was running the interpreter (or we can't tell)."""
+        if not frames:
+            return None
+        name = self.name(frames[0])
+        if not name or name[1] == self.__interpreter:
+            return None
+        return name
+
+    def name(self, address: int) -> Optional[NativeSymbol]:
+        if address not in self.__names:
+            self.__names[address] = self.__lookup(address)
+        return self.__names[address]
+
+    def __lookup(self, address: int) -> Optional[NativeSymbol]:
+        if not self.__lib:
+            return None
+        symbol = ctypes.c_char_p()
+        obj = ctypes.c_char_p()
+        if not self.__lib.scalene_symbolize(
+            address, ctypes.byref(symbol), ctypes.byref(obj)
+        ):
+            return None
+        return (
+            symbol.value.decode("utf-8", "replace")
+            if symbol.value
+            else "[unknown]",
+            os.path.basename(obj.value.decode("utf-8", "replace"))
+            if obj.value
+            else "?",
+        )
@@ -0,0 +1,143 @@
+import math
+from typing import Dict, List
+
+
+class OverheadController:
+    """Keeps the time spent in Scalene's handlers under a budget.
+
+    Handler time is added as it is spent. Once per window, we compare it
+    to the wall-clock time that passed, and stretch the sampling
+    intervals (by `scale`) when over budget, or shrink them back towards
+    the configured ones when comfortably under it."""
+
+    def __init__(
+        self, budget: float, window: float = 1.0, max_scale: float = 100.0
+    ) -> None:
+        # budget is a fraction of wall-clock time (0.02 == 2%)
+        self.budget = budget
+        self.window = window
+        self.max_scale = max_scale
+        self.scale = 1.0
+        self.overhead = 0.0
+        self.__handler_time = 0.0
+        self.__window_start = -1.0
+
+    def add(self, handler_time: float) -> None:
+        """Account for time spent in a handler."""
+        self.__handler_time += handler_time
+
+    def update(self, now: float) -> bool:
+        """Adjust the scale at the end of a window; true if it changed."""
+        if self.__window_start < 0:
+            self.__window_start = now
+            return False
+        elapsed = now - self.__window_start
+        if elapsed < self.window:
+            return False
+        self.overhead = self.__handler_time / elapsed
+        self.__handler_time = 0.0
+        self.__window_start = now
+        ratio = self.overhead / self.budget
+        if ratio > 1.0:
+            # Over budget: sample less often, by at most 4x at a time.
+            scale = self.scale * min(ratio, 4.0)
+        elif ratio < 0.5:
+            # Well under budget: sample more often, by at most 2x at a time.
+            scale = self.scale * max(ratio, 0.5)
+        else:
+            return False
+        scale = min(max(scale, 1.0), self.max_scale)
+        if scale == self.scale:
+            return False
+        self.scale = scale
+        return True
+
+
+def parse_percentage(value: str) -> float:
+    """Parse a command-line percentage ("2%" or "2") as a fraction."""
+    return float(value.rstrip("%")) / 100
+
+
+class HandlerTimer:
+    """Invocation count, total time and latency histogram for one kind of
+    work Scalene does on its own behalf."""
+
+    # Latencies are binned on a log scale from 1us, four bins per
+    # doubling: cheap to update, enough to estimate percentiles, and
+    # easy to merge across processes.
+    BINS_PER_DOUBLING = 4
+    NUM_BINS = 128
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        # times the work was skipped because a handler was already running
+        self.skipped = 0
+        self.histogram: List[int] = [0] * HandlerTimer.NUM_BINS
+
+    def add(self, elapsed: float) -> None:
+        """Account for one invocation that took elapsed seconds."""
+        self.count += 1
+        self.total += elapsed
+        microseconds = elapsed * 1e6
+        if microseconds <= 1:
+            index = 0
+        else:
+            index = min(
+                int(math.log2(microseconds) * HandlerTimer.BINS_PER_DOUBLING),
+                HandlerTimer.NUM_BINS - 1,
+            )
+        self.histogram[index] += 1
+
+    def skip(self) -> None:
+        """Account for an invocation that was skipped."""
+        self.skipped += 1
+
+    def percentile(self, fraction: float) -> float:
+        """An upper bound on the given percentile latency (in seconds)."""
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for index, n in enumerate(self.histogram):
+            seen += n
+            if n and seen >= rank:
+                return (
+                    2 ** ((index + 1) / HandlerTimer.BINS_PER_DOUBLING) / 1e6
+                )
+        return 0.0
+
+    def merge(self, other: "HandlerTimer") -> None:
+        self.count += other.count
+        self.total += other.total
+        self.skipped += other.skipped
+        for index, n in enumerate(other.histogram):
+            self.histogram[index] += n
+
+
+class OverheadStats:
+    """Timers for Scalene's handlers, and for the phases inside them."""
+
+    # Top-level work, which adds up to our overhead.
+    HANDLERS = ["CPU handler", "memory handler", "copy handler", "collector"]
+    # Work done at report time (merging child processes' profiles).
+    REPORTING = ["merging stats"]
+    # Parts of the handlers above.
+    PHASES = ["stack walks", "sample reads"]
+
+    def __init__(self) -> None:
+        self.timers: Dict[str, HandlerTimer] = {
+            name: HandlerTimer()
+            for name in self.HANDLERS + self.REPORTING + self.PHASES
+        }
+
+    def __getitem__(self, name: str) -> HandlerTimer:
+        return self.timers[name]
+
+    def total(self) -> float:
+        """Seconds spent in handlers and reporting."""
+        return sum(
+            self.timers[name].total for name in self.HANDLERS + self.REPORTING
+        )
+
+    def merge(self, other: "OverheadStats") -> None:
+        for name, timer in other.timers.items():
+            self.timers[name].merge(timer)
@@ -0,0 +1,349 @@
+"""scalene diff: compare two JSON profiles (see scalene/jsonprofile.py).
+
+Lines are matched by their file (relative to the profiled program's
+directory, when it's in there) and their offset from the start of the
+function they were sampled in, so edits elsewhere in the file that move
+them don't stop them from matching. Functions are matched by name (and,
+for functions with the same name in the same file, by order).
+
+Every change comes with a z-score: the change divided by its standard
+error, estimating each side's error from the number of samples behind
+it (a total from n samples is off by about total / sqrt(n)). A change
+is a regression if it is an increase of more than --threshold percent
+of the old profile's total for that metric, and its z-score is at
+least --min-z. We exit with status 1 if there are any regressions (2
+for errors), so CI can fail on them.
+
+Profiles merged by scalene merge hold sums over all their runs, so we
+compare them per run: we divide their values by their number of runs
+(but still estimate the error from all of their samples).
+"""
+import argparse
+import math
+import os
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from scalene.jsonprofile import read_profile
+
+CPU = "cpu"
+MEMORY = "memory"
+COPY = "copy"
+METRICS = (CPU, MEMORY, COPY)
+UNITS = {CPU: "s", MEMORY: "MB", COPY: "MB"}
+
+# Where in a Measures each metric's (value, gross, samples) go.
+FIELDS = 3
+INDEX = {metric: FIELDS * i for i, metric in enumerate(METRICS)}
+
+# value, gross (the total the error scales with), and samples for each
+# of the metrics
+Measures = List[float]
+# (file, function name or "", the function's number among those with
+# its name in the file, line offset from the function's first line (or
+# the line itself, outside functions))
+LineKey = Tuple[str, str, int, int]
+FunctionKey = Tuple[str, str, int]
+
+MB = 1024 * 1024
+
+
+def zeros() -> Measures:
+    return [0.0] * (FIELDS * len(METRICS))
+
+
+def line_measures(line: Dict[str, Any], metadata: Dict[str, Any]) -> Measures:
+    """The CPU time, net allocation and copy volume of a line, per run."""
+    measures = zeros()
+    cpu = line["python_s"] + line["native_s"]
+    samples = line["utilization"]["samples"] or (
+        cpu / metadata["cpu_sampling_rate_s"]
+    )
+    measures[INDEX[CPU] : INDEX[CPU] + FIELDS] = [cpu, cpu, samples]
+    measures[INDEX[MEMORY] : INDEX[MEMORY] + FIELDS] = [
+        line["malloc_mb"] - line["free_mb"],
+        line["malloc_mb"] + line["free_mb"],
+        line["malloc_count"] + line["free_count"],
+    ]
+    copy = line["copy_bytes"]
+    measures[INDEX[COPY] : INDEX[COPY] + FIELDS] = [
+        copy / MB,
+        copy / MB,
+        copy / metadata["memcpy_sampling_rate_bytes"],
+    ]
+    per_run(measures, metadata)
+    return measures
+
+
+def per_run(measures: Measures, metadata: Dict[str, Any]) -> None:
+    """Divide the values and grosses of a merged profile's measures by
+    its number of runs."""
+    runs = metadata.get("runs", 1)
+    for i in range(0, len(measures), FIELDS):
+        measures[i] /= runs
+        measures[i + 1] /= runs
+
+
+def add(total: Measures, measures: Measures) -> None:
+    for i, v in enumerate(measures):
+        total[i] += v
+
+
+def relative_name(fname: str, metadata: Dict[str, Any]) -> str:
+    """fname relative to the profiled program's directory, if it's in
+    there (so profiles of copies of a program in different places
+    match)."""
+    program_dir = os.path.dirname(os.path.abspath(metadata["program"]))
+    if os.path.abspath(fname).startswith(program_dir + os.sep):
+        return os.path.relpath(fname, program_dir)
+    return fname
+
+
+class Profile:
+    """The measures of a profile's lines and functions, by key."""
+
+    def __init__(self, path: str) -> None:
+        metadata, files = read_profile(path)
+        self.metadata = metadata
+        self.lines: Dict[LineKey, Measures] = {}
+        self.functions: Dict[FunctionKey, Measures] = {}
+        self.first_lines: Dict[FunctionKey, int] = {}
+        self.totals = zeros()
+        for profile in files:
+            self.add_file(profile)
+        # Regressions are relative to the whole program's CPU time and
+        # allocation, not just what was in the files we report.
+        runs = metadata.get("runs", 1)
+        self.totals[INDEX[CPU]] = metadata["total_cpu_s"] / runs
+        self.totals[INDEX[MEMORY] + 1] = (
+            metadata["total_malloc_mb"] + metadata["total_free_mb"]
+        ) / runs
+
+    def add_file(self, profile: Dict[str, Any]) -> None:
+        fname = relative_name(profile["filename"], self.metadata)
+        # Number the functions with the same name in the file in order.
+        ordinals: Dict[Tuple[str, int], int] = {}
+        seen: Dict[str, int] = {}
+        for function in sorted(
+            profile["functions"], key=lambda f: f["first_line"]
+        ):
+            name = function["name"]
+            ordinals[(name, function["first_line"])] = seen.get(name, 0)
+            seen[name] = seen.get(name, 0) + 1
+        for line in profile["lines"]:
+            measures = line_measures(line, self.metadata)
+            if line["function"]:
+                name, first_line = line["function"]
+                ordinal = ordinals.get((name, first_line), 0)
+                function_key = (fname, name, ordinal)
+                key = (fname, name, ordinal, line["lineno"] - first_line)
+                self.first_lines[function_key] = first_line
+                add(self.functions.setdefault(function_key, zeros()), measures)
+            else:
+                key = (fname, "", 0, line["lineno"])
+            add(self.lines.setdefault(key, zeros()), measures)
+            add(self.totals, measures)
+
+
+class Change:
+    def __init__(
+        self, where: str, metric: str, old: Measures, new: Measures
+    ) -> None:
+        i = INDEX[metric]
+        self.where = where
+        self.metric = metric
+        self.old = old[i]
+        self.new = new[i]
+        self.delta = self.new - self.old
+        self.z = z_score(old[i : i + FIELDS], new[i : i + FIELDS])
+
+
+def standard_error(gross: float, samples: float) -> float:
+    return gross / math.sqrt(samples) if samples > 0 else gross
+
+
+def z_score(old: Measures, new: Measures) -> float:
+    """How many standard errors apart old and new (value, gross,
+    samples) are."""
+    delta = new[0] - old[0]
+    error = math.hypot(
+        standard_error(old[1], old[2]), standard_error(new[1], new[2])
+    )
+    if error > 0:
+        return delta / error
+    return 0.0 if delta == 0 else math.copysign(math.inf, delta)
+
+
+def line_name(key: LineKey, first_lines: Dict[FunctionKey, int]) -> str:
+    fname, function, ordinal, offset = key
+    if not function:
+        return "%s:%d" % (fname, offset)
+    first_line = first_lines.get((fname, function, ordinal))
+    return "%s:%s (%s+%d)" % (
+        fname,
+        first_line + offset if first_line is not None else "?",
+        function,
+        offset,
+    )
+
+
+def function_name(key: FunctionKey) -> str:
+    fname, function, ordinal = key
+    return "%s:%s%s" % (fname, function, "#%d" % ordinal if ordinal else "")
+
+
+def changes(
+    old: Dict[Any, Measures],
+    new: Dict[Any, Measures],
+    name: Any,
+    metrics: Iterable[str],
+) -> List[Change]:
+    result = []
+    for key in set(old) | set(new):
+        for metric in metrics:
+            change = Change(
+                name(key), metric, old.get(key, zeros()), new.get(key, zeros())
+            )
+            if change.delta:
+                result.append(change)
+    return result
+
+
+def format_value(metric: str, value: float) -> str:
+    return "%.3f%s" % (value, UNITS[metric])
+
+
+def print_changes(title: str, found: List[Change], top: int) -> None:
+    if not found:
+        return
+    print(title)
+    print(
+        "  %-7s %12s %12s %12s %7s  %s"
+        % ("metric", "old", "new", "change", "z", "where")
+    )
+    for change in sorted(found, key=lambda c: -abs(c.delta))[:top]:
+        print(
+            "  %-7s %12s %12s %12s %7.1f  %s"
+            % (
+                change.metric,
+                format_value(change.metric, change.old),
+                format_value(change.metric, change.new),
+                ("+" if change.delta > 0 else "")
+                + format_value(change.metric, change.delta),
+                change.z,
+                change.where,
+            )
+        )
+    print()
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="scalene diff",
+        description="Compare two Scalene JSON profiles (from --json), "
+        "line by line and function by function. Exits with status 1 if "
+        "anything got significantly worse by more than the threshold.",
+    )
+    parser.add_argument("old", help="the baseline profile")
+    parser.add_argument("new", help="the profile to compare with it")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=5.0,
+        metavar="PERCENT",
+        help="report an increase as a regression if it is more than PERCENT of the old profile's total for its metric (default: 5)",
+    )
+    parser.add_argument(
+        "--min-z",
+        dest="min_z",
+        type=float,
+        default=2.0,
+        help="only count increases at least this many standard errors big as regressions (default: 2)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=",".join(METRICS),
+        help="comma-separated metrics to compare: cpu, memory, copy (default: all)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="how many of the largest line and function changes to show (default: 20)",
+    )
+    args = parser.parse_args(argv)
+    metrics = [m.strip() for m in args.metrics.split(",") if m.strip()]
+    for metric in metrics:
+        if metric not in METRICS:
+            parser.error("unknown metric %r" % metric)
+    args.metrics = metrics
+    return args
+
+
+def regressions(
+    found: List[Change], totals: Measures, threshold: float, min_z: float
+) -> List[Change]:
+    result = []
+    for change in found:
+        i = INDEX[change.metric]
+        # Net allocation can't be a share of net allocation (it might
+        # be zero): we measure it against all allocation and frees.
+        total = totals[i + 1] if change.metric == MEMORY else totals[i]
+        if (
+            change.delta > threshold / 100 * total
+            and change.z >= min_z
+        ):
+            result.append(change)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        old = Profile(args.old)
+        new = Profile(args.new)
+    except (OSError, ValueError, KeyError) as e:
+        print("scalene diff: %s" % e, file=sys.stderr)
+        return 2
+    print("Scalene profile diff: %s -> %s" % (args.old, args.new))
+    for metric in args.metrics:
+        i = INDEX[metric]
+        print(
+            "  %-7s %s -> %s"
+            % (
+                metric,
+                format_value(metric, old.totals[i]),
+                format_value(metric, new.totals[i]),
+            )
+        )
+    print()
+    first_lines = dict(old.first_lines)
+    first_lines.update(new.first_lines)
+    function_changes = changes(
+        old.functions, new.functions, function_name, args.metrics
+    )
+    line_changes = changes(
+        old.lines,
+        new.lines,
+        lambda key: line_name(key, first_lines),
+        args.metrics,
+    )
+    print_changes("Functions:", function_changes, args.top)
+    print_changes("Lines:", line_changes, args.top)
+    found = regressions(
+        function_changes + line_changes,
+        old.totals,
+        args.threshold,
+        args.min_z,
+    )
+    if found:
+        print_changes(
+            "Regressions (over %g%% of the old total, z >= %g):"
+            % (args.threshold, args.min_z),
+            found,
+            len(found),
+        )
+        return 1
+    print("No regressions.")
+    return 0
@@ -0,0 +1,428 @@
+"""scalene merge: combine JSON profiles (see scalene/jsonprofile.py) of
+many runs of a program (on one machine or many) into one.
+
+Each worker in a process pool merges a share of the profiles, reading
+each one a file at a time; we merge the workers' results as they come
+in, and write the merged profile out a file at a time. Counters are
+summed. For each line we also keep how many runs it had samples in
+(runs), and the mean and variance across runs of its CPU time, net
+allocation and copy volume (across_runs; a run without samples on the
+line counts as 0), so lines whose cost varies a lot from run to run
+stand out. Source files are named relative to the profiled program's
+directory, so runs from different checkouts line up.
+
+Footprint timelines of separate runs can't be added up, so the merged
+profile has none.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from scalene.jsonprofile import ProfileWriter, read_profile
+from scalene.profilediff import relative_name
+
+# Per-line counters we add up, in order.
+SUMMED = (
+    "python_s",
+    "native_s",
+    "malloc_mb",
+    "python_malloc_mb",
+    "free_mb",
+    "malloc_count",
+    "free_count",
+    "copy_bytes",
+    "leak_score",
+)
+# Per-offset counters we add up, in order.
+BYTECODE_SUMMED = (
+    "malloc_mb",
+    "python_malloc_mb",
+    "free_mb",
+    "malloc_count",
+    "free_count",
+)
+# Per-function counters we add up, in order.
+FUNCTION_SUMMED = ("python_s", "native_s", "net_mb", "copy_bytes")
+# What we keep the variance across runs of.
+ACROSS_RUNS = ("cpu_s", "net_mb", "copy_bytes")
+# Metadata we add up, and that we take the largest of.
+METADATA_SUMMED = (
+    "elapsed_s",
+    "total_cpu_s",
+    "total_malloc_mb",
+    "total_free_mb",
+)
+METADATA_MAX = ("max_footprint_mb",)
+# Metadata that should be the same in every run (we keep the first).
+METADATA_SAME = (
+    "python",
+    "platform",
+    "cpu_sampling_rate_s",
+    "malloc_sampling_rate_bytes",
+    "memcpy_sampling_rate_bytes",
+)
+
+
+def across_runs(line: Dict[str, Any]) -> List[float]:
+    return [
+        line["python_s"] + line["native_s"],
+        line["malloc_mb"] - line["free_mb"],
+        line["copy_bytes"],
+    ]
+
+
+def combine_stats(
+    a: Tuple[float, float, float], b: Tuple[float, float, float]
+) -> Tuple[float, float, float]:
+    """Combine two (count, mean, sum of squared deviations) summaries
+    (Chan et al.)."""
+    n = a[0] + b[0]
+    if not n:
+        return (0, 0.0, 0.0)
+    delta = b[1] - a[1]
+    return (
+        n,
+        a[1] + delta * b[0] / n,
+        a[2] + b[2] + delta * delta * a[0] * b[0] / n,
+    )
+
+
+class LineTotals:
+    def __init__(self) -> None:
+        self.function: Optional[List[Any]] = None
+        self.runs = 0
+        self.sums = [0.0] * len(SUMMED)
+        # Sums, and sums of squares, of each run's ACROSS_RUNS.
+        self.run_sums = [0.0] * len(ACROSS_RUNS)
+        self.run_squares = [0.0] * len(ACROSS_RUNS)
+        # (count, mean, sum of squared deviations) of utilization
+        self.utilization: Tuple[float, float, float] = (0, 0.0, 0.0)
+        self.bytecode: Dict[int, List[float]] = {}
+        self.native_symbols: Dict[Tuple[str, str], int] = {}
+
+    def add(self, line: Dict[str, Any], runs: int) -> None:
+        """Add a run's line (or a line merged from runs runs)."""
+        if self.function is None:
+            self.function = line["function"]
+        for i, key in enumerate(SUMMED):
+            self.sums[i] += line[key]
+        if "across_runs" in line:
+            for i, key in enumerate(ACROSS_RUNS):
+                stats = line["across_runs"][key]
+                total = stats["mean"] * runs
+                self.run_sums[i] += total
+                self.run_squares[i] += (
+                    stats["variance"] * (runs - 1) + total * stats["mean"]
+                )
+            self.runs += line["runs"]
+        else:
+            for i, v in enumerate(across_runs(line)):
+                self.run_sums[i] += v
+                self.run_squares[i] += v * v
+            self.runs += 1
+        utilization = line["utilization"]
+        n = utilization["samples"]
+        # sem = sqrt(variance / n)
+        m2 = utilization["sem"] ** 2 * n * (n - 1) if n > 1 else 0.0
+        self.utilization = combine_stats(
+            self.utilization, (n, utilization["mean"], m2)
+        )
+        for offset in line["bytecode"]:
+            sums = self.bytecode.setdefault(
+                offset["offset"], [0.0] * len(BYTECODE_SUMMED)
+            )
+            for i, key in enumerate(BYTECODE_SUMMED):
+                sums[i] += offset[key]
+        for symbol in line["native_symbols"]:
+            symbol_key = (symbol["symbol"], symbol["object"])
+            self.native_symbols[symbol_key] = (
+                self.native_symbols.get(symbol_key, 0) + symbol["samples"]
+            )
+
+    def merge(self, other: "LineTotals") -> None:
+        if self.function is None:
+            self.function = other.function
+        self.runs += other.runs
+        for totals, theirs in [
+            (self.sums, other.sums),
+            (self.run_sums, other.run_sums),
+            (self.run_squares, other.run_squares),
+        ]:
+            for i, v in enumerate(theirs):
+                totals[i] += v
+        self.utilization = combine_stats(self.utilization, other.utilization)
+        for offset, theirs in other.bytecode.items():
+            sums = self.bytecode.setdefault(
+                offset, [0.0] * len(BYTECODE_SUMMED)
+            )
+            for i, v in enumerate(theirs):
+                sums[i] += v
+        for key, count in other.native_symbols.items():
+            self.native_symbols[key] = self.native_symbols.get(key, 0) + count
+
+    def profile(self, lineno: int, runs: int) -> Dict[str, Any]:
+        """The merged line, from runs runs in all."""
+        n, mean, m2 = self.utilization
+        line: Dict[str, Any] = {"lineno": lineno, "function": self.function}
+        line.update(zip(SUMMED, self.sums))
+        line["utilization"] = {
+            "samples": n,
+            "mean": mean,
+            "sem": (m2 / (n - 1) / n) ** 0.5 if n > 1 else 0.0,
+        }
+        line["footprint"] = []
+        line["bytecode"] = [
+            dict(offset=offset, **dict(zip(BYTECODE_SUMMED, sums)))
+            for (offset, sums) in sorted(self.bytecode.items())
+        ]
+        line["native_symbols"] = [
+            {"symbol": symbol, "object": obj, "samples": count}
+            for ((symbol, obj), count) in sorted(
+                self.native_symbols.items(), key=lambda item: -item[1]
+            )
+        ]
+        line["runs"] = self.runs
+        line["across_runs"] = {}
+        for key, total, squares in zip(
+            ACROSS_RUNS, self.run_sums, self.run_squares
+        ):
+            mean = total / runs
+            line["across_runs"][key] = {
+                "mean": mean,
+                "variance": max(0.0, (squares - total * mean) / (runs - 1))
+                if runs > 1
+                else 0.0,
+            }
+        return line
+
+
+class FileTotals:
+    def __init__(self) -> None:
+        self.cpu_s = 0.0
+        self.malloc_samples = 0.0
+        self.functions: Dict[Tuple[str, int], List[float]] = {}
+        self.lines: Dict[int, LineTotals] = {}
+
+    def add(self, profile: Dict[str, Any], runs: int) -> None:
+        """Add a run's profile of this file (or one merged from runs
+        runs)."""
+        self.cpu_s += profile["cpu_s"]
+        self.malloc_samples += profile["malloc_samples"]
+        for function in profile["functions"]:
+            sums = self.functions.setdefault(
+                (function["name"], function["first_line"]),
+                [0.0] * len(FUNCTION_SUMMED),
+            )
+            for i, key in enumerate(FUNCTION_SUMMED):
+                sums[i] += function[key]
+        for line in profile["lines"]:
+            self.lines.setdefault(line["lineno"], LineTotals()).add(
+                line, runs
+            )
+
+    def merge(self, other: "FileTotals") -> None:
+        self.cpu_s += other.cpu_s
+        self.malloc_samples += other.malloc_samples
+        for function, theirs in other.functions.items():
+            sums = self.functions.setdefault(
+                function, [0.0] * len(FUNCTION_SUMMED)
+            )
+            for i, v in enumerate(theirs):
+                sums[i] += v
+        for lineno, line in other.lines.items():
+            if lineno in self.lines:
+                self.lines[lineno].merge(line)
+            else:
+                self.lines[lineno] = line
+
+    def profile(self, fname: str, runs: int) -> Dict[str, Any]:
+        return {
+            "filename": fname,
+            "cpu_s": self.cpu_s,
+            "malloc_samples": self.malloc_samples,
+            "functions": [
+                dict(
+                    name=name,
+                    first_line=first_line,
+                    **dict(zip(FUNCTION_SUMMED, sums))
+                )
+                for ((name, first_line), sums) in sorted(
+                    self.functions.items()
+                )
+            ],
+            "lines": [
+                line.profile(lineno, runs)
+                for (lineno, line) in sorted(self.lines.items())
+            ],
+        }
+
+
+class MergedProfile:
+    def __init__(self) -> None:
+        self.runs = 0
+        self.metadata: Dict[str, Any] = {}
+        self.sources: List[Dict[str, Any]] = []
+        self.files: Dict[str, FileTotals] = {}
+        self.warnings: List[str] = []
+
+    def add(self, path: str) -> None:
+        """Add the profile in path (read a file at a time), which may
+        itself be a merged profile."""
+        metadata, files = read_profile(path)
+        if "sources" in metadata:
+            self.sources += metadata["sources"]
+        else:
+            self.sources.append(
+                {
+                    "path": path,
+                    "program": metadata["program"],
+                    "pid": metadata["pid"],
+                    "children": metadata["children"],
+                    "elapsed_s": metadata["elapsed_s"],
+                }
+            )
+        self.combine(path, metadata)
+        runs = metadata.get("runs", 1)
+        for profile in files:
+            fname = relative_name(profile["filename"], metadata)
+            self.files.setdefault(fname, FileTotals()).add(profile, runs)
+        self.runs += runs
+
+    def combine(self, path: str, metadata: Dict[str, Any]) -> None:
+        """Combine metadata (from path) with ours."""
+        mine = self.metadata
+        if not mine:
+            mine.update(
+                (key, metadata[key])
+                for key in METADATA_SUMMED + METADATA_MAX + METADATA_SAME
+            )
+            mine["program"] = os.path.basename(metadata["program"])
+            mine["argv"] = metadata["argv"]
+            mine["memory_profiled"] = metadata["memory_profiled"]
+            mine["samples"] = dict(metadata["samples"])
+            mine["overhead"] = {
+                name: dict(timer)
+                for (name, timer) in metadata["overhead"].items()
+            }
+            return
+        for key in METADATA_SUMMED:
+            mine[key] += metadata[key]
+        for key in METADATA_MAX:
+            mine[key] = max(mine[key], metadata[key])
+        for key in METADATA_SAME:
+            if mine[key] != metadata[key]:
+                self.warnings.append(
+                    "%s: %s is %s, not %s as in the other profiles"
+                    % (path, key, metadata[key], mine[key])
+                )
+        mine["memory_profiled"] = (
+            mine["memory_profiled"] or metadata["memory_profiled"]
+        )
+        for key, v in metadata["samples"].items():
+            mine["samples"][key] = mine["samples"].get(key, 0) + v
+        for name, timer in metadata["overhead"].items():
+            totals = mine["overhead"].setdefault(
+                name, {"count": 0, "total_s": 0.0}
+            )
+            totals["count"] += timer["count"]
+            totals["total_s"] += timer["total_s"]
+
+    def merge(self, other: "MergedProfile") -> None:
+        if not other.runs:
+            return
+        if not self.runs:
+            self.__dict__.update(other.__dict__)
+            return
+        self.combine(other.sources[0]["path"], other.metadata)
+        self.sources += other.sources
+        self.warnings += other.warnings
+        self.runs += other.runs
+        for fname, totals in other.files.items():
+            if fname in self.files:
+                self.files[fname].merge(totals)
+            else:
+                self.files[fname] = totals
+
+    def write(self, out: Any) -> None:
+        metadata = dict(self.metadata)
+        metadata["runs"] = self.runs
+        metadata["sources"] = sorted(
+            self.sources, key=lambda source: source["path"]
+        )
+        metadata["pid"] = None
+        metadata["children"] = sorted(
+            pid
+            for source in self.sources
+            for pid in [source["pid"]] + source["children"]
+            if pid is not None
+        )
+        metadata["footprint"] = []
+        writer = ProfileWriter(out, metadata)
+        for fname, totals in sorted(
+            self.files.items(), key=lambda item: (-item[1].cpu_s, item[0])
+        ):
+            writer.add_file(totals.profile(fname, self.runs))
+        writer.close()
+
+
+def merge_group(paths: List[str]) -> MergedProfile:
+    """Merge one worker's share of the profiles."""
+    merged = MergedProfile()
+    for path in paths:
+        merged.add(path)
+    return merged
+
+
+def merge_profiles(paths: List[str], jobs: int) -> MergedProfile:
+    jobs = max(1, min(jobs, len(paths)))
+    groups = [paths[i::jobs] for i in range(jobs)]
+    if jobs == 1:
+        return merge_group(paths)
+    merged = MergedProfile()
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap_unordered(merge_group, groups):
+            merged.merge(result)
+    return merged
+
+
+def parse_args(argv: Iterable[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="scalene merge",
+        description="Merge Scalene JSON profiles (from --json) of many "
+        "runs into one, keeping how much each line varies across runs.",
+    )
+    parser.add_argument("profiles", nargs="+", help="the profiles to merge")
+    parser.add_argument(
+        "--outfile",
+        "-o",
+        type=str,
+        default=None,
+        help="file to hold the merged profile (default: stdout)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="how many processes to read profiles with (default: one per CPU)",
+    )
+    return parser.parse_args(list(argv))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        merged = merge_profiles(args.profiles, args.jobs)
+    except (OSError, ValueError, KeyError) as e:
+        print("scalene merge: %s" % e, file=sys.stderr)
+        return 2
+    for warning in merged.warnings:
+        print("scalene merge: warning: %s" % warning, file=sys.stderr)
+    if args.outfile:
+        with open(args.outfile, "w") as out:
+            merged.write(out)
+    else:
+        merged.write(sys.stdout)
+    return 0
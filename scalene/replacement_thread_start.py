@@ -0,0 +1,15 @@
+from scalene.scalene_profiler import Scalene
+import threading
+
+
+@Scalene.shim
+def replacement_thread_start(scalene: Scalene):
+    orig_thread_start = threading.Thread.start
+
+    def thread_start_replacement(self: threading.Thread) -> None:
+        """We replace threading.Thread.start with this method, which
+        tells Scalene about the thread once it has an identifier."""
+        orig_thread_start(self)
+        scalene.register_thread(self)
+
+    threading.Thread.start = thread_start_replacement
@@ -0,0 +1,225 @@
+"""Reads the sample files that libscalene writes (see include/samplefile.hpp).
+
+Each signal file is paired with a lock file whose first bytes hold a
+header (magic number, format version, record size, ring capacity, the
+head/tail cursors, counts of dropped records and raised signals, and
+the sampling rate we ask libscalene to use). The signal file is a ring of
+fixed-width records: libscalene's threads reserve slots by advancing the
+head, and publish each record by writing its sequence number (its
+position in the ring, plus one) last. We decode the new records in a
+single pass with struct.iter_unpack over a memoryview of the mapping,
+keep the ones that have been published, and advance the tail past them.
+"""
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Callable, List, Optional, Tuple
+
+# Things that need to be in sync with include/samplefile.hpp:
+#
+#   the lock file header (SampleFileHeader)
+SAMPLEFILE_MAGIC = 0x4E4C4353  # "SCLN"
+SAMPLEFILE_VERSION = 6
+header_struct = struct.Struct("=IIIIQQQQQ")
+# the tail cursor, which we advance after reading, and the sampling rate
+tail_struct = struct.Struct("=Q")
+TAIL_OFFSET = 24
+SAMPLING_RATE_OFFSET = 48
+
+# ...with include/sampleheap.hpp (AllocationRecord):
+#   action (b"M" or b"F"), sequence number, byte count,
+#   python fraction, allocating thread id, and where that thread was:
+#   the address of its code object (0 if unknown), line, and bytecode
+#   offset (-1 if unknown)
+allocation_record = struct.Struct("=c7xQQdQQii")
+ALLOCATION_SEQUENCE_FIELD = 1
+
+# ...with include/memcpysampler.hpp (MemcpyRecord):
+#   sequence number, byte count
+memcpy_record = struct.Struct("=QQ")
+MEMCPY_SEQUENCE_FIELD = 0
+
+# ...and with include/nativesampler.hpp (NativeRecord):
+#   sequence number, sampled thread id, stack depth, and that many
+#   return addresses (innermost first) out of NATIVE_STACK_DEPTH slots
+NATIVE_STACK_DEPTH = 16
+native_record = struct.Struct("=QQQ%dQ" % NATIVE_STACK_DEPTH)
+NATIVE_SEQUENCE_FIELD = 0
+
+
+def parse_legacy_allocation(
+    line: str,
+) -> Tuple[bytes, int, int, float, int, int, int, int]:
+    """Parse a text record ("M,123,1048576,0.53") from an older libscalene."""
+    action, sequence, count, python_fraction = line.split(",")
+    return (
+        action.encode("ascii"),
+        int(sequence),
+        int(count),
+        float(python_fraction),
+        0,
+        0,
+        0,
+        -1,
+    )
+
+
+def parse_legacy_memcpy(line: str) -> Tuple[int, int]:
+    """Parse a text record ("123,2097152") from an older libscalene."""
+    sequence, count = line.split(",")
+    return (int(sequence), int(count))
+
+
+class SampleFile:
+    """Consumes the records libscalene writes to a signal file's ring."""
+
+    def __init__(
+        self,
+        name: str,
+        record: struct.Struct,
+        sequence_field: int,
+        legacy_parser: Optional[Callable[[str], Tuple[Any, ...]]] = None,
+    ) -> None:
+        pid = os.getpid()
+        self.__signal_filename = "/tmp/scalene-%s-signal%d" % (name, pid)
+        self.__lock_filename = "/tmp/scalene-%s-lock%d" % (name, pid)
+        self.__record = record
+        self.__sequence_field = sequence_field
+        self.__legacy_parser = legacy_parser
+        self.__signal_mmap: Optional[mmap.mmap] = None
+        self.__lock_mmap: Optional[mmap.mmap] = None
+        # Offset of the first record we have not read yet (legacy text only).
+        self.__position = 0
+        self.__warned = False
+
+    def __open(self) -> bool:
+        """Map the signal and lock files, if libscalene created them."""
+        if self.__signal_mmap and self.__lock_mmap:
+            return True
+        try:
+            with open(self.__signal_filename, "rb") as signal_file:
+                self.__signal_mmap = mmap.mmap(
+                    signal_file.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ
+                )
+            with open(self.__lock_filename, "r+b") as lock_file:
+                self.__lock_mmap = mmap.mmap(
+                    lock_file.fileno(),
+                    0,
+                    mmap.MAP_SHARED,
+                    mmap.PROT_READ | mmap.PROT_WRITE,
+                )
+        except (OSError, ValueError):
+            # Not there (yet): we aren't profiling memory.
+            return False
+        return True
+
+    def read(self) -> List[Tuple[Any, ...]]:
+        """Return every record written since the last call."""
+        if not self.__open():
+            return []
+        assert self.__signal_mmap and self.__lock_mmap
+        (
+            magic,
+            version,
+            record_size,
+            capacity,
+            head,
+            tail,
+            _overflows,
+            _signals,
+            _sampling_rate,
+        ) = header_struct.unpack_from(self.__lock_mmap, 0)
+        if magic != SAMPLEFILE_MAGIC:
+            # An older libscalene, which writes comma-separated text
+            # (if it writes these samples at all).
+            return self.__read_legacy() if self.__legacy_parser else []
+        if version != SAMPLEFILE_VERSION or record_size != self.__record.size:
+            if not self.__warned:
+                print(
+                    "Scalene warning: libscalene sample format version %d "
+                    "(record size %d) does not match the expected version %d "
+                    "(record size %d); ignoring these samples."
+                    % (
+                        version,
+                        record_size,
+                        SAMPLEFILE_VERSION,
+                        self.__record.size,
+                    ),
+                    file=sys.stderr,
+                )
+                self.__warned = True
+            return []
+        if head == tail:
+            return []
+        # The new records may wrap around the end of the ring.
+        size = self.__record.size
+        start = tail % capacity
+        count = head - tail
+        first = min(count, capacity - start)
+        with memoryview(self.__signal_mmap) as view:
+            chunk = view[start * size : (start + first) * size]
+            records = list(self.__record.iter_unpack(chunk))
+            chunk.release()
+            if count > first:
+                chunk = view[0 : (count - first) * size]
+                records += self.__record.iter_unpack(chunk)
+                chunk.release()
+        # Stop at the first slot that has been reserved but not yet
+        # published; we will pick it up next time.
+        field = self.__sequence_field
+        for i, record in enumerate(records):
+            if record[field] != tail + i + 1:
+                del records[i:]
+                break
+        # Hand the slots back to the writers.
+        tail_struct.pack_into(
+            self.__lock_mmap, TAIL_OFFSET, tail + len(records)
+        )
+        return records
+
+    def counters(self) -> Tuple[int, int, int]:
+        """How many records libscalene has written, how many signals it
+        raised to announce them, and how many records it dropped because
+        the ring was full."""
+        if not self.__open():
+            return (0, 0, 0)
+        assert self.__lock_mmap
+        (
+            magic,
+            version,
+            _record_size,
+            _capacity,
+            head,
+            _tail,
+            overflows,
+            signals,
+            _sampling_rate,
+        ) = header_struct.unpack_from(self.__lock_mmap, 0)
+        if magic != SAMPLEFILE_MAGIC or version != SAMPLEFILE_VERSION:
+            return (0, 0, 0)
+        return (int(head), int(signals), int(overflows))
+
+    def set_sampling_rate(self, rate: int) -> None:
+        """Ask libscalene to sample every rate bytes from now on."""
+        if not self.__open():
+            return
+        assert self.__lock_mmap
+        magic, version, *_rest = header_struct.unpack_from(self.__lock_mmap, 0)
+        if magic != SAMPLEFILE_MAGIC or version != SAMPLEFILE_VERSION:
+            return
+        tail_struct.pack_into(self.__lock_mmap, SAMPLING_RATE_OFFSET, rate)
+
+    def __read_legacy(self) -> List[Tuple[Any, ...]]:
+        """Parse newline-separated text records."""
+        assert self.__signal_mmap and self.__legacy_parser
+        records: List[Tuple[Any, ...]] = []
+        mm = self.__signal_mmap
+        mm.seek(self.__position)
+        while True:
+            line = mm.readline().rstrip().decode("ascii")
+            if line == "":
+                break
+            records.append(self.__legacy_parser(line))
+        self.__position = mm.tell() - 1
+        return records
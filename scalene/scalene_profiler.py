@@ -14,10 +14,11 @@ import argparse
 import atexit
 import builtins
 import cloudpickle
+import ctypes
 import dis
+import fnmatch
 import functools
 import inspect
-import mmap
 import multiprocessing
 import os
 import pathlib
@@ -25,6 +26,7 @@ import pickle
 import platform
 import random
 import selectors
+import shlex
 import shutil
 import signal
 import stat
@@ -35,6 +37,7 @@ import tempfile
 import threading
 import time
 import traceback
+import weakref
 from collections import defaultdict
 from functools import lru_cache, wraps
 from rich.console import Console
@@ -63,8 +66,38 @@ from typing import (
 from multiprocessing.process import BaseProcess
 
 from scalene.adaptive import Adaptive
+from scalene.footprint import extremes, running_footprint
+from scalene.functionstats import (
+    COPY_VOLUME,
+    NATIVE_TIME,
+    NET_MEMORY,
+    PYTHON_TIME,
+    FunctionStats,
+)
+from scalene.jsonprofile import ProfileWriter
+from scalene.lineranges import LineRanges, code_lines
+from scalene.linestats import ByteCodeColumn, FileIds, LineColumn
+from scalene.overhead import (
+    OverheadController,
+    OverheadStats,
+    parse_percentage,
+)
 from scalene.runningstats import RunningStats
+from scalene.nativesymbols import NativeSymbol, NativeSymbols
+from scalene.stacks import CPU, MALLOC, MAX_DEPTH, Frame, StackTable
+from scalene.samplefile import (
+    ALLOCATION_SEQUENCE_FIELD,
+    MEMCPY_SEQUENCE_FIELD,
+    NATIVE_SEQUENCE_FIELD,
+    SampleFile,
+    allocation_record,
+    memcpy_record,
+    native_record,
+    parse_legacy_allocation,
+    parse_legacy_memcpy,
+)
 from scalene.syntaxline import SyntaxLine
+from scalene.threadclocks import ThreadClocks
 from scalene import sparkline
 
 Filename = NewType("Filename", str)
@@ -104,20 +137,27 @@ class Scalene:
     # Support for @profile
     # decorated files
     __files_to_profile: Dict[Filename, bool] = defaultdict(bool)
-    # decorated functions
-    __functions_to_profile: Dict[Filename, Dict[Any, bool]] = defaultdict(
-        lambda: {}
-    )
+    # the lines of the decorated functions in each of those files
+    __lines_to_profile: Dict[Filename, LineRanges] = defaultdict(LineRanges)
+    # Per-code-object caches, by id(); entries are dropped when the
+    # code object goes away (see remember_code):
+    #   should_trace's decision for each code object we have walked past
+    __code_traced: Dict[int, bool] = {}
+    #   a bitmap of the instructions that are calls (see is_call_function)
+    __code_calls: Dict[int, bytes] = {}
+    __code_refs: Dict[int, "weakref.ReferenceType[CodeType]"] = {}
 
     # We use these in is_call_function to determine whether a
     # particular bytecode is a function call.  We use this to
     # distinguish between Python and native code execution when
-    # running in threads.
+    # running in threads.  (CALL_FUNCTION* up to 3.10, CALL_METHOD
+    # from 3.7 to 3.10, PRECALL and CALL in 3.11, CALL and CALL_KW after.)
     __call_opcodes: FrozenSet[int] = frozenset(
         {
             dis.opmap[op_name]
             for op_name in dis.opmap
             if op_name.startswith("CALL_FUNCTION")
+            or op_name in ("CALL_METHOD", "PRECALL", "CALL", "CALL_KW")
         }
     )
 
@@ -145,17 +185,16 @@ class Scalene:
 
     # Statistics counters:
     #
+    #   the files they cover
+    __files = FileIds()
+
     #   CPU samples for each location in the program
     #   spent in the interpreter
-    __cpu_samples_python: Dict[
-        Filename, Dict[LineNumber, float]
-    ] = defaultdict(lambda: defaultdict(float))
+    __cpu_samples_python = LineColumn(__files)
 
     #   CPU samples for each location in the program
     #   spent in C / libraries / system calls
-    __cpu_samples_c: Dict[Filename, Dict[LineNumber, float]] = defaultdict(
-        lambda: defaultdict(float)
-    )
+    __cpu_samples_c = LineColumn(__files)
 
     # Running stats for the fraction of time running on the CPU.
     __cpu_utilization: Dict[
@@ -169,39 +208,30 @@ class Scalene:
     __malloc_samples: Dict[Filename, float] = defaultdict(float)
 
     # malloc samples for each location in the program
-    __memory_malloc_samples: Dict[
-        Filename, Dict[LineNumber, Dict[ByteCodeIndex, float]]
-    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+    __memory_malloc_samples = ByteCodeColumn(__files)
 
     # number of times samples were added for the above
-    __memory_malloc_count: Dict[
-        Filename, Dict[LineNumber, Dict[ByteCodeIndex, int]]
-    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    __memory_malloc_count = ByteCodeColumn(__files)
 
     # mallocs attributable to Python, for each location in the program
-    __memory_python_samples: Dict[
-        Filename, Dict[LineNumber, Dict[ByteCodeIndex, float]]
-    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+    __memory_python_samples = ByteCodeColumn(__files)
 
     # free samples for each location in the program
-    __memory_free_samples: Dict[
-        Filename, Dict[LineNumber, Dict[ByteCodeIndex, float]]
-    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+    __memory_free_samples = ByteCodeColumn(__files)
 
     # number of times samples were added for the above
-    __memory_free_count: Dict[
-        Filename, Dict[LineNumber, Dict[ByteCodeIndex, int]]
-    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    __memory_free_count = ByteCodeColumn(__files)
 
     # memcpy samples for each location in the program
-    __memcpy_samples: Dict[Filename, Dict[LineNumber, int]] = defaultdict(
-        lambda: defaultdict(int)
-    )
+    __memcpy_samples = LineColumn(__files)
+
+    # the same CPU, memory and copy totals for each function, and how
+    # many of the top functions by each to list above a file's lines
+    __function_stats = FunctionStats()
+    __functions_shown = 5
 
     # leak score tracking
-    __leak_score: Dict[Filename, Dict[LineNumber, float]] = defaultdict(
-        lambda: defaultdict(float)
-    )
+    __leak_score = LineColumn(__files)
 
     __allocation_velocity: Tuple[float, int] = (0.0, 0)
 
@@ -226,6 +256,16 @@ class Scalene:
     # last num seconds between interrupts for CPU sampling.
     __last_cpu_sampling_rate: float = __mean_cpu_sampling_rate
 
+    # bytes between memory and copy samples (before any scaling).
+    __malloc_sampling_rate: int = 1048576
+    __memcpy_sampling_rate: int = 2097152
+
+    # scales the sampling intervals to keep our overhead within
+    # --max-overhead, if given
+    __overhead_controller: Optional[OverheadController] = None
+    # how much time we spend in our own handlers (see scalene/overhead.py)
+    __overhead = OverheadStats()
+
     # when did we last receive a signal?
     __last_signal_time_virtual: float = 0
     __last_signal_time_wallclock: float = 0
@@ -251,6 +291,8 @@ class Scalene:
     __output_file: str = ""
     # if we output HTML or not
     __html: bool = False
+    # if we output JSON (see scalene/jsonprofile.py) instead
+    __json: bool = False
     # if we profile all code or just target code and code in its child directories
     __profile_all: bool = False
     # how long between outputting stats during execution
@@ -259,6 +301,10 @@ class Scalene:
     __next_output_time: float = float("inf")
     # when we started
     __start_time: float = 0
+    # when we first started (timelines are relative to this)
+    __first_start_time: float = 0
+    # the child processes whose profiles we merged into ours
+    __child_pids: List[int] = []
     # total time spent in program being profiled
     __elapsed_time: float = 0
     # pid for tracking child processes
@@ -272,46 +318,56 @@ class Scalene:
         Filename, Dict[LineNumber, Set[ByteCodeIndex]]
     ] = defaultdict(lambda: defaultdict(lambda: set()))
 
-    # Things that need to be in sync with include/sampleheap.hpp:
+    # native stack samples for each location in the program, by the
+    # native function (and shared object) they landed in
+    __native_samples: Dict[
+        Filename, Dict[LineNumber, Dict[NativeSymbol, int]]
+    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+
+    # Things that need to be in sync with include/sampleheap.hpp
+    # and include/memcpysampler.hpp (see scalene/samplefile.py):
     #
-    #   file to communicate the number of malloc/free samples (+ PID)
-    __malloc_signal_filename = Filename(
-        "/tmp/scalene-malloc-signal" + str(os.getpid())
+    #   file to communicate the malloc/free samples (+ PID)
+    __malloc_samplefile = SampleFile(
+        "malloc",
+        allocation_record,
+        ALLOCATION_SEQUENCE_FIELD,
+        parse_legacy_allocation,
     )
-    __malloc_signal_position = 0
-    try:
-        __malloc_signal_fd = open(__malloc_signal_filename, "x")
-    except BaseException:
-        pass
-    try:
-        __malloc_signal_fd = open(__malloc_signal_filename, "r")
-        __malloc_signal_mmap = mmap.mmap(
-            __malloc_signal_fd.fileno(),
-            0,
-            mmap.MAP_SHARED,
-            mmap.PROT_READ,
-        )
-    except BaseException:
-        # Ignore if we aren't profiling memory.
-        pass
-
-    #   file to communicate the number of memcpy samples (+ PID)
-    __memcpy_signal_filename = Filename(
-        "/tmp/scalene-memcpy-signal" + str(os.getpid())
+    #   file to communicate the memcpy samples (+ PID)
+    __memcpy_samplefile = SampleFile(
+        "memcpy", memcpy_record, MEMCPY_SEQUENCE_FIELD, parse_legacy_memcpy
     )
-    __memcpy_signal_fd = None
-    try:
-        __memcpy_signal_fd = open(__memcpy_signal_filename, "r")
-        __memcpy_signal_mmap = mmap.mmap(
-            __memcpy_signal_fd.fileno(),
-            0,
-            mmap.MAP_SHARED,
-            mmap.PROT_READ,
-        )
+    #   file to communicate native call stack samples (+ PID), which
+    #   we take with --native-symbols
+    __native_samplefile = SampleFile(
+        "native", native_record, NATIVE_SEQUENCE_FIELD
+    )
+    __native_symbols: Optional[NativeSymbols] = None
+    # how many native functions to list under each line
+    __native_symbols_shown = 3
+    # the traced call stacks of every sample, with --stacks, and the
+    # prefix of the collapsed-stack files we write them to
+    __stacks: Optional[StackTable] = None
+    __stacks_prefix = ""
+    #   sample counters from child processes: records written, signals
+    #   raised to announce them, and records dropped because a ring was full
+    __child_sample_counters: List[int] = [0, 0, 0]
+    #   who consumes the samples: "signal" handlers on the main thread, or
+    #   a collector "thread" that libscalene wakes up through a pipe
+    __collector_mode: str = "signal"
+    __collector_thread: Optional[threading.Thread] = None
+    __collector_pipe: Tuple[int, int] = (-1, -1)
+    #   held by the collector while it adds samples, and by the CPU handler
+    #   while it adds its own (it waits for the collector, rather than
+    #   skipping a sample, since they update the same statistics)
+    __collector_lock = threading.Lock()
+    #   who takes the CPU samples: the CPU timer's "signal" handler on the
+    #   main thread, or a sampler "thread" that wakes up on its own
+    __sampler_mode: str = "signal"
+    __sampler_thread: Optional[threading.Thread] = None
+    __sampler_stop: Optional[threading.Event] = None
 
-    except BaseException:
-        pass
-    __memcpy_signal_position = 0
     # The specific signals we use.
     # Malloc and free signals are generated by include/sampleheap.hpp.
 
@@ -328,6 +384,18 @@ class Scalene:
     #   the name of the program being profiled
     __program_being_profiled = Filename("")
 
+    # The threads we know about, by identifier (None for threads that
+    # threading doesn't know about), and the name patterns of the threads
+    # to sample (--threads) and not to sample (--exclude-threads).
+    __threads: Dict[int, Optional[threading.Thread]] = {}
+    __thread_include: List[str] = []
+    __thread_exclude: List[str] = []
+    # every Python thread's innermost frame, as of the last stack walk
+    __thread_snapshot: Dict[int, FrameType] = {}
+
+    # Each thread's CPU clock, to charge it the time it actually used.
+    __thread_clocks = ThreadClocks()
+
     # Is the thread sleeping? (We use this to properly attribute CPU time.)
     __is_thread_sleeping: Dict[int, bool] = defaultdict(
         bool
@@ -349,7 +417,12 @@ class Scalene:
     def profile(func: Any) -> Any:
         # Record the file and function name
         Scalene.__files_to_profile[func.__code__.co_filename] = True
-        Scalene.__functions_to_profile[func.__code__.co_filename][func] = True
+        Scalene.__lines_to_profile[func.__code__.co_filename].add(
+            *code_lines(func.__code__)
+        )
+        # This changes what we trace.
+        Scalene.should_trace.cache_clear()
+        Scalene.__code_traced.clear()
 
         @functools.wraps(func)
         def wrapper_profile(*args: Any, **kwargs: Any) -> Any:
@@ -388,13 +461,33 @@ class Scalene:
         Scalene.__is_thread_sleeping[tid] = False
 
     @staticmethod
-    @lru_cache(maxsize=None)
     def is_call_function(code: CodeType, bytei: ByteCodeIndex) -> bool:
         """Returns true iff the bytecode at the given index is a function call."""
-        for ins in dis.get_instructions(code):
-            if ins.offset == bytei and ins.opcode in Scalene.__call_opcodes:
-                return True
-        return False
+        calls = Scalene.__code_calls.get(id(code))
+        if calls is None:
+            calls = Scalene.call_bitmap(code)
+            Scalene.__code_calls[id(code)] = calls
+            Scalene.remember_code(code)
+        # Instructions are two bytes long (3.6+).
+        index = bytei // 2
+        if index < 0 or index >> 3 >= len(calls):
+            return False
+        return bool(calls[index >> 3] & (1 << (index & 7)))
+
+    @staticmethod
+    def call_bitmap(code: CodeType) -> bytes:
+        """A bitmap of the instructions in code that are calls (one bit
+        per two-byte code unit)."""
+        bits = bytearray((len(code.co_code) // 2 + 7) // 8)
+        instructions = list(dis.get_instructions(code))
+        ends = [ins.offset for ins in instructions[1:]] + [len(code.co_code)]
+        for ins, end in zip(instructions, ends):
+            if ins.opcode in Scalene.__call_opcodes:
+                # Include any inline cache entries (3.11+): while it
+                # calls Python code, f_lasti points at the last one.
+                for index in range(ins.offset // 2, end // 2):
+                    bits[index >> 3] |= 1 << (index & 7)
+        return bytes(bits)
 
     @staticmethod
     def set_timer_signals() -> None:
@@ -419,8 +512,11 @@ class Scalene:
         """Set up the signal handlers to handle interrupts for profiling and start the
         timer interrupts."""
         Scalene.set_timer_signals()
+        if Scalene.__sampler_mode == "thread":
+            Scalene.start_sampler()
         # CPU
-        signal.signal(Scalene.__cpu_signal, Scalene.cpu_signal_handler)
+        if Scalene.__sampler_mode == "signal":
+            signal.signal(Scalene.__cpu_signal, Scalene.cpu_signal_handler)
         # Set signal handlers for memory allocation and memcpy events.
         signal.signal(Scalene.__malloc_signal, Scalene.malloc_signal_handler)
         signal.signal(Scalene.__free_signal, Scalene.free_signal_handler)
@@ -428,17 +524,30 @@ class Scalene:
             Scalene.__memcpy_signal,
             Scalene.memcpy_event_signal_handler,
         )
+        if Scalene.__collector_mode == "thread":
+            Scalene.start_collector()
+        if Scalene.__native_symbols and not Scalene.__native_symbols.start(
+            Scalene.__mean_cpu_sampling_rate
+        ):
+            Scalene.__native_symbols = None
+            print(
+                "Scalene warning: this libscalene can't sample native "
+                "stacks (it needs memory profiling, on Linux); ignoring "
+                "--native-symbols.",
+                file=sys.stderr,
+            )
         # Set every signal to restart interrupted system calls.
         signal.siginterrupt(Scalene.__cpu_signal, False)
         signal.siginterrupt(Scalene.__malloc_signal, False)
         signal.siginterrupt(Scalene.__free_signal, False)
         signal.siginterrupt(Scalene.__memcpy_signal, False)
         # Turn on the CPU profiling timer to run every mean_cpu_sampling_rate seconds.
-        signal.setitimer(
-            Scalene.__cpu_timer_signal,
-            Scalene.__mean_cpu_sampling_rate,
-            Scalene.__mean_cpu_sampling_rate,
-        )
+        if Scalene.__sampler_mode == "signal":
+            signal.setitimer(
+                Scalene.__cpu_timer_signal,
+                Scalene.__mean_cpu_sampling_rate,
+                Scalene.__mean_cpu_sampling_rate,
+            )
         Scalene.__last_signal_time_virtual = Scalene.get_process_time()
 
     @staticmethod
@@ -446,6 +555,11 @@ class Scalene:
         """Time spent on the CPU."""
         return time.process_time()
 
+    @staticmethod
+    def get_thread_time() -> float:
+        """Time the calling thread spent on the CPU."""
+        return time.thread_time()
+
     @staticmethod
     def get_wallclock_time() -> float:
         """Wall-clock time."""
@@ -465,6 +579,9 @@ class Scalene:
         # Hijack join.
         import scalene.replacement_thread_join
 
+        # Keep track of threads as they start.
+        import scalene.replacement_thread_start
+
         if "cpu_percent_threshold" in arguments:
             Scalene.__cpu_percent_threshold = int(
                 arguments.cpu_percent_threshold
@@ -477,6 +594,31 @@ class Scalene:
             )
         if arguments.use_virtual_time:
             Scalene.__use_wallclock_time = False
+        if "malloc_sampling_rate" in arguments:
+            Scalene.__malloc_sampling_rate = arguments.malloc_sampling_rate
+            Scalene.__memcpy_sampling_rate = arguments.memcpy_sampling_rate
+        if "max_overhead" in arguments and arguments.max_overhead:
+            Scalene.__overhead_controller = OverheadController(
+                arguments.max_overhead
+            )
+        if "collector" in arguments:
+            Scalene.__collector_mode = arguments.collector
+        if "sampler" in arguments:
+            Scalene.__sampler_mode = arguments.sampler
+        if "native_symbols" in arguments and arguments.native_symbols:
+            Scalene.__native_symbols = NativeSymbols()
+        if "functions" in arguments:
+            Scalene.__functions_shown = arguments.functions
+        if "stacks" in arguments and arguments.stacks:
+            Scalene.__stacks = StackTable()
+            Scalene.__stacks_prefix = arguments.stacks_prefix
+        if "threads" in arguments:
+            Scalene.__thread_include = Scalene.thread_patterns(
+                arguments.threads
+            )
+            Scalene.__thread_exclude = Scalene.thread_patterns(
+                arguments.exclude_threads
+            )
 
         if arguments.pid:
             # Child process.
@@ -502,10 +644,42 @@ class Scalene:
             )
             if arguments.use_virtual_time:
                 cmdline += " --use-virtual-time"
+            cmdline += " --collector=" + arguments.collector
+            cmdline += " --sampler=" + arguments.sampler
+            if arguments.stacks:
+                cmdline += " --stacks --stacks-prefix=" + shlex.quote(
+                    arguments.stacks_prefix
+                )
+            if arguments.threads:
+                cmdline += " --threads=" + shlex.quote(arguments.threads)
+            if arguments.exclude_threads:
+                cmdline += " --exclude-threads=" + shlex.quote(
+                    arguments.exclude_threads
+                )
+            if arguments.max_overhead:
+                cmdline += " --max-overhead=" + str(
+                    arguments.max_overhead * 100
+                )
+            cmdline += " --malloc-sampling-rate=" + str(
+                arguments.malloc_sampling_rate
+            )
+            cmdline += " --memcpy-sampling-rate=" + str(
+                arguments.memcpy_sampling_rate
+            )
+            cmdline += " --signal-batch-size=" + str(
+                arguments.signal_batch_size
+            )
+            cmdline += " --signal-batch-time=" + str(
+                arguments.signal_batch_time
+            )
             if arguments.cpu_only:
                 cmdline += " --cpu-only"
             else:
+                if arguments.native_symbols:
+                    cmdline += " --native-symbols"
                 preface = "PYTHONMALLOC=malloc "
+                for name, value in Scalene.native_settings(arguments).items():
+                    preface += name + "=" + value + " "
                 if sys.platform == "linux":
                     shared_lib = os.path.join(
                         os.path.dirname(__file__), "libscalene.so"
@@ -560,8 +734,14 @@ class Scalene:
     ) -> None:
         """Wrapper for CPU signal handlers that locks access to the signal handler itself."""
         if Scalene.__in_signal_handler.acquire(blocking=False):
-            Scalene.cpu_signal_handler_helper(signum, this_frame)
+            with Scalene.__collector_lock:
+                start = Scalene.get_wallclock_time()
+                cpu_start = Scalene.get_thread_time()
+                Scalene.cpu_signal_handler_helper(signum, this_frame)
+                Scalene.charge_overhead("CPU handler", start, cpu_start)
             Scalene.__in_signal_handler.release()
+        else:
+            Scalene.__overhead["CPU handler"].skip()
 
     @staticmethod
     def profile_this_code(fname: Filename, lineno: LineNumber) -> bool:
@@ -571,12 +751,7 @@ class Scalene:
         if fname not in Scalene.__files_to_profile:
             return False
         # Now check to see if it's the right line range.
-        for fn in Scalene.__functions_to_profile[fname]:
-            lines, line_start = inspect.getsourcelines(fn)
-            if lineno >= line_start and lineno < line_start + len(lines):
-                # Yes, it's in range.
-                return True
-        return False
+        return lineno in Scalene.__lines_to_profile[fname]
 
     @staticmethod
     def cpu_signal_handler_helper(
@@ -596,9 +771,16 @@ class Scalene:
             # signals, print the profile, and then start signals
             # again.
             Scalene.__next_output_time += Scalene.__output_profile_interval
-            Scalene.stop()
-            Scalene.output_profiles()
-            Scalene.start()
+            if Scalene.__sampler_mode == "thread":
+                # We can't touch signal handlers off the main thread,
+                # but holding the handler lock keeps them out anyway.
+                Scalene.__elapsed_time += now_wallclock - Scalene.__start_time
+                Scalene.__start_time = now_wallclock
+                Scalene.output_profiles()
+            else:
+                Scalene.stop()
+                Scalene.output_profiles()
+                Scalene.start()
         # Here we take advantage of an ostensible limitation of Python:
         # it only delivers signals after the interpreter has given up
         # control. This seems to mean that sampling is limited to code
@@ -637,6 +819,62 @@ class Scalene:
 
         # Update counters for every running thread.
         new_frames = Scalene.compute_frames_to_record(this_frame)
+        if Scalene.__native_symbols:
+            Scalene.attribute_native_samples(new_frames)
+        if Scalene.__sampler_mode == "thread":
+            # No signal delay to go by, even for the main thread.
+            total_time = Scalene.attribute_thread_cpu_time(
+                new_frames, None, elapsed_wallclock
+            )
+        elif ThreadClocks.available:
+            total_time = Scalene.attribute_thread_cpu_time(
+                new_frames, python_time, elapsed_wallclock
+            )
+        else:
+            total_time = Scalene.attribute_cpu_time_equally(
+                new_frames, python_time, c_time, cpu_utilization
+            )
+        del new_frames
+
+        Scalene.__total_cpu_samples += total_time
+        Scalene.adjust_sampling_rates()
+        # Pick a new random interval, distributed around the mean.
+        # (Samples are weighted by the time they cover, so stretching
+        # the mean to limit overhead doesn't bias them.)
+        mean_interval = Scalene.__mean_cpu_sampling_rate
+        if Scalene.__overhead_controller:
+            mean_interval *= Scalene.__overhead_controller.scale
+        next_interval = 0.0
+        while next_interval <= 0.0:
+            # Choose a normally distributed random number around the
+            # mean for the next interval. By setting the standard
+            # deviation to a fraction of the mean, we know by
+            # properties of the normal distribution that the
+            # likelihood of iterating this loop more than once is
+            # low. For a fraction 1/f, the probability is
+            # p = 1-(math.erf(f/math.sqrt(2)))/2
+            next_interval = random.normalvariate(
+                mean_interval, mean_interval / 3.0
+            )
+        Scalene.__last_cpu_sampling_rate = next_interval
+        Scalene.__last_signal_time_wallclock = Scalene.get_wallclock_time()
+        Scalene.__last_signal_time_virtual = Scalene.get_process_time()
+        if Scalene.__sampler_mode == "signal":
+            signal.setitimer(
+                Scalene.__cpu_timer_signal, next_interval, next_interval
+            )
+
+    @staticmethod
+    def attribute_cpu_time_equally(
+        new_frames: List[Tuple[FrameType, int, FrameType]],
+        python_time: float,
+        c_time: float,
+        cpu_utilization: float,
+    ) -> float:
+        """Charge the CPU time since the last sample to the threads'
+        lines, splitting it equally among the threads that aren't
+        sleeping (when we can't read per-thread CPU clocks). Returns
+        the time charged."""
         # Now update counters (weighted) for every frame we are tracking.
         total_time = python_time + c_time
 
@@ -648,21 +886,42 @@ class Scalene:
             if not Scalene.__is_thread_sleeping[tident]:
                 total_frames += 1
         if total_frames == 0:
-            return
+            return 0.0
         normalized_time = total_time / total_frames
+        main_thread = threading.main_thread().ident
 
         # Now attribute execution time.
         for (frame, tident, orig_frame) in new_frames:
             fname = Filename(frame.f_code.co_filename)
             lineno = LineNumber(frame.f_lineno)
-            if frame == new_frames[0][0]:
+            if not Scalene.profile_this_code(fname, lineno):
+                # Outside the @profile-decorated functions: we won't
+                # report this line, so only count its time for the file.
+                if not Scalene.__is_thread_sleeping[tident]:
+                    Scalene.__cpu_samples[fname] += normalized_time
+                continue
+            if tident == main_thread:
                 # Main thread.
                 if not Scalene.__is_thread_sleeping[tident]:
-                    Scalene.__cpu_samples_python[fname][lineno] += (
-                        python_time / total_frames
+                    Scalene.__cpu_samples_python.add(
+                        fname, lineno, python_time / total_frames
+                    )
+                    Scalene.__cpu_samples_c.add(
+                        fname, lineno, c_time / total_frames
                     )
-                    Scalene.__cpu_samples_c[fname][lineno] += (
-                        c_time / total_frames
+                    Scalene.__function_stats.add(
+                        fname,
+                        lineno,
+                        frame.f_code,
+                        PYTHON_TIME,
+                        python_time / total_frames,
+                    )
+                    Scalene.__function_stats.add(
+                        fname,
+                        lineno,
+                        frame.f_code,
+                        NATIVE_TIME,
+                        c_time / total_frames,
                     )
                     Scalene.__cpu_samples[fname] += (
                         python_time + c_time
@@ -670,6 +929,10 @@ class Scalene:
                     Scalene.__cpu_utilization[fname][lineno].push(
                         cpu_utilization
                     )
+                    if Scalene.__stacks:
+                        Scalene.__stacks.add(
+                            CPU, Scalene.traced_stack(frame), normalized_time
+                        )
             else:
                 # We can't play the same game here of attributing
                 # time, because we are in a thread, and threads don't
@@ -683,98 +946,268 @@ class Scalene:
                         ByteCodeIndex(orig_frame.f_lasti),
                     ):
                         # It is. Attribute time to native.
-                        Scalene.__cpu_samples_c[fname][
-                            lineno
-                        ] += normalized_time
+                        Scalene.__cpu_samples_c.add(
+                            fname, lineno, normalized_time
+                        )
+                        Scalene.__function_stats.add(
+                            fname,
+                            lineno,
+                            frame.f_code,
+                            NATIVE_TIME,
+                            normalized_time,
+                        )
                     else:
                         # Not in a call function so we attribute the time to Python.
-                        Scalene.__cpu_samples_python[fname][
-                            lineno
-                        ] += normalized_time
+                        Scalene.__cpu_samples_python.add(
+                            fname, lineno, normalized_time
+                        )
+                        Scalene.__function_stats.add(
+                            fname,
+                            lineno,
+                            frame.f_code,
+                            PYTHON_TIME,
+                            normalized_time,
+                        )
                     Scalene.__cpu_samples[fname] += normalized_time
                     Scalene.__cpu_utilization[fname][lineno].push(
                         cpu_utilization
                     )
+                    if Scalene.__stacks:
+                        Scalene.__stacks.add(
+                            CPU, Scalene.traced_stack(frame), normalized_time
+                        )
 
-        del new_frames
+        return total_time
 
-        Scalene.__total_cpu_samples += total_time
-        # Pick a new random interval, distributed around the mean.
-        next_interval = 0.0
-        while next_interval <= 0.0:
-            # Choose a normally distributed random number around the
-            # mean for the next interval. By setting the standard
-            # deviation to a fraction of the mean, we know by
-            # properties of the normal distribution that the
-            # likelihood of iterating this loop more than once is
-            # low. For a fraction 1/f, the probability is
-            # p = 1-(math.erf(f/math.sqrt(2)))/2
-            next_interval = random.normalvariate(
-                Scalene.__mean_cpu_sampling_rate,
-                Scalene.__mean_cpu_sampling_rate / 3.0,
+    @staticmethod
+    def attribute_thread_cpu_time(
+        new_frames: List[Tuple[FrameType, int, FrameType]],
+        python_time: Optional[float],
+        elapsed_wallclock: float,
+    ) -> float:
+        """Charge each thread's line with the CPU time that thread used
+        since the last sample, according to its own CPU clock. Returns
+        the time charged. (python_time is how long the main thread ran
+        Python, if the signal's delay tells us.)"""
+        main_thread = threading.main_thread().ident
+        total_time = 0.0
+        Scalene.__thread_clocks.tick()
+        for (frame, tident, orig_frame) in new_frames:
+            elapsed = Scalene.__thread_clocks.elapsed(tident)
+            if not elapsed:
+                # Idle (or gone) since the last sample.
+                continue
+            total_time += elapsed
+            fname = Filename(frame.f_code.co_filename)
+            lineno = LineNumber(frame.f_lineno)
+            Scalene.__cpu_samples[fname] += elapsed
+            if not Scalene.profile_this_code(fname, lineno):
+                # Outside the @profile-decorated functions: we won't
+                # report this line, so only count its time for the file.
+                continue
+            if tident == main_thread and python_time is not None:
+                # The main thread ran Python for the sampling interval
+                # (or the signal would have been delayed); the rest of
+                # its CPU time went to native code.
+                python = min(python_time, elapsed)
+                native = elapsed - python
+            elif Scalene.is_call_function(
+                orig_frame.f_code, ByteCodeIndex(orig_frame.f_lasti)
+            ):
+                # Stuck inside a call: native.
+                python, native = 0.0, elapsed
+            else:
+                python, native = elapsed, 0.0
+            Scalene.__cpu_samples_python.add(fname, lineno, python)
+            Scalene.__cpu_samples_c.add(fname, lineno, native)
+            Scalene.__function_stats.add(
+                fname, lineno, frame.f_code, PYTHON_TIME, python
             )
-        Scalene.__last_cpu_sampling_rate = next_interval
-        Scalene.__last_signal_time_wallclock = Scalene.get_wallclock_time()
-        Scalene.__last_signal_time_virtual = Scalene.get_process_time()
-        signal.setitimer(
-            Scalene.__cpu_timer_signal, next_interval, next_interval
-        )
+            Scalene.__function_stats.add(
+                fname, lineno, frame.f_code, NATIVE_TIME, native
+            )
+            # The rest of the wall-clock time, this thread was idle.
+            Scalene.__cpu_utilization[fname][lineno].push(
+                min(1.0, elapsed / elapsed_wallclock)
+                if elapsed_wallclock > 0
+                else 1.0
+            )
+            if Scalene.__stacks:
+                Scalene.__stacks.add(
+                    CPU, Scalene.traced_stack(frame), elapsed
+                )
+        return total_time
+
+    @staticmethod
+    def traced_stack(
+        frame: Optional[FrameType], line: Optional[int] = None
+    ) -> List[Frame]:
+        """The frames we trace from the outermost one down to frame
+        (which we say is at line, if given)."""
+        stack: List[Frame] = []
+        code_traced = Scalene.__code_traced
+        while frame and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            traced = code_traced.get(id(code))
+            if traced is None:
+                traced = Scalene.should_trace_code(code)
+            if traced:
+                stack.append(
+                    (
+                        code.co_filename,
+                        code.co_name,
+                        frame.f_lineno
+                        if line is None or stack
+                        else line,
+                    )
+                )
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    @staticmethod
+    def attribute_native_samples(
+        new_frames: List[Tuple[FrameType, int, FrameType]],
+    ) -> None:
+        """Charge the native stacks libscalene sampled since the last
+        CPU sample to the lines their threads are on now."""
+        symbols = cast(NativeSymbols, Scalene.__native_symbols)
+        start = Scalene.get_wallclock_time()
+        records = Scalene.__native_samplefile.read()
+        Scalene.charge_overhead("sample reads", start)
+        thread_frames = {tident: frame for (frame, tident, _) in new_frames}
+        for (_sequence, tident, depth, *frames) in records:
+            frame = thread_frames.get(tident)
+            if not frame:
+                continue
+            fname = Filename(frame.f_code.co_filename)
+            lineno = LineNumber(frame.f_lineno)
+            if not Scalene.profile_this_code(fname, lineno):
+                continue
+            symbol = symbols.leaf(frames[:depth])
+            if symbol:
+                Scalene.__native_samples[fname][lineno][symbol] += 1
+
+    @staticmethod
+    def charge_overhead(
+        timer: str, start: float, cpu_start: Optional[float] = None
+    ) -> None:
+        """Account for the time spent on timer's work since start (and,
+        for a handler, the CPU time this thread spent since cpu_start)."""
+        elapsed = Scalene.get_wallclock_time() - start
+        Scalene.__overhead[timer].add(elapsed)
+        if Scalene.__overhead_controller and cpu_start is not None:
+            # Only CPU time counts against the budget: while a handler
+            # waits for the GIL, the program's own threads are running.
+            Scalene.__overhead_controller.add(
+                Scalene.get_thread_time() - cpu_start
+            )
+
+    @staticmethod
+    def adjust_sampling_rates() -> None:
+        """Stretch or shrink the sampling intervals to keep our overhead
+        within budget (--max-overhead)."""
+        controller = Scalene.__overhead_controller
+        if controller and controller.update(Scalene.get_wallclock_time()):
+            Scalene.__malloc_samplefile.set_sampling_rate(
+                int(Scalene.__malloc_sampling_rate * controller.scale)
+            )
+            Scalene.__memcpy_samplefile.set_sampling_rate(
+                int(Scalene.__memcpy_sampling_rate * controller.scale)
+            )
+            if Scalene.__native_symbols:
+                # Each CPU sample charges every native stack sampled
+                # since the last one, so those have to slow down too.
+                Scalene.__native_symbols.set_interval(
+                    Scalene.__mean_cpu_sampling_rate * controller.scale
+                )
 
     # Returns final frame (up to a line in a file we are profiling), the thread identifier, and the original frame.
+    @staticmethod
+    def register_thread(thread: threading.Thread) -> None:
+        """Remember a thread that just started."""
+        if thread.ident is not None:
+            Scalene.__threads[thread.ident] = thread
+
+    @staticmethod
+    def refresh_threads() -> None:
+        """Rebuild the map from identifiers to threads."""
+        Scalene.__threads = {
+            cast(int, t.ident): t for t in threading.enumerate()
+        }
+        Scalene.__thread_clocks.retain(Scalene.__threads)
+
+    @staticmethod
+    def find_thread(tident: int) -> Optional[threading.Thread]:
+        """The thread with this identifier, for threads that started
+        before we could register them (or that threading doesn't know
+        about, in which case it is None)."""
+        Scalene.refresh_threads()
+        return Scalene.__threads.setdefault(tident, None)
+
+    @staticmethod
+    def thread_patterns(patterns: Optional[str]) -> List[str]:
+        """Split a comma-separated list of thread name patterns."""
+        if not patterns:
+            return []
+        return [p.strip() for p in patterns.split(",") if p.strip()]
+
+    @staticmethod
+    @lru_cache(None)
+    def should_sample_thread(name: str) -> bool:
+        """Return true if we should sample the thread with this name."""
+        if Scalene.__thread_include and not any(
+            fnmatch.fnmatchcase(name, p) for p in Scalene.__thread_include
+        ):
+            return False
+        return not any(
+            fnmatch.fnmatchcase(name, p) for p in Scalene.__thread_exclude
+        )
+
     @staticmethod
     def compute_frames_to_record(
         this_frame: FrameType,
     ) -> List[Tuple[FrameType, int, FrameType]]:
         """Collects all stack frames that Scalene actually processes."""
-        frames: List[Tuple[FrameType, int]] = [
-            (
-                cast(
-                    FrameType,
-                    sys._current_frames().get(cast(int, t.ident), None),
-                ),
-                cast(int, t.ident),
-            )
-            for t in threading.enumerate()
-            if t != threading.main_thread()
-        ]
-        # Put the main thread in the front.
-        frames.insert(
-            0,
-            (
-                sys._current_frames().get(
-                    cast(int, threading.main_thread().ident), None
-                ),
-                cast(int, threading.main_thread().ident),
-            ),
-        )
-        # Process all the frames to remove ones we aren't going to track.
+        start = Scalene.get_wallclock_time()
+        # One snapshot of every thread's innermost frame.
+        frames = sys._current_frames()
+        Scalene.__thread_snapshot = frames
+        threads = Scalene.__threads
+        if len(threads) > 2 * len(frames) + 16:
+            # Forget threads that have exited.
+            Scalene.refresh_threads()
+        filtering = Scalene.__thread_include or Scalene.__thread_exclude
+        main_thread = threading.main_thread().ident
+        # Never sample our own threads: they run threading.py, which
+        # --profile-all traces.
+        own_threads = {
+            thread.ident
+            for thread in (Scalene.__sampler_thread, Scalene.__collector_thread)
+            if thread
+        }
+        # Process all the frames to remove ones we aren't going to track,
+        # with the main thread (if we track it) in the front.
         new_frames: List[Tuple[FrameType, int, FrameType]] = []
-        for (frame, tident) in frames:
-            orig_frame = frame
-            if not frame:
+        for (tident, frame) in frames.items():
+            if tident in own_threads:
                 continue
-            fname = frame.f_code.co_filename
-            # Record samples only for files we care about.
-            if not fname:
-                # 'eval/compile' gives no f_code.co_filename.  We have
-                # to look back into the outer frame in order to check
-                # the co_filename.
-                back = cast(FrameType, frame.f_back)
-                fname = Filename(back.f_code.co_filename)
-            while not Scalene.should_trace(fname):
-                # Walk the stack backwards until we hit a frame that
-                # IS one we should trace (if there is one).  i.e., if
-                # it's in the code being profiled, and it is just
-                # calling stuff deep in libraries.
-                if frame:
-                    frame = cast(FrameType, frame.f_back)
-                    if frame:
-                        fname = frame.f_code.co_filename
-                        continue
-                else:
-                    break
-            if frame:
-                new_frames.append((frame, tident, orig_frame))
+            if tident in threads:
+                thread = threads[tident]
+            else:
+                thread = Scalene.find_thread(tident)
+            if not thread:
+                continue
+            if filtering and not Scalene.should_sample_thread(thread.name):
+                continue
+            traced_frame = Scalene.find_traced_frame(frame)
+            if not traced_frame:
+                continue
+            if tident == main_thread:
+                new_frames.insert(0, (traced_frame, tident, frame))
+            else:
+                new_frames.append((traced_frame, tident, frame))
+        Scalene.charge_overhead("stack walks", start)
         return new_frames
 
     @staticmethod
@@ -786,8 +1219,13 @@ class Scalene:
     ) -> None:
         """Handle malloc events."""
         if Scalene.__in_signal_handler.acquire(blocking=False):
+            start = Scalene.get_wallclock_time()
+            cpu_start = Scalene.get_thread_time()
             Scalene.allocation_signal_handler(signum, this_frame)
+            Scalene.charge_overhead("memory handler", start, cpu_start)
             Scalene.__in_signal_handler.release()
+        else:
+            Scalene.__overhead["memory handler"].skip()
 
     @staticmethod
     def free_signal_handler(
@@ -798,8 +1236,13 @@ class Scalene:
     ) -> None:
         """Handle free events."""
         if Scalene.__in_signal_handler.acquire(blocking=False):
+            start = Scalene.get_wallclock_time()
+            cpu_start = Scalene.get_thread_time()
             Scalene.allocation_signal_handler(signum, this_frame)
+            Scalene.charge_overhead("memory handler", start, cpu_start)
             Scalene.__in_signal_handler.release()
+        else:
+            Scalene.__overhead["memory handler"].skip()
 
     @staticmethod
     def allocation_signal_handler(
@@ -813,107 +1256,154 @@ class Scalene:
         if not new_frames:
             return
 
-        # Process the input array from where we left off reading last time.
-        arr: List[Tuple[int, str, float, float]] = []
-        try:
-            mm = Scalene.__malloc_signal_mmap
-            mm.seek(Scalene.__malloc_signal_position)
-            while True:
-                count_str = mm.readline().rstrip().decode("ascii")
-                if count_str == "":
-                    break
-                (
-                    action,
-                    alloc_time_str,
-                    count_str,
-                    python_fraction_str,
-                ) = count_str.split(",")
-                arr.append(
-                    (
-                        int(alloc_time_str),
-                        action,
-                        float(count_str),
-                        float(python_fraction_str),
-                    )
-                )
-            Scalene.__malloc_signal_position = mm.tell() - 1
-        except FileNotFoundError:
-            pass
-
-        arr.sort()
-
-        # Iterate through the array to compute the new current footprint.
-        # and update the global __memory_footprint_samples.
-        before = Scalene.__current_footprint
+        # Process the records written since we last read them.
+        # Each one is (action, sequence, count, python fraction, thread id,
+        # code address, line, bytecode offset), already in the order they
+        # were written.
+        start = Scalene.get_wallclock_time()
+        arr: List[
+            Tuple[bytes, int, int, float, int, int, int, int]
+        ] = Scalene.__malloc_samplefile.read()
+        Scalene.charge_overhead("sample reads", start)
+        if not arr:
+            return
+        # Timestamp for this batch's footprint samples.
+        now = Scalene.get_wallclock_time()
+
+        # Compute the footprint after each record with one prefix sum
+        # over the signed counts (in MB), and group the records by the
+        # thread that made them and where it was.
+        deltas = [
+            (count if action == b"M" else -count) / (1024 * 1024)
+            for (action, _seq, count, *_rest) in arr
+        ]
+        footprints = running_footprint(Scalene.__current_footprint, deltas)
+        batch = range(len(footprints))
         prevmax = Scalene.__max_footprint
-        for item in arr:
-            _alloc_time, action, count, python_fraction = item
-            count /= 1024 * 1024
-            is_malloc = action == "M"
-            if is_malloc:
-                Scalene.__current_footprint += count
-                if Scalene.__current_footprint > Scalene.__max_footprint:
-                    Scalene.__max_footprint = Scalene.__current_footprint
-            else:
-                Scalene.__current_footprint -= count
-            Scalene.__memory_footprint_samples.add(Scalene.__current_footprint)
-        after = Scalene.__current_footprint
-        # Now update the memory footprint for every running frame.
-        # This is a pain, since we don't know to whom to attribute memory,
-        # so we may overcount.
-
-        for (frame, _tident, _orig_frame) in new_frames:
-            fname = Filename(frame.f_code.co_filename)
-            lineno = LineNumber(frame.f_lineno)
-            bytei = ByteCodeIndex(frame.f_lasti)
-            # Add the byte index to the set for this line (if it's not there already).
-            Scalene.__bytei_map[fname][lineno].add(bytei)
-            curr = before
+        Scalene.__max_footprint = max(prevmax, max(footprints))
+        Scalene.__current_footprint = footprints[-1]
+        for i in extremes(footprints, batch):
+            Scalene.__memory_footprint_samples.add(footprints[i], now)
+        by_location: Dict[Tuple[int, int, int, int], List[int]] = defaultdict(
+            list
+        )
+        for i, record in enumerate(arr):
+            by_location[record[4:]].append(i)
+
+        # Attribute each thread's allocations to the line that made them.
+        # Threads we don't know about (native threads, or an older
+        # libscalene that does not record thread ids) are charged to the
+        # first thread we sampled; Python threads outside the profiled
+        # code count towards the totals, but not towards any line.
+        thread_frames = {tident: frame for (frame, tident, _) in new_frames}
+        python_threads = Scalene.__thread_snapshot
+        for (tid, code, line, lasti), samples in by_location.items():
+            delta = 0.0
             python_frac = 0.0
             allocs = 0.0
-            # Go through the array again and add each updated current footprint.
-            for item in arr:
-                _alloc_time, action, count, python_fraction = item
-                count /= 1024 * 1024
-                is_malloc = action == "M"
-                if is_malloc:
+            for i in samples:
+                count = deltas[i]
+                delta += count
+                if count > 0:
                     allocs += count
-                    curr += count
-                    python_frac += python_fraction * count
-                else:
-                    curr -= count
-                Scalene.__per_line_footprint_samples[fname][lineno].add(curr)
-            assert curr == after
+                    python_frac += arr[i][3] * count
+            if delta > 0:
+                Scalene.__total_memory_malloc_samples += delta
+            else:
+                Scalene.__total_memory_free_samples -= delta
+            Scalene.__allocation_velocity = (
+                Scalene.__allocation_velocity[0] + delta,
+                Scalene.__allocation_velocity[1] + allocs,
+            )
+            if tid not in python_threads:
+                tid = new_frames[0][1]
+            if tid not in thread_frames:
+                continue
+            location = Scalene.allocation_location(
+                python_threads[tid], code, line, lasti
+            )
+            if location:
+                frame, fname, lineno, bytei = location
+            else:
+                # Not captured, or no longer running: use the line the
+                # thread is on now.
+                frame = thread_frames[tid]
+                fname = Filename(frame.f_code.co_filename)
+                lineno = LineNumber(frame.f_lineno)
+                bytei = ByteCodeIndex(frame.f_lasti)
+            if delta > 0:
+                Scalene.__malloc_samples[fname] += 1
+            if not Scalene.profile_this_code(fname, lineno):
+                # Outside the @profile-decorated functions: we won't
+                # report this line.
+                continue
+            # Add the byte index to the set for this line (if it's not there already).
+            Scalene.__bytei_map[fname][lineno].add(bytei)
+            Scalene.__function_stats.add(
+                fname, lineno, frame.f_code, NET_MEMORY, delta
+            )
+            if Scalene.__stacks:
+                Scalene.__stacks.add(
+                    MALLOC, Scalene.traced_stack(frame, lineno), delta
+                )
+            timeline = Scalene.__per_line_footprint_samples[fname][lineno]
+            for i in extremes(footprints, samples):
+                timeline.add(footprints[i], now)
             # If there was a net increase in memory, treat it as if it
             # was a malloc; otherwise, treat it as if it was a
             # free. This is for later reporting of net memory gain /
             # loss per line of code.
-            if after > before:
-                Scalene.__memory_malloc_samples[fname][lineno][bytei] += (
-                    after - before
+            if delta > 0:
+                Scalene.__memory_malloc_samples.add_at(
+                    fname, lineno, bytei, delta
                 )
-                Scalene.__memory_python_samples[fname][lineno][bytei] += (
-                    python_frac / allocs
-                ) * (after - before)
-                Scalene.__malloc_samples[fname] += 1
-                Scalene.__memory_malloc_count[fname][lineno][bytei] += 1
-                Scalene.__total_memory_malloc_samples += after - before
+                Scalene.__memory_python_samples.add_at(
+                    fname, lineno, bytei, (python_frac / allocs) * delta
+                )
+                Scalene.__memory_malloc_count.add_at(fname, lineno, bytei, 1)
             else:
-                Scalene.__memory_free_samples[fname][lineno][bytei] += (
-                    before - after
+                Scalene.__memory_free_samples.add_at(
+                    fname, lineno, bytei, -delta
                 )
-                Scalene.__memory_free_count[fname][lineno][bytei] += 1
-                Scalene.__total_memory_free_samples += before - after
-            Scalene.__allocation_velocity = (
-                Scalene.__allocation_velocity[0] + (after - before),
-                Scalene.__allocation_velocity[1] + allocs,
-            )
+                Scalene.__memory_free_count.add_at(fname, lineno, bytei, 1)
             # Update leak score if we just increased the max footprint (starting at a fixed threshold, currently 100MB, FIXME).
             if (
                 prevmax < Scalene.__max_footprint
                 and Scalene.__max_footprint > 100
             ):
-                Scalene.__leak_score[fname][lineno] += 1
+                Scalene.__leak_score.add(fname, lineno, 1)
+
+    @staticmethod
+    def allocation_location(
+        frame: Optional[FrameType], code: int, line: int, lasti: int
+    ) -> Optional[Tuple[FrameType, Filename, LineNumber, ByteCodeIndex]]:
+        """Where libscalene saw an allocation happen: the frame and line
+        in code (the address of a code object on this thread's stack),
+        or, if that isn't code we trace, the frame and line in the
+        profiled code that led to it. None if the code object is no
+        longer on the stack."""
+        if not code:
+            return None
+        while frame and id(frame.f_code) != code:
+            frame = frame.f_back
+        if not frame:
+            return None
+        if Scalene.should_trace_code(frame.f_code):
+            return (
+                frame,
+                Filename(frame.f_code.co_filename),
+                LineNumber(line),
+                ByteCodeIndex(lasti if lasti >= 0 else frame.f_lasti),
+            )
+        frame = Scalene.find_traced_frame(frame)
+        if not frame:
+            return None
+        return (
+            frame,
+            Filename(frame.f_code.co_filename),
+            LineNumber(frame.f_lineno),
+            ByteCodeIndex(frame.f_lasti),
+        )
 
     @staticmethod
     def memcpy_event_signal_handler(
@@ -923,42 +1413,195 @@ class Scalene:
         frame: FrameType,
     ) -> None:
         """Handles memcpy events."""
-        if not Scalene.__in_signal_handler.acquire(blocking=False):
-            return
+        if Scalene.__in_signal_handler.acquire(blocking=False):
+            start = Scalene.get_wallclock_time()
+            cpu_start = Scalene.get_thread_time()
+            Scalene.memcpy_signal_handler_helper(signum, frame)
+            Scalene.charge_overhead("copy handler", start, cpu_start)
+            Scalene.__in_signal_handler.release()
+        else:
+            Scalene.__overhead["copy handler"].skip()
+
+    @staticmethod
+    def memcpy_signal_handler_helper(
+        signum: Union[
+            Callable[[Signals, FrameType], None], int, Handlers, None
+        ],
+        frame: FrameType,
+    ) -> None:
+        """Handle interrupts for memcpy profiling."""
         new_frames = Scalene.compute_frames_to_record(frame)
         if not new_frames:
-            Scalene.__in_signal_handler.release()
             return
-        arr: List[Tuple[int, int]] = []
-        # Process the input array.
-        try:
-            mfile = Scalene.__memcpy_signal_mmap
-            if mfile:
-                mfile.seek(Scalene.__memcpy_signal_position)
-                while True:
-                    count_str = mfile.readline().rstrip().decode("ascii")
-                    if count_str == "":
-                        break
-                    count_str = count_str.rstrip()
-
-                    (memcpy_time_str, count_str2) = count_str.split(",")
-                    arr.append((int(memcpy_time_str), int(count_str2)))
-                Scalene.__memcpy_signal_position = mfile.tell() - 1
-        except Exception:
-            pass
-        arr.sort()
+        # Process the records written since we last read them.
+        start = Scalene.get_wallclock_time()
+        arr: List[Tuple[int, int]] = Scalene.__memcpy_samplefile.read()
+        Scalene.charge_overhead("sample reads", start)
 
         for item in arr:
             _memcpy_time, count = item
             for (the_frame, _tident, _orig_frame) in new_frames:
                 fname = Filename(the_frame.f_code.co_filename)
                 line_no = LineNumber(the_frame.f_lineno)
+                if not Scalene.profile_this_code(fname, line_no):
+                    continue
                 bytei = ByteCodeIndex(the_frame.f_lasti)
                 # Add the byte index to the set for this line.
                 Scalene.__bytei_map[fname][line_no].add(bytei)
-                Scalene.__memcpy_samples[fname][line_no] += count
+                Scalene.__memcpy_samples.add(fname, line_no, count)
+                Scalene.__function_stats.add(
+                    fname, line_no, the_frame.f_code, COPY_VOLUME, count
+                )
+
+    @staticmethod
+    def set_notify_fd(fd: int) -> bool:
+        """Ask libscalene to announce new memory samples by writing to
+        fd rather than raising signals (or, if fd is -1, to go back to
+        signals). Returns false if this libscalene can't."""
+        try:
+            ctypes.CDLL(None).scalene_set_notify_fd(fd)
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    @staticmethod
+    def start_collector() -> None:
+        """Consume memory samples on a collector thread instead of in
+        signal handlers, so allocating code is not interrupted."""
+        if not Scalene.__collector_thread:
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(write_fd, False)
+            if not Scalene.set_notify_fd(write_fd):
+                os.close(read_fd)
+                os.close(write_fd)
+                Scalene.__collector_mode = "signal"
+                print(
+                    "Scalene warning: this version of libscalene does not "
+                    "support --collector=thread; using signal handlers.",
+                    file=sys.stderr,
+                )
+                return
+            Scalene.__collector_pipe = (read_fd, write_fd)
+            Scalene.__collector_thread = threading.Thread(
+                target=Scalene.collector_loop,
+                name="scalene-collector",
+                daemon=True,
+            )
+            Scalene.__collector_thread.start()
+        else:
+            Scalene.set_notify_fd(Scalene.__collector_pipe[1])
+
+    @staticmethod
+    def start_sampler() -> None:
+        """Take CPU samples on a sampler thread instead of in the CPU
+        timer's signal handler, so they keep coming while the main
+        thread is stuck in native code."""
+        if not ThreadClocks.available:
+            Scalene.__sampler_mode = "signal"
+            print(
+                "Scalene warning: --sampler=thread needs per-thread CPU "
+                "clocks, which this platform lacks; using signals.",
+                file=sys.stderr,
+            )
+            return
+        if Scalene.__sampler_stop:
+            Scalene.__sampler_stop.set()
+        Scalene.__sampler_stop = threading.Event()
+        Scalene.__sampler_thread = threading.Thread(
+            target=Scalene.sampler_loop,
+            args=(Scalene.__sampler_stop,),
+            name="scalene-sampler",
+            daemon=True,
+        )
+        Scalene.__last_signal_time_wallclock = Scalene.get_wallclock_time()
+        Scalene.__sampler_thread.start()
+
+    @staticmethod
+    def sampler_loop(stop: threading.Event) -> None:
+        """Take a CPU sample every (randomized) sampling interval."""
+        this_frame = sys._getframe()
+        while not stop.wait(Scalene.__last_cpu_sampling_rate):
+            # Wait our turn rather than skipping this sample.
+            with Scalene.__in_signal_handler, Scalene.__collector_lock:
+                if stop.is_set():
+                    return
+                start = Scalene.get_wallclock_time()
+                cpu_start = Scalene.get_thread_time()
+                Scalene.cpu_signal_handler_helper(None, this_frame)
+                Scalene.charge_overhead("CPU handler", start, cpu_start)
+
+    @staticmethod
+    def collector_loop() -> None:
+        """Drain the sample files whenever libscalene writes to our pipe."""
+        this_frame = sys._getframe()
+        while True:
+            try:
+                # Wakeups that arrive while we work are coalesced.
+                if not os.read(Scalene.__collector_pipe[0], 4096):
+                    return
+            except OSError:
+                return
+            # We don't take the handler lock, so the CPU handler never
+            # skips a sample while we work; it waits for us instead.
+            with Scalene.__collector_lock:
+                start = Scalene.get_wallclock_time()
+                cpu_start = Scalene.get_thread_time()
+                Scalene.allocation_signal_handler(None, this_frame)
+                Scalene.memcpy_signal_handler_helper(None, this_frame)
+                Scalene.charge_overhead("collector", start, cpu_start)
+
+    @staticmethod
+    def should_trace_code(code: CodeType) -> bool:
+        """Return true if code is in a file we should trace."""
+        key = id(code)
+        traced = Scalene.__code_traced.get(key)
+        if traced is None:
+            traced = Scalene.should_trace(code.co_filename)
+            Scalene.__code_traced[key] = traced
+            Scalene.remember_code(code)
+        return traced
+
+    @staticmethod
+    def remember_code(code: CodeType) -> None:
+        """Drop what we cache about code when it goes away (its id
+        can then be reused)."""
+        key = id(code)
+        if key not in Scalene.__code_refs:
+            Scalene.__code_refs[key] = weakref.ref(
+                code, lambda _: Scalene.forget_code(key)
+            )
 
-        Scalene.__in_signal_handler.release()
+    @staticmethod
+    def forget_code(key: int) -> None:
+        Scalene.__code_traced.pop(key, None)
+        Scalene.__code_calls.pop(key, None)
+        Scalene.__code_refs.pop(key, None)
+
+    @staticmethod
+    def find_traced_frame(frame: Optional[FrameType]) -> Optional[FrameType]:
+        """The innermost frame at or above frame that we should trace."""
+        if not frame:
+            return None
+        back = frame.f_back
+        if not frame.f_code.co_filename and back:
+            # 'eval/compile' gives no f_code.co_filename; it belongs
+            # to whoever called it.
+            if Scalene.should_trace_code(back.f_code):
+                return frame
+            frame = back
+        # Walk the stack backwards until we hit a frame that IS one we
+        # should trace (if there is one).  i.e., if it's in the code
+        # being profiled, and it is just calling stuff deep in
+        # libraries.
+        code_traced = Scalene.__code_traced
+        while frame:
+            traced = code_traced.get(id(frame.f_code))
+            if traced is None:
+                traced = Scalene.should_trace_code(frame.f_code)
+            if traced:
+                return frame
+            frame = frame.f_back
+        return None
 
     @staticmethod
     @lru_cache(None)
@@ -996,6 +1639,8 @@ class Scalene:
         """Initiate profiling."""
         Scalene.enable_signals()
         Scalene.__start_time = Scalene.get_wallclock_time()
+        if not Scalene.__first_start_time:
+            Scalene.__first_start_time = Scalene.__start_time
 
     @staticmethod
     def stop() -> None:
@@ -1042,13 +1687,15 @@ class Scalene:
             + Scalene.__total_memory_malloc_samples
         ) > 0
         # Prepare output values.
-        n_cpu_samples_c = Scalene.__cpu_samples_c[fname][line_no]
+        n_cpu_samples_c = Scalene.__cpu_samples_c.get(fname, line_no)
         # Correct for negative CPU sample counts. This can happen
         # because of floating point inaccuracies, since we perform
         # subtraction to compute it.
         if n_cpu_samples_c < 0:
             n_cpu_samples_c = 0
-        n_cpu_samples_python = Scalene.__cpu_samples_python[fname][line_no]
+        n_cpu_samples_python = Scalene.__cpu_samples_python.get(
+            fname, line_no
+        )
 
         # Compute percentages of CPU time.
         if Scalene.__total_cpu_samples != 0:
@@ -1062,19 +1709,12 @@ class Scalene:
             n_cpu_percent_c = 0
             n_cpu_percent_python = 0
 
-        # Now, memory stats.
-        # Accumulate each one from every byte index.
-        n_malloc_mb = 0.0
-        n_python_malloc_mb = 0.0
-        n_free_mb = 0.0
-        for index in Scalene.__bytei_map[fname][line_no]:
-            mallocs = Scalene.__memory_malloc_samples[fname][line_no][index]
-            n_malloc_mb += mallocs
-            n_python_malloc_mb += Scalene.__memory_python_samples[fname][
-                line_no
-            ][index]
-            frees = Scalene.__memory_free_samples[fname][line_no][index]
-            n_free_mb += frees
+        # Now, memory stats (summed over every byte index).
+        n_malloc_mb = Scalene.__memory_malloc_samples.get(fname, line_no)
+        n_python_malloc_mb = Scalene.__memory_python_samples.get(
+            fname, line_no
+        )
+        n_free_mb = Scalene.__memory_free_samples.get(fname, line_no)
 
         n_usage_fraction = (
             0
@@ -1091,15 +1731,14 @@ class Scalene:
         if False:
             # Currently disabled; possibly use in another column?
             # Correct for number of samples
-            for bytei in Scalene.__memory_malloc_count[fname][line_no]:
-                n_malloc_mb /= Scalene.__memory_malloc_count[fname][line_no][
-                    bytei
-                ]
-                n_python_malloc_mb /= Scalene.__memory_malloc_count[fname][
-                    line_no
-                ][bytei]
-            for bytei in Scalene.__memory_free_count[fname][line_no]:
-                n_free_mb /= Scalene.__memory_free_count[fname][line_no][bytei]
+            for bytei in Scalene.__bytei_map[fname][line_no]:
+                count = Scalene.__memory_malloc_count.at(fname, line_no, bytei)
+                if count:
+                    n_malloc_mb /= count
+                    n_python_malloc_mb /= count
+                count = Scalene.__memory_free_count.at(fname, line_no, bytei)
+                if count:
+                    n_free_mb /= count
 
         n_growth_mb = n_malloc_mb - n_free_mb
         if -1 < n_growth_mb < 0:
@@ -1130,7 +1769,7 @@ class Scalene:
             if n_python_fraction < 0.5
             else "%5.0f%%" % (100 * n_python_fraction)
         )
-        n_copy_b = Scalene.__memcpy_samples[fname][line_no]
+        n_copy_b = Scalene.__memcpy_samples.get(fname, line_no)
         n_copy_mb_s = n_copy_b / (1024 * 1024 * Scalene.__elapsed_time)
         n_copy_mb_s_str: str = (
             "" if n_copy_mb_s < 0.5 else "%6.0f" % n_copy_mb_s
@@ -1155,12 +1794,14 @@ class Scalene:
         if did_sample_memory:
             spark_str: str = ""
             # Scale the sparkline by the usage fraction.
-            samples = Scalene.__per_line_footprint_samples[fname][line_no]
-            for i in range(0, len(samples.get())):
-                samples.get()[i] *= n_usage_fraction
-            if samples.get():
+            samples = Scalene.__per_line_footprint_samples[fname].get(
+                line_no
+            )
+            if samples and samples.len():
                 _, _, spark_str = sparkline.generate(
-                    samples.get()[0 : samples.len()], 0, current_max
+                    [v * n_usage_fraction for v in samples.get()],
+                    0,
+                    current_max,
                 )
 
             # Red highlight
@@ -1194,6 +1835,8 @@ class Scalene:
                     n_copy_mb_s_str,
                     line,
                 )
+                if n_cpu_percent_c_str:
+                    Scalene.output_native_symbols(fname, line_no, tbl)
                 return True
             else:
                 return False
@@ -1218,10 +1861,99 @@ class Scalene:
                     sys_str,
                     line,
                 )
+                if n_cpu_percent_c_str:
+                    Scalene.output_native_symbols(fname, line_no, tbl)
                 return True
             else:
                 return False
 
+    @staticmethod
+    def output_functions(
+        fname: Filename,
+        title: str,
+        console: Console,
+        did_sample_memory: bool,
+        column_width: int,
+    ) -> bool:
+        """Print the top functions in fname by each metric, if there are
+        at least two functions to compare. Returns true if we did."""
+        metrics = [PYTHON_TIME, NATIVE_TIME]
+        if did_sample_memory:
+            metrics += [NET_MEMORY, COPY_VOLUME]
+        stats = Scalene.__function_stats
+        functions = stats.top(fname, metrics, Scalene.__functions_shown)
+        if len(functions) < 2:
+            return False
+        tbl = Table(
+            box=box.MINIMAL_HEAVY_HEAD,
+            title=title,
+            collapse_padding=True,
+            width=column_width - 1,
+        )
+        tbl.add_column("Line", justify="right", no_wrap=True)
+        tbl.add_column("Time %\nPython", no_wrap=True)
+        tbl.add_column("Time %\nnative", no_wrap=True)
+        other_columns_width = 28  # Size taken up by all columns BUT names
+        if did_sample_memory:
+            tbl.add_column("Net\n(MB)", no_wrap=True)
+            tbl.add_column("Copy\n(MB/s)", no_wrap=True)
+            other_columns_width = 46
+        tbl.add_column(
+            "\nfunction",
+            width=column_width - other_columns_width,
+            no_wrap=True,
+        )
+        for function in functions:
+            (name, firstline) = function
+            totals = stats.get(fname, function)
+            row = [
+                str(firstline),
+                "%5.0f%%"
+                % (100 * totals[PYTHON_TIME] / Scalene.__total_cpu_samples)
+                if Scalene.__total_cpu_samples
+                else "",
+                "%6.0f%%"
+                % (100 * totals[NATIVE_TIME] / Scalene.__total_cpu_samples)
+                if Scalene.__total_cpu_samples
+                else "",
+            ]
+            if did_sample_memory:
+                row += [
+                    "%5.0f" % totals[NET_MEMORY],
+                    "%6.0f"
+                    % (
+                        totals[COPY_VOLUME]
+                        / (1024 * 1024 * Scalene.__elapsed_time)
+                    ),
+                ]
+            tbl.add_row(*row, name)
+        console.print(tbl)
+        return True
+
+    @staticmethod
+    def output_native_symbols(
+        fname: Filename, line_no: LineNumber, tbl: Table
+    ) -> None:
+        """Break a line's native time down by the native functions it
+        went to (with --native-symbols), in rows beneath it."""
+        samples = Scalene.__native_samples.get(fname, {}).get(line_no)
+        if not samples:
+            return
+        total = sum(samples.values())
+        top = sorted(samples.items(), key=lambda item: item[1], reverse=True)
+        for (symbol, obj), count in top[: Scalene.__native_symbols_shown]:
+            share = count / total
+            if share < 0.01:
+                break
+            tbl.add_row(
+                *([""] * (len(tbl.columns) - 1)),
+                Text.assemble(
+                    ("  \u21b3 %3.0f%% " % (100 * share), "dim"),
+                    (symbol, "bold"),
+                    (" (%s)" % obj, "dim"),
+                ),
+            )
+
     @staticmethod
     def output_stats(pid: int) -> None:
         payload: List[Any] = []
@@ -1241,6 +1973,11 @@ class Scalene:
             Scalene.__total_memory_free_samples,
             Scalene.__total_memory_malloc_samples,
             Scalene.__memory_footprint_samples,
+            Scalene.count_samples(),
+            Scalene.__overhead,
+            Scalene.__native_samples,
+            Scalene.__stacks,
+            Scalene.__function_stats,
         ]
         # To be added: __malloc_samples
 
@@ -1254,11 +1991,16 @@ class Scalene:
 
     @staticmethod
     def merge_stats() -> None:
+        start = Scalene.get_wallclock_time()
         the_dir = pathlib.Path(Scalene.__python_alias_dir_name)
         for f in list(the_dir.glob("**/scalene*")):
             # Skip empty files.
             if os.path.getsize(f) == 0:
                 continue
+            # Named scalene<our pid>-<its pid>.
+            child = f.name.rpartition("-")[2]
+            if child.isdigit() and int(child) not in Scalene.__child_pids:
+                Scalene.__child_pids.append(int(child))
             with open(f, "rb") as file:
                 unpickler = pickle.Unpickler(file)
                 value = unpickler.load()
@@ -1268,27 +2010,21 @@ class Scalene:
                 Scalene.__elapsed_time = max(Scalene.__elapsed_time, value[1])
                 Scalene.__total_cpu_samples += value[2]
                 del value[:3]
-                for dict, index in [
+                for column, index in [
                     (Scalene.__cpu_samples_c, 0),
                     (Scalene.__cpu_samples_python, 1),
-                    (Scalene.__memcpy_samples, 7),
-                    (Scalene.__per_line_footprint_samples, 8),
-                ]:
-                    for fname in value[index]:
-                        for lineno in value[index][fname]:
-                            v = value[index][fname][lineno]
-                            dict[fname][lineno] += v  # type: ignore
-                for dict, index in [
                     (Scalene.__memory_malloc_samples, 4),
                     (Scalene.__memory_python_samples, 5),
                     (Scalene.__memory_free_samples, 6),
+                    (Scalene.__memcpy_samples, 7),
                 ]:
-                    for fname in value[index]:
-                        for lineno in value[index][fname]:
-                            for ind in value[index][fname][lineno]:
-                                dict[fname][lineno][ind] += value[index][
-                                    fname
-                                ][lineno][ind]
+                    column.merge(value[index])
+                for fname in value[8]:
+                    for lineno in value[8][fname]:
+                        v = value[8][fname][lineno]
+                        Scalene.__per_line_footprint_samples[fname][
+                            lineno
+                        ] += v
                 for fname in value[2]:
                     for lineno in value[2][fname]:
                         v = value[2][fname][lineno]
@@ -1298,7 +2034,20 @@ class Scalene:
                 Scalene.__total_memory_free_samples += value[9]
                 Scalene.__total_memory_malloc_samples += value[10]
                 Scalene.__memory_footprint_samples += value[11]
+                for i, v in enumerate(value[12]):
+                    Scalene.__child_sample_counters[i] += v
+                Scalene.__overhead.merge(value[13])
+                for fname in value[14]:
+                    for lineno in value[14][fname]:
+                        for symbol, count in value[14][fname][lineno].items():
+                            Scalene.__native_samples[fname][lineno][
+                                symbol
+                            ] += count
+                if Scalene.__stacks and value[15]:
+                    Scalene.__stacks.merge(value[15])
+                Scalene.__function_stats.merge(value[16])
             os.remove(f)
+        Scalene.charge_overhead("merging stats", start)
 
     @staticmethod
     def output_profiles() -> bool:
@@ -1316,17 +2065,26 @@ class Scalene:
             # Nothing to output.
             return False
         # Collect all instrumented filenames.
-        all_instrumented_files: List[Filename] = list(
-            set(
-                list(Scalene.__cpu_samples_python.keys())
-                + list(Scalene.__cpu_samples_c.keys())
-                + list(Scalene.__memory_free_samples.keys())
-                + list(Scalene.__memory_malloc_samples.keys())
+        all_instrumented_files: List[Filename] = [
+            Filename(fname)
+            for fname in set(
+                Scalene.__cpu_samples_python.fnames()
+                + Scalene.__cpu_samples_c.fnames()
+                + Scalene.__memory_free_samples.fnames()
+                + Scalene.__memory_malloc_samples.fnames()
             )
-        )
+        ]
         if not all_instrumented_files:
             # We didn't collect samples in source files.
             return False
+        if Scalene.__json and not Scalene.__pid:
+            Scalene.output_json(
+                sorted(
+                    all_instrumented_files,
+                    key=lambda f: (-(Scalene.__cpu_samples[f]), f),
+                )
+            )
+            return True
         # If I have at least one memory sample, then we are profiling memory.
         did_sample_memory: bool = (
             Scalene.__total_memory_free_samples
@@ -1428,6 +2186,12 @@ class Scalene:
             # Only display total memory usage once.
             mem_usage_line = ""
 
+            if Scalene.output_functions(
+                fname, new_title, console, did_sample_memory, column_width
+            ):
+                # The function summary took the title.
+                new_title = ""
+
             tbl = Table(
                 box=box.MINIMAL_HEAVY_HEAD,
                 title=new_title,
@@ -1509,6 +2273,10 @@ class Scalene:
 
             console.print(tbl)
 
+        if Scalene.__stacks:
+            Scalene.output_stacks(console)
+        Scalene.output_footer(console)
+
         if Scalene.__html:
             # Write HTML file.
             md = Markdown(
@@ -1529,9 +2297,293 @@ class Scalene:
                 )
         return True
 
+    @staticmethod
+    def output_json(fnames: List[Filename]) -> None:
+        """Write every counter out as JSON, one file at a time."""
+        out = (
+            open(Scalene.__output_file, "w")
+            if Scalene.__output_file
+            else sys.stdout
+        )
+        records, signals, dropped = Scalene.count_samples()
+        metadata = {
+            "program": sys.argv[0],
+            "argv": sys.argv[1:],
+            "pid": os.getpid(),
+            "children": Scalene.__child_pids,
+            "python": platform.python_version(),
+            "platform": sys.platform,
+            "elapsed_s": Scalene.__elapsed_time,
+            "cpu_sampling_rate_s": Scalene.__mean_cpu_sampling_rate,
+            "malloc_sampling_rate_bytes": Scalene.__malloc_sampling_rate,
+            "memcpy_sampling_rate_bytes": Scalene.__memcpy_sampling_rate,
+            "memory_profiled": (
+                Scalene.__total_memory_free_samples
+                + Scalene.__total_memory_malloc_samples
+            )
+            > 0,
+            "total_cpu_s": Scalene.__total_cpu_samples,
+            "total_malloc_mb": Scalene.__total_memory_malloc_samples,
+            "total_free_mb": Scalene.__total_memory_free_samples,
+            "max_footprint_mb": Scalene.__max_footprint,
+            "footprint": Scalene.json_timeline(
+                Scalene.__memory_footprint_samples
+            ),
+            "samples": {
+                "records": records,
+                "signals": signals,
+                "dropped": dropped,
+            },
+            "overhead": {
+                name: {"count": timer.count, "total_s": timer.total}
+                for name, timer in Scalene.__overhead.timers.items()
+            },
+        }
+        try:
+            writer = ProfileWriter(out, metadata)
+            for fname in fnames:
+                writer.add_file(Scalene.json_file(fname))
+            writer.close()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    @staticmethod
+    def json_timeline(samples: Adaptive) -> List[List[float]]:
+        """A footprint timeline as [seconds since we started, MB] pairs."""
+        return [
+            [t - Scalene.__first_start_time, v] for (t, v) in samples.samples()
+        ]
+
+    @staticmethod
+    def json_file(fname: Filename) -> Dict[str, Any]:
+        """Every counter for fname and its lines (see
+        scalene/jsonprofile.py)."""
+        stats = Scalene.__function_stats
+        functions = [
+            {
+                "name": name,
+                "first_line": first_line,
+                "python_s": totals[PYTHON_TIME],
+                "native_s": totals[NATIVE_TIME],
+                "net_mb": totals[NET_MEMORY],
+                "copy_bytes": totals[COPY_VOLUME],
+            }
+            for ((name, first_line), totals) in sorted(
+                stats.totals.get(fname, {}).items()
+            )
+        ]
+        line_numbers: Set[int] = set()
+        for column in [
+            Scalene.__cpu_samples_python,
+            Scalene.__cpu_samples_c,
+            Scalene.__memory_malloc_samples,
+            Scalene.__memory_free_samples,
+            Scalene.__memcpy_samples,
+        ]:
+            line_numbers.update(line for (line, _) in column.lines(fname))
+        lines = []
+        python_samples = Scalene.__memory_python_samples
+        for line_no in sorted(line_numbers):
+            utilization = Scalene.__cpu_utilization[fname][LineNumber(line_no)]
+            footprint = Scalene.__per_line_footprint_samples[fname].get(
+                line_no
+            )
+            function = stats.function_of(fname, line_no)
+            lines.append(
+                {
+                    "lineno": line_no,
+                    "function": list(function) if function else None,
+                    "python_s": Scalene.__cpu_samples_python.get(
+                        fname, line_no
+                    ),
+                    "native_s": Scalene.__cpu_samples_c.get(fname, line_no),
+                    "utilization": {
+                        "samples": utilization.size(),
+                        "mean": utilization.mean(),
+                        "sem": utilization.sem()
+                        if utilization.size() > 1
+                        else 0.0,
+                    },
+                    "malloc_mb": Scalene.__memory_malloc_samples.get(
+                        fname, line_no
+                    ),
+                    "python_malloc_mb": python_samples.get(fname, line_no),
+                    "free_mb": Scalene.__memory_free_samples.get(
+                        fname, line_no
+                    ),
+                    "malloc_count": Scalene.__memory_malloc_count.get(
+                        fname, line_no
+                    ),
+                    "free_count": Scalene.__memory_free_count.get(
+                        fname, line_no
+                    ),
+                    "copy_bytes": Scalene.__memcpy_samples.get(
+                        fname, line_no
+                    ),
+                    "leak_score": Scalene.__leak_score.get(fname, line_no),
+                    "footprint": Scalene.json_timeline(footprint)
+                    if footprint
+                    else [],
+                    "bytecode": [
+                        {
+                            "offset": bytei,
+                            "malloc_mb": Scalene.__memory_malloc_samples.at(
+                                fname, line_no, bytei
+                            ),
+                            "python_malloc_mb": python_samples.at(
+                                fname, line_no, bytei
+                            ),
+                            "free_mb": Scalene.__memory_free_samples.at(
+                                fname, line_no, bytei
+                            ),
+                            "malloc_count": Scalene.__memory_malloc_count.at(
+                                fname, line_no, bytei
+                            ),
+                            "free_count": Scalene.__memory_free_count.at(
+                                fname, line_no, bytei
+                            ),
+                        }
+                        for bytei in sorted(
+                            Scalene.__bytei_map[fname].get(line_no, ())
+                        )
+                    ],
+                    "native_symbols": [
+                        {"symbol": symbol, "object": obj, "samples": count}
+                        for ((symbol, obj), count) in sorted(
+                            Scalene.__native_samples.get(fname, {})
+                            .get(line_no, {})
+                            .items(),
+                            key=lambda item: -item[1],
+                        )
+                    ],
+                }
+            )
+        return {
+            "filename": fname,
+            "cpu_s": Scalene.__cpu_samples[fname],
+            "malloc_samples": Scalene.__malloc_samples[fname],
+            "functions": functions,
+            "lines": lines,
+        }
+
+    @staticmethod
+    def count_samples() -> List[int]:
+        """Memory samples written by libscalene, the signals raised to
+        announce them, and the samples dropped because a ring was full,
+        in this process and its children."""
+        counters = list(Scalene.__child_sample_counters)
+        for samplefile in [
+            Scalene.__malloc_samplefile,
+            Scalene.__memcpy_samplefile,
+        ]:
+            for i, v in enumerate(samplefile.counters()):
+                counters[i] += v
+        return counters
+
+    @staticmethod
+    def output_overhead(console: Console) -> None:
+        """Report how much time Scalene spent on its own work."""
+        overhead = Scalene.__overhead
+        if Scalene.__elapsed_time > 0:
+            console.print(
+                "Scalene overhead: %.3fs (%.1f%% of %.2fs elapsed)."
+                % (
+                    overhead.total(),
+                    100 * overhead.total() / Scalene.__elapsed_time,
+                    Scalene.__elapsed_time,
+                )
+            )
+        for name, timer in overhead.timers.items():
+            if not timer.count and not timer.skipped:
+                continue
+            line = "  %s: %d calls, %.3fs total, p99 %.2fms" % (
+                name,
+                timer.count,
+                timer.total,
+                1000 * timer.percentile(0.99),
+            )
+            if timer.skipped:
+                line += ", %d skipped (handler busy)" % timer.skipped
+            console.print(line)
+
+    @staticmethod
+    def output_stacks(console: Console) -> None:
+        """Write the sampled stacks out as collapsed stacks, and show the
+        callers of the lines with the most CPU time and net allocation."""
+        stacks = cast(StackTable, Scalene.__stacks)
+        # Collapsed stacks count whole units: milliseconds and KB.
+        for metric, scale, unit, title in [
+            (CPU, 1000, "ms", "CPU time"),
+            (MALLOC, 1024, "KB", "net memory allocation"),
+        ]:
+            lines = stacks.collapsed(metric, scale)
+            if not lines:
+                continue
+            out_fname = "%s.%s.collapsed" % (Scalene.__stacks_prefix, metric)
+            try:
+                with open(out_fname, "w") as out_file:
+                    out_file.write("\n".join(lines) + "\n")
+                saved = "; stacks (in %s) saved to %s" % (unit, out_fname)
+            except OSError as e:
+                saved = "; could not save stacks: %s" % e
+            console.print(
+                Text.assemble(
+                    ("Callers of the lines with the most %s" % title, "bold"),
+                    saved,
+                )
+            )
+            for line in stacks.format_callers(
+                metric, roots=5, min_percent=1, max_depth=8
+            ):
+                console.print(Text(line), no_wrap=True)
+            console.print("")
+
+    @staticmethod
+    def output_footer(console: Console) -> None:
+        """Print information about the profile itself after the tables."""
+        records, signals, dropped = Scalene.count_samples()
+        controller = Scalene.__overhead_controller
+        if controller:
+            console.print(
+                "Sampling intervals scaled by %.1fx to keep Scalene's overhead "
+                "within %g%% (last measured: %.1f%%)."
+                % (
+                    controller.scale,
+                    controller.budget * 100,
+                    controller.overhead * 100,
+                )
+            )
+        Scalene.output_overhead(console)
+        if signals and records > signals:
+            # Signals were coalesced (see --signal-batch-size).
+            console.print(
+                "Memory samples: %d delivered in %d batches "
+                "(batching factor %.1f; %d signal handler invocations saved)."
+                % (records, signals, records / signals, records - signals)
+            )
+        if dropped:
+            console.print(
+                Text.assemble(
+                    (
+                        "Scalene warning: %d memory samples were dropped "
+                        "because the sample buffer was full."
+                    )
+                    % dropped,
+                    style="bold red",
+                )
+            )
+
     @staticmethod
     def disable_signals() -> None:
         """Turn off the profiling signals."""
+        if Scalene.__collector_thread:
+            Scalene.set_notify_fd(-1)
+        if Scalene.__sampler_stop:
+            Scalene.__sampler_stop.set()
+            Scalene.__sampler_stop = None
+        if Scalene.__native_symbols:
+            Scalene.__native_symbols.stop()
         try:
             signal.setitimer(Scalene.__cpu_timer_signal, 0)
             signal.signal(Scalene.__malloc_signal, signal.SIG_IGN)
@@ -1605,6 +2657,14 @@ class Scalene:
             default=False,
             help="output as HTML (default: text)",
         )
+        parser.add_argument(
+            "--json",
+            dest="json",
+            action="store_const",
+            const=True,
+            default=False,
+            help="output every counter as JSON, for other programs to read (see scalene/jsonprofile.py; default: text)",
+        )
         parser.add_argument(
             "--reduced-profile",
             dest="reduced_profile",
@@ -1657,6 +2717,104 @@ class Scalene:
             default=0.01,
             help="CPU sampling rate (default: every 0.01s)",
         )
+        parser.add_argument(
+            "--malloc-sampling-rate",
+            dest="malloc_sampling_rate",
+            type=int,
+            default=1048576,
+            help="memory sampling rate (default: every 1048576 bytes allocated or freed); samples are charged to the line that allocated on Linux with Python 3.9 to 3.11 (3.11 needs a libscalene built against 3.11's headers), and otherwise, including on 3.12 and later, to the line running when scalene reads them",
+        )
+        parser.add_argument(
+            "--memcpy-sampling-rate",
+            dest="memcpy_sampling_rate",
+            type=int,
+            default=2097152,
+            help="copy sampling rate (default: every 2097152 bytes copied)",
+        )
+        parser.add_argument(
+            "--max-overhead",
+            dest="max_overhead",
+            type=parse_percentage,
+            default=None,
+            metavar="PERCENT",
+            help="sample less often to keep Scalene's own overhead under this percentage, e.g. 2%% (default: no limit)",
+        )
+        parser.add_argument(
+            "--signal-batch-size",
+            dest="signal_batch_size",
+            type=int,
+            default=1,
+            help="deliver memory samples in batches of this many (default: 1, no batching)",
+        )
+        parser.add_argument(
+            "--signal-batch-time",
+            dest="signal_batch_time",
+            type=float,
+            default=0.01,
+            help="with batching, deliver memory samples at least every so many seconds (default: 0.01s)",
+        )
+        parser.add_argument(
+            "--collector",
+            dest="collector",
+            choices=["signal", "thread"],
+            default="signal",
+            help="consume memory samples in signal handlers or on a background thread (default: signal)",
+        )
+        parser.add_argument(
+            "--sampler",
+            dest="sampler",
+            choices=["signal", "thread"],
+            default="signal",
+            help="take CPU samples in the CPU timer's signal handler or on a sampler thread, which keeps sampling while the main thread is blocked in native code (default: signal)",
+        )
+        parser.add_argument(
+            "--native-symbols",
+            dest="native_symbols",
+            action="store_const",
+            const=True,
+            default=False,
+            help="sample native call stacks, and list the native functions each line's native time went to (Linux, not with --cpu-only; default: False)",
+        )
+        parser.add_argument(
+            "--functions",
+            dest="functions",
+            type=int,
+            default=5,
+            metavar="N",
+            help="above each file's lines, list the N functions with the most Python time, native time, net memory and copy volume (0 for none; default: 5)",
+        )
+        parser.add_argument(
+            "--stacks",
+            dest="stacks",
+            action="store_const",
+            const=True,
+            default=False,
+            help="record the call stack of every sample; write collapsed stacks (for flame graphs) to PREFIX.cpu.collapsed and PREFIX.malloc.collapsed, and show the callers of the hottest lines (default: False)",
+        )
+        parser.add_argument(
+            "--stacks-prefix",
+            dest="stacks_prefix",
+            type=str,
+            default="scalene-stacks",
+            metavar="PREFIX",
+            help="the PREFIX of the files --stacks writes (default: scalene-stacks)",
+        )
+        parser.add_argument(
+            "--threads",
+            dest="threads",
+            type=str,
+            default=None,
+            metavar="PATTERNS",
+            help="only sample threads whose names match one of these comma-separated patterns, e.g. 'MainThread,worker-*' (default: all threads)",
+        )
+        parser.add_argument(
+            "--exclude-threads",
+            dest="exclude_threads",
+            type=str,
+            default=None,
+            metavar="PATTERNS",
+            help="never sample threads whose names match one of these comma-separated patterns, e.g. 'ThreadPoolExecutor-*' (default: none)",
+        )
         parser.add_argument(
             "--malloc-threshold",
             dest="malloc_threshold",
@@ -1678,6 +2836,20 @@ class Scalene:
             sys.exit(-1)
         return args, left
 
+    @staticmethod
+    def native_settings(args: argparse.Namespace) -> Dict[str, str]:
+        """Environment variables that configure libscalene."""
+        return {
+            "SCALENE_SIGNAL_BATCH_SIZE": str(max(1, args.signal_batch_size)),
+            "SCALENE_SIGNAL_BATCH_TIME": str(args.signal_batch_time),
+            "SCALENE_MALLOC_SAMPLING_RATE": str(
+                max(1, args.malloc_sampling_rate)
+            ),
+            "SCALENE_MEMCPY_SAMPLING_RATE": str(
+                max(1, args.memcpy_sampling_rate)
+            ),
+        }
+
     @staticmethod
     def setup_preload(args: argparse.Namespace) -> None:
         # First, check that we are on a supported platform.
@@ -1707,6 +2879,8 @@ class Scalene:
             )
             and struct.calcsize("P") * 8 == 64
         ):
+            # libscalene reads its settings when it starts up.
+            os.environ.update(Scalene.native_settings(args))
             # Load the shared object on Linux.
             if sys.platform == "linux":
                 if ("LD_PRELOAD" not in os.environ) and (
@@ -1773,6 +2947,7 @@ class Scalene:
                 + Scalene.__output_profile_interval
             )
             Scalene.__html = args.html
+            Scalene.__json = args.json
             Scalene.__output_file = args.outfile
             Scalene.__profile_all = args.profile_all
             if args.reduced_profile:
@@ -0,0 +1,163 @@
+"""Call stacks for --stacks: which callers a line's time and memory
+came through.
+
+Each sample is charged to the traced portion of its thread's stack
+(the frames in code we profile, outermost first). Every distinct frame
+(file, function, line) and every distinct stack is interned once: a
+stack is its innermost frame plus the id of the stack that called it,
+so stacks that share callers share storage and a sample only costs a
+dictionary update. The stacks can be written out as collapsed-stack
+text (for flamegraph.pl, speedscope, etc.) or shown as a caller tree:
+the hottest lines, with the paths that led to them beneath.
+"""
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+# (file name, function name, line number)
+Frame = Tuple[str, str, int]
+
+# What we sample: CPU time (in seconds) and net allocation (in MB).
+CPU = "cpu"
+MALLOC = "malloc"
+METRICS = (CPU, MALLOC)
+
+# We keep at most this many of the innermost frames of a stack.
+MAX_DEPTH = 128
+
+
+def frame_name(frame: Frame) -> str:
+    fname, function, line = frame
+    return "%s (%s:%d)" % (function, fname, line)
+
+
+class CallerNode:
+    """A frame in the caller tree, with how much of a metric went
+    through it and the frames that called it."""
+
+    __slots__ = ("total", "callers")
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.callers: Dict[Frame, "CallerNode"] = defaultdict(CallerNode)
+
+
+class StackTable:
+    def __init__(self) -> None:
+        self.frames: List[Frame] = []
+        self.__frame_ids: Dict[Frame, int] = {}
+        # For each stack: the stack that called it (-1 for none) and
+        # its innermost frame.
+        self.parents = array("l")
+        self.leaves = array("l")
+        self.__stack_ids: Dict[Tuple[int, int], int] = {}
+        # metric -> stack id -> total
+        self.samples: Dict[str, Dict[int, float]] = {
+            metric: defaultdict(float) for metric in METRICS
+        }
+
+    def intern(self, stack: Iterable[Frame]) -> int:
+        """The id of stack (outermost frame first); -1 if it's empty."""
+        stack_id = -1
+        for frame in stack:
+            frame_id = self.__frame_ids.get(frame)
+            if frame_id is None:
+                frame_id = len(self.frames)
+                self.__frame_ids[frame] = frame_id
+                self.frames.append(frame)
+            key = (stack_id, frame_id)
+            stack_id = self.__stack_ids.get(key, -1)
+            if stack_id < 0:
+                stack_id = len(self.parents)
+                self.__stack_ids[key] = stack_id
+                self.parents.append(key[0])
+                self.leaves.append(frame_id)
+        return stack_id
+
+    def add(self, metric: str, stack: Iterable[Frame], value: float) -> None:
+        stack_id = self.intern(stack)
+        if stack_id >= 0:
+            self.samples[metric][stack_id] += value
+
+    def stack(self, stack_id: int) -> List[Frame]:
+        """The frames of a stack, outermost first."""
+        stack = []
+        while stack_id >= 0:
+            stack.append(self.frames[self.leaves[stack_id]])
+            stack_id = self.parents[stack_id]
+        stack.reverse()
+        return stack
+
+    def merge(self, other: "StackTable") -> None:
+        for metric, samples in other.samples.items():
+            for stack_id, value in samples.items():
+                self.add(metric, other.stack(stack_id), value)
+
+    def total(self, metric: str) -> float:
+        """The total of a metric over every stack, counting only the
+        stacks where it is positive (for net allocation)."""
+        return sum(v for v in self.samples[metric].values() if v > 0)
+
+    def collapsed(self, metric: str, scale: float) -> List[str]:
+        """The stacks with a positive total of metric, in collapsed-stack
+        format: frames separated by semicolons, outermost first, then
+        the total times scale, rounded."""
+        lines = []
+        for stack_id, value in self.samples[metric].items():
+            count = round(value * scale)
+            if count > 0:
+                lines.append(
+                    "%s %d"
+                    % (";".join(map(frame_name, self.stack(stack_id))), count)
+                )
+        lines.sort()
+        return lines
+
+    def callers(self, metric: str) -> Dict[Frame, CallerNode]:
+        """The inverted tree of the stacks with a positive total of
+        metric: innermost frames at the root, their callers beneath."""
+        roots: Dict[Frame, CallerNode] = defaultdict(CallerNode)
+        for stack_id, value in self.samples[metric].items():
+            if value <= 0:
+                continue
+            nodes = roots
+            while stack_id >= 0:
+                node = nodes[self.frames[self.leaves[stack_id]]]
+                node.total += value
+                nodes = node.callers
+                stack_id = self.parents[stack_id]
+        return roots
+
+    def format_callers(
+        self, metric: str, roots: int, min_percent: float, max_depth: int
+    ) -> List[str]:
+        """The caller tree as indented text: the roots innermost frames
+        with the largest share of metric, and the callers beneath each
+        that account for at least min_percent of it, up to max_depth
+        callers deep."""
+        total = self.total(metric)
+        if total <= 0:
+            return []
+        lines: List[str] = []
+
+        def show(nodes: Dict[Frame, CallerNode], depth: int) -> None:
+            for frame, node in sorted(
+                nodes.items(), key=lambda item: -item[1].total
+            ):
+                percent = 100 * node.total / total
+                if depth and percent < min_percent:
+                    break
+                lines.append(
+                    "%s%5.1f%%  %s" % ("  " * depth, percent, frame_name(frame))
+                )
+                if depth < max_depth:
+                    show(node.callers, depth + 1)
+
+        tree = self.callers(metric)
+        show(
+            dict(
+                sorted(tree.items(), key=lambda item: -item[1].total)[:roots]
+            ),
+            0,
+        )
+        return lines
@@ -0,0 +1,69 @@
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class ThreadClocks:
+    """How much CPU time each thread used between samples, read from
+    its own CPU clock (pthread_getcpuclockid).
+
+    Clock ids are looked up while the thread is running (so its pthread
+    handle is still valid) and then cached; reading the clock of a
+    thread that has since exited fails instead of touching freed memory.
+
+    A thread is only charged for the time since the previous sample if
+    it was seen then too: time it spent outside the code we trace in
+    between is not its line's."""
+
+    # Not every platform (e.g., macOS) has per-thread CPU clocks.
+    available = hasattr(time, "pthread_getcpuclockid")
+
+    def __init__(self) -> None:
+        self.__tick = 0
+        # by thread ident
+        self.__clocks: Dict[int, int] = {}
+        # (tick, CPU time) when we last read each thread's clock
+        self.__last: Dict[int, Tuple[int, float]] = {}
+
+    def tick(self) -> None:
+        """Start a new sample."""
+        self.__tick += 1
+
+    def elapsed(self, tident: int) -> Optional[float]:
+        """The CPU time the (running) thread tident used since the
+        previous sample (0 if it wasn't seen then), or None if we can't
+        tell."""
+        if not self.available:
+            return None
+        now = self.__read(tident)
+        if now is None:
+            # Its ident was reused by a new thread: start over.
+            self.forget(tident)
+            now = self.__read(tident)
+            if now is None:
+                return None
+        tick, last = self.__last.get(tident, (-1, now))
+        self.__last[tident] = (self.__tick, now)
+        if tick != self.__tick - 1:
+            return 0.0
+        return max(0.0, now - last)
+
+    def __read(self, tident: int) -> Optional[float]:
+        try:
+            clock = self.__clocks.get(tident)
+            if clock is None:
+                clock = time.pthread_getcpuclockid(tident)
+                self.__clocks[tident] = clock
+            return time.clock_gettime(clock)
+        except OSError:
+            return None
+
+    def forget(self, tident: int) -> None:
+        self.__clocks.pop(tident, None)
+        self.__last.pop(tident, None)
+
+    def retain(self, tidents: Iterable[int]) -> None:
+        """Forget every thread not in tidents (they have exited)."""
+        live = set(tidents)
+        for tident in list(self.__clocks):
+            if tident not in live:
+                self.forget(tident)
@@ -0,0 +1,46 @@
+from scalene.adaptive import Adaptive
+
+
+def test_keeps_every_sample_until_full():
+    samples = Adaptive(9)
+    for i in range(8):
+        samples.add(float(i), float(i))
+
+    assert samples.get() == [float(i) for i in range(8)]
+    assert samples.get_times() == [float(i) for i in range(8)]
+
+
+def test_decimates_to_medians_of_three():
+    samples = Adaptive(9)
+    for value in [5, 1, 3, 9, 7, 8, 2, 4, 6]:
+        samples.add(float(value), float(samples.len()))
+
+    assert samples.get() == [3.0, 8.0, 4.0]
+    assert samples.len() == 3
+
+
+def test_stays_bounded_and_evenly_spread():
+    samples = Adaptive(27)
+    for i in range(10000):
+        samples.add(float(i), float(i))
+
+    assert samples.len() <= 27
+    times = samples.get_times()
+    assert times == sorted(times)
+    # The kept samples span the whole timeline, not just its start.
+    assert times[-1] > 5000
+
+
+def test_merge_aligns_timelines():
+    parent = Adaptive(27)
+    parent.add(10.0, 1.0)
+    parent.add(20.0, 3.0)
+    child = Adaptive(27)
+    child.add(5.0, 2.0)
+    child.add(0.0, 4.0)
+
+    parent += child
+
+    assert parent.get_times() == [1.0, 2.0, 3.0, 4.0]
+    assert parent.get() == [10.0, 15.0, 25.0, 20.0]
+    assert (parent + Adaptive(27)).get() == parent.get()
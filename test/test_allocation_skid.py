@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import scalene
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIBSCALENE = os.path.join(os.path.dirname(scalene.__file__), "libscalene.so")
+
+# Allocates on line 4, then spins without allocating, so samples that
+# are attributed when the signal handler runs land on the loop below.
+PROGRAM = """\
+def main():
+    keep = []
+    for i in range(400):
+        keep.append(b"x" * (2 * 1048576))
+        j = 0
+        while j < 200:
+            j += 1
+        if len(keep) > 8:
+            keep.clear()
+
+
+main()
+"""
+ALLOCATING_LINE = 4
+
+
+@pytest.fixture(scope="module")
+def libscalene():
+    """Build libscalene from this tree, so we test its frame capture
+    rather than whatever library happens to be installed."""
+    if not os.path.isdir(os.path.join(ROOT, "Heap-Layers")):
+        pytest.skip("building libscalene needs Heap-Layers (see GNUmakefile)")
+    # For this Python's headers (include/pythonframe.hpp).
+    subprocess.run(
+        ["make", "-C", ROOT, "PYTHON=" + sys.executable],
+        check=True,
+        timeout=600,
+    )
+    return LIBSCALENE
+
+
+def net_memory_by_line(profile):
+    """The Net (MB) column of a text profile, as {line: MB}."""
+    rows = [line.split("│") for line in profile.splitlines()]
+    net = None
+    result = {}
+    for row in rows:
+        cells = [cell.strip() for cell in row]
+        if net is None:
+            if "Net" in cells:
+                net = cells.index("Net")
+            continue
+        if len(cells) > net and cells[0].isdigit() and cells[net]:
+            result[int(cells[0])] = float(cells[net])
+    return result
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux")
+    or not (3, 9) <= sys.version_info < (3, 12),
+    reason="libscalene only captures Python frames on Linux, 3.9 to 3.11",
+)
+def test_allocations_do_not_skid(libscalene, tmp_path):
+    program = tmp_path / "skid.py"
+    program.write_text(PROGRAM)
+    outfile = tmp_path / "profile.txt"
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "scalene",
+            "--malloc-threshold=1",
+            "--outfile",
+            str(outfile),
+            str(program),
+        ],
+        check=True,
+        timeout=300,
+    )
+    net = net_memory_by_line(outfile.read_text())
+
+    allocated = sum(mb for mb in net.values() if mb > 0)
+    assert allocated > 0
+    skid = allocated - max(0, net.get(ALLOCATING_LINE, 0))
+    assert skid / allocated < 0.1
@@ -0,0 +1,48 @@
+import os
+import signal
+import sys
+import threading
+
+from scalene.overhead import OverheadStats
+from scalene.scalene_profiler import Scalene
+
+
+def test_cpu_samples_not_skipped_while_collecting(monkeypatch):
+    collecting = threading.Event()
+    finish = threading.Event()
+
+    def drain(_signum, _frame):
+        collecting.set()
+        finish.wait()
+
+    samples = []
+    monkeypatch.setattr(Scalene, "allocation_signal_handler", drain)
+    monkeypatch.setattr(
+        Scalene, "memcpy_signal_handler_helper", lambda _s, _f: None
+    )
+    monkeypatch.setattr(
+        Scalene,
+        "cpu_signal_handler_helper",
+        lambda _s, frame: samples.append(frame),
+    )
+    overhead = OverheadStats()
+    monkeypatch.setattr(Scalene, "_Scalene__overhead", overhead)
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr(
+        Scalene, "_Scalene__collector_pipe", (read_fd, write_fd)
+    )
+    collector = threading.Thread(target=Scalene.collector_loop)
+    collector.start()
+    os.write(write_fd, b"x")
+    collecting.wait()
+    # The collector is busy until this goes off; the CPU sample waits
+    # for it.
+    threading.Timer(0.05, finish.set).start()
+    Scalene.cpu_signal_handler(signal.SIGVTALRM, sys._getframe())
+    os.close(write_fd)
+    collector.join()
+    os.close(read_fd)
+    assert overhead["CPU handler"].skipped == 0
+    assert overhead["CPU handler"].count == 1
+    assert len(samples) == 1
+    assert overhead["collector"].count == 1
@@ -0,0 +1,32 @@
+from scalene import footprint
+from scalene.footprint import extremes, running_footprint
+
+
+def test_running_footprint():
+    assert running_footprint(10.0, [1.0, 2.0, -4.0]) == [11.0, 13.0, 9.0]
+    assert running_footprint(0.0, []) == []
+
+
+def test_running_footprint_large_batches_match():
+    deltas = [float(i % 7 - 3) for i in range(1000)]
+    expected = []
+    total = 5.0
+    for delta in deltas:
+        total += delta
+        expected.append(total)
+
+    assert running_footprint(5.0, deltas) == expected
+    if footprint.np is not None:
+        footprint.NUMPY_MIN_RECORDS, saved = 10 ** 9, footprint.NUMPY_MIN_RECORDS
+        try:
+            assert running_footprint(5.0, deltas) == expected
+        finally:
+            footprint.NUMPY_MIN_RECORDS = saved
+
+
+def test_extremes_in_order():
+    footprints = [5.0, 9.0, 1.0, 4.0, 3.0]
+
+    assert extremes(footprints, range(5)) == [1, 2, 4]
+    assert extremes(footprints, [0, 3]) == [0, 3]
+    assert extremes(footprints, [3]) == [3]
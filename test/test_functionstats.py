@@ -0,0 +1,68 @@
+import pickle
+
+from scalene.functionstats import (
+    COPY_VOLUME,
+    NATIVE_TIME,
+    NET_MEMORY,
+    PYTHON_TIME,
+    FunctionStats,
+)
+
+
+def f():
+    pass
+
+
+def g():
+    pass
+
+
+def h():
+    pass
+
+
+def add(stats, function, metric, v):
+    code = function.__code__
+    stats.add("prog.py", code.co_firstlineno + 1, code, metric, v)
+
+
+def test_totals_by_code_object():
+    stats = FunctionStats()
+    add(stats, f, PYTHON_TIME, 1.0)
+    add(stats, f, PYTHON_TIME, 0.5)
+    add(stats, f, NET_MEMORY, -2.0)
+    totals = stats.get("prog.py", ("f", f.__code__.co_firstlineno))
+    assert list(totals) == [1.5, 0.0, -2.0, 0.0]
+    assert list(stats.get("prog.py", ("nope", 1))) == [0.0] * 4
+    assert "other.py" not in stats.totals
+
+
+def test_top_by_each_metric():
+    stats = FunctionStats()
+    add(stats, f, PYTHON_TIME, 3.0)
+    add(stats, g, PYTHON_TIME, 1.0)
+    add(stats, g, NATIVE_TIME, 1.0)
+    add(stats, h, NET_MEMORY, 10.0)
+    add(stats, h, PYTHON_TIME, 0.5)
+    top = stats.top("prog.py", [PYTHON_TIME, NATIVE_TIME], 1)
+    assert [name for (name, _) in top] == ["f", "g"]
+    top = stats.top("prog.py", [PYTHON_TIME, NET_MEMORY, COPY_VOLUME], 1)
+    assert [name for (name, _) in top] == ["f", "h"]
+
+
+def test_merge():
+    parent, child = FunctionStats(), FunctionStats()
+    add(parent, f, PYTHON_TIME, 1.0)
+    add(child, f, PYTHON_TIME, 2.0)
+    add(child, g, COPY_VOLUME, 4.0)
+    parent.merge(pickle.loads(pickle.dumps(child)))
+    assert parent.get("prog.py", ("f", f.__code__.co_firstlineno))[0] == 3.0
+    assert parent.get("prog.py", ("g", g.__code__.co_firstlineno))[3] == 4.0
+
+
+def test_function_of_line():
+    stats = FunctionStats()
+    line = f.__code__.co_firstlineno + 1
+    stats.add("prog.py", line, f.__code__, COPY_VOLUME, 1.0)
+    assert stats.function_of("prog.py", line) == ("f", line - 1)
+    assert stats.function_of("prog.py", line + 1) is None
@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from scalene.jsonprofile import ProfileWriter, read_profile
+
+
+def write(tmp_path, files):
+    out = io.StringIO()
+    writer = ProfileWriter(out, {"elapsed_s": 1.5})
+    for profile in files:
+        writer.add_file(profile)
+    writer.close()
+    path = tmp_path / "profile.json"
+    path.write_text(out.getvalue())
+    return str(path), out.getvalue()
+
+
+@pytest.mark.parametrize("count", [0, 1, 3])
+def test_round_trip(tmp_path, count):
+    files = [{"filename": "f%d.py" % i, "lines": []} for i in range(count)]
+    path, text = write(tmp_path, files)
+    # It's one JSON document...
+    assert json.loads(text)["files"] == files
+    # ...that we can also read a file at a time.
+    metadata, read = read_profile(path)
+    assert metadata == {"elapsed_s": 1.5}
+    assert list(read) == files
+
+
+def test_reformatted(tmp_path):
+    files = [{"filename": "a.py", "lines": [{"lineno": 1}]}]
+    path, text = write(tmp_path, files)
+    with open(path, "w") as f:
+        json.dump(json.loads(text), f, indent=2)
+    metadata, read = read_profile(path)
+    assert list(read) == files
+
+
+def test_not_a_profile(tmp_path):
+    path = tmp_path / "other.json"
+    path.write_text('{"schema": "something else"}\n')
+    with pytest.raises(ValueError):
+        read_profile(str(path))
+    path.write_text("not json")
+    with pytest.raises(ValueError):
+        read_profile(str(path))
@@ -0,0 +1,48 @@
+import textwrap
+
+from scalene.lineranges import LineRanges, code_lines
+
+SOURCE = textwrap.dedent(
+    """\
+    import sys
+
+    @decorator
+    def decorated(x):
+        def inner():
+            return [y
+                    for y in range(x)]
+        # a comment
+        return inner()
+
+    def undecorated():
+        pass
+    """
+)
+
+
+def test_code_lines_cover_decorators_and_nested_code():
+    module = compile(SOURCE, "example.py", "exec")
+    decorated = next(
+        const
+        for const in module.co_consts
+        if getattr(const, "co_name", None) == "decorated"
+    )
+
+    first, last = code_lines(decorated)
+
+    assert last == 9
+    # 3.8+ starts at the decorator; older versions at the def.
+    assert first in (3, 4)
+
+
+def test_line_ranges():
+    ranges = LineRanges()
+    ranges.add(20, 30)
+    ranges.add(3, 9)
+    ranges.add(10, 12)
+    ranges.add(25, 40)
+
+    assert 3 in ranges and 9 in ranges and 12 in ranges
+    assert 2 not in ranges and 13 not in ranges and 19 not in ranges
+    assert 20 in ranges and 40 in ranges
+    assert 41 not in ranges
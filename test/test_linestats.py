@@ -0,0 +1,48 @@
+import pickle
+
+from scalene.linestats import ByteCodeColumn, FileIds, LineColumn
+
+
+def test_line_column():
+    files = FileIds()
+    column = LineColumn(files)
+    column.add("a.py", 10, 1.5)
+    column.add("a.py", 10, 0.5)
+    column.add("b.py", 3, 1.0)
+
+    assert column.get("a.py", 10) == 2.0
+    assert column.get("a.py", 11) == 0.0
+    assert column.get("c.py", 1) == 0.0
+    assert list(column.lines("a.py")) == [(10, 2.0)]
+    assert sorted(column.fnames()) == ["a.py", "b.py"]
+    assert 10 in column["a.py"] and 9 not in column["a.py"]
+
+
+def test_merge_across_file_ids():
+    ours = LineColumn(FileIds())
+    ours.add("a.py", 2, 1.0)
+    theirs = LineColumn(FileIds())
+    theirs.add("b.py", 5, 3.0)
+    theirs.add("a.py", 4, 2.0)
+
+    ours.merge(pickle.loads(pickle.dumps(theirs)))
+
+    assert ours.get("a.py", 2) == 1.0
+    assert ours.get("a.py", 4) == 2.0
+    assert ours.get("b.py", 5) == 3.0
+
+
+def test_bytecode_column():
+    files = FileIds()
+    column = ByteCodeColumn(files)
+    column.add_at("a.py", 7, 12, 1.0)
+    column.add_at("a.py", 7, 20, 2.0)
+    other = ByteCodeColumn(FileIds())
+    other.add_at("a.py", 7, 12, 4.0)
+
+    column.merge(other)
+
+    assert column.get("a.py", 7) == 7.0
+    assert column.at("a.py", 7, 12) == 5.0
+    assert column.at("a.py", 7, 20) == 2.0
+    assert column.at("a.py", 8, 12) == 0.0
@@ -0,0 +1,140 @@
+from scalene.overhead import (
+    HandlerTimer,
+    OverheadController,
+    OverheadStats,
+    parse_percentage,
+)
+from scalene.scalene_profiler import Scalene
+
+
+def run_window(controller, start, handler_time):
+    controller.add(handler_time)
+    return controller.update(start + controller.window)
+
+
+def test_over_budget_stretches_intervals():
+    controller = OverheadController(0.02)
+    controller.update(0.0)
+
+    assert run_window(controller, 0.0, 0.06)
+    assert controller.overhead == 0.06
+    assert controller.scale == 3.0
+
+
+def test_scale_grows_at_most_4x_per_window():
+    controller = OverheadController(0.02)
+    controller.update(0.0)
+
+    run_window(controller, 0.0, 0.5)
+
+    assert controller.scale == 4.0
+
+
+def test_under_budget_shrinks_back_but_not_below_1():
+    controller = OverheadController(0.02)
+    controller.update(0.0)
+    run_window(controller, 0.0, 0.08)
+    assert controller.scale == 4.0
+
+    assert run_window(controller, 1.0, 0.001)
+    assert controller.scale == 2.0
+    run_window(controller, 2.0, 0.001)
+    assert controller.scale == 1.0
+    assert not run_window(controller, 3.0, 0.0)
+    assert controller.scale == 1.0
+
+
+def test_within_budget_keeps_scale():
+    controller = OverheadController(0.02)
+    controller.update(0.0)
+
+    assert not run_window(controller, 0.0, 0.015)
+    assert controller.scale == 1.0
+
+
+def test_waits_for_a_full_window():
+    controller = OverheadController(0.02)
+    controller.update(0.0)
+    controller.add(0.5)
+
+    assert not controller.update(0.5)
+    assert controller.scale == 1.0
+
+
+class Clocks:
+    def __init__(self):
+        self.wall = 0.0
+        self.thread = 0.0
+
+
+class Rates:
+    def __init__(self):
+        self.rate = None
+        self.interval = None
+
+    def set_sampling_rate(self, rate):
+        self.rate = rate
+
+    def set_interval(self, interval):
+        self.interval = interval
+
+
+def test_drives_per_sample_cost_within_budget(monkeypatch):
+    clocks = Clocks()
+    rates = Rates()
+    controller = OverheadController(0.01)
+    monkeypatch.setattr(Scalene, "get_wallclock_time", lambda: clocks.wall)
+    monkeypatch.setattr(Scalene, "get_thread_time", lambda: clocks.thread)
+    monkeypatch.setattr(Scalene, "_Scalene__overhead", OverheadStats())
+    monkeypatch.setattr(Scalene, "_Scalene__overhead_controller", controller)
+    monkeypatch.setattr(Scalene, "_Scalene__mean_cpu_sampling_rate", 0.001)
+    monkeypatch.setattr(Scalene, "_Scalene__malloc_samplefile", rates)
+    monkeypatch.setattr(Scalene, "_Scalene__memcpy_samplefile", rates)
+    monkeypatch.setattr(Scalene, "_Scalene__native_symbols", rates)
+    controller.update(clocks.wall)
+    # Every sample costs 0.5ms of CPU (50% overhead at the configured
+    # 1ms interval), plus 2ms waiting for the GIL, which isn't overhead.
+    while clocks.wall < 20.0:
+        clocks.wall += 0.001 * controller.scale
+        start, cpu_start = clocks.wall, clocks.thread
+        clocks.thread += 0.0005
+        clocks.wall += 0.0025
+        Scalene.charge_overhead("CPU handler", start, cpu_start)
+        Scalene.adjust_sampling_rates()
+
+    assert controller.overhead <= controller.budget
+    assert 1.0 < controller.scale < controller.max_scale
+    assert rates.interval == 0.001 * controller.scale
+
+
+def test_parse_percentage():
+    assert parse_percentage("2%") == 0.02
+    assert parse_percentage("5") == 0.05
+
+
+def test_handler_timer_percentiles():
+    timer = HandlerTimer()
+    for _ in range(99):
+        timer.add(0.0001)
+    timer.add(0.01)
+
+    assert timer.count == 100
+    assert abs(timer.total - 0.0199) < 1e-9
+    # Upper bounds, within a bin (2 ** 0.25) of the true latency.
+    assert 0.0001 <= timer.percentile(0.99) < 0.0001 * 2 ** 0.25
+    assert 0.01 <= timer.percentile(1.0) < 0.01 * 2 ** 0.25
+
+
+def test_overhead_stats_merge():
+    stats, other = OverheadStats(), OverheadStats()
+    stats["CPU handler"].add(0.5)
+    other["CPU handler"].add(0.25)
+    other["CPU handler"].skip()
+    other["stack walks"].add(0.125)
+
+    stats.merge(other)
+
+    assert stats["CPU handler"].count == 2
+    assert stats["CPU handler"].skipped == 1
+    # Phases are part of the handlers' time, so they aren't added again.
+    assert stats.total() == 0.75
@@ -0,0 +1,103 @@
+import math
+
+import pytest
+
+from scalene import profilediff
+from scalene.jsonprofile import ProfileWriter
+
+
+def line(lineno, function, cpu, samples):
+    return {
+        "lineno": lineno,
+        "function": function,
+        "python_s": cpu,
+        "native_s": 0.0,
+        "utilization": {"samples": samples, "mean": 1.0, "sem": 0.0},
+        "malloc_mb": 0.0,
+        "python_malloc_mb": 0.0,
+        "free_mb": 0.0,
+        "malloc_count": 0,
+        "free_count": 0,
+        "copy_bytes": 0.0,
+        "leak_score": 0.0,
+        "footprint": [],
+        "bytecode": [],
+        "native_symbols": [],
+    }
+
+
+def write_profile(path, directory, first_line, hot_cpu):
+    """A profile of directory/prog.py, whose function hot starts at
+    first_line and spends hot_cpu seconds on its second line."""
+    metadata = {
+        "program": "%s/prog.py" % directory,
+        "cpu_sampling_rate_s": 0.01,
+        "memcpy_sampling_rate_bytes": 2097152,
+        "total_cpu_s": hot_cpu + 1.0,
+        "total_malloc_mb": 0.0,
+        "total_free_mb": 0.0,
+    }
+    with open(path, "w") as out:
+        writer = ProfileWriter(out, metadata)
+        writer.add_file(
+            {
+                "filename": "%s/prog.py" % directory,
+                "functions": [
+                    {"name": "hot", "first_line": first_line},
+                    {"name": "<module>", "first_line": 1},
+                ],
+                "lines": [
+                    line(
+                        first_line + 1,
+                        ["hot", first_line],
+                        hot_cpu,
+                        100 * hot_cpu,
+                    ),
+                    line(30, ["<module>", 1], 1.0, 100),
+                ],
+            }
+        )
+        writer.close()
+    return str(path)
+
+
+def test_matches_moved_lines(tmp_path, capsys):
+    old = write_profile(tmp_path / "old.json", "/a", 10, 1.0)
+    # Three lines were added above hot, in a copy of the program.
+    new = write_profile(tmp_path / "new.json", "/b", 13, 1.01)
+    assert profilediff.main([old, new]) == 0
+    out = capsys.readouterr().out
+    assert "prog.py:14 (hot+1)" in out
+    assert "No regressions." in out
+
+
+def test_regression(tmp_path, capsys):
+    old = write_profile(tmp_path / "old.json", "/a", 10, 1.0)
+    new = write_profile(tmp_path / "new.json", "/a", 10, 2.0)
+    assert profilediff.main([old, new]) == 1
+    out = capsys.readouterr().out
+    assert "Regressions" in out
+    assert "prog.py:hot" in out
+    # Not if the threshold is higher than the change.
+    assert profilediff.main([old, new, "--threshold", "60"]) == 0
+
+
+def test_noise_is_not_a_regression(tmp_path):
+    old = write_profile(tmp_path / "old.json", "/a", 10, 0.05)
+    new = write_profile(tmp_path / "new.json", "/a", 10, 0.08)
+    # A big change, but from just a few samples.
+    assert profilediff.main([old, new, "--threshold", "1"]) == 0
+
+
+def test_unreadable(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text("{}")
+    assert profilediff.main([str(path), str(path)]) == 2
+
+
+def test_z_score():
+    assert profilediff.z_score([1, 1, 100], [1, 1, 100]) == 0
+    assert profilediff.z_score([1, 1, 100], [2, 2, 100]) == pytest.approx(
+        1 / math.hypot(0.1, 0.2)
+    )
+    assert profilediff.z_score([0, 0, 0], [1, 0, 0]) == float("inf")
@@ -0,0 +1,174 @@
+import json
+
+import pytest
+
+from scalene import profilediff, profilemerge
+from scalene.jsonprofile import ProfileWriter, read_profile
+
+
+def write_run(path, directory, pid, cpu, malloc_mb=0.0):
+    """A run of directory/prog.py that spent cpu seconds on line 2 (and,
+    if cpu is 0, had no samples there)."""
+    metadata = {
+        "program": "%s/prog.py" % directory,
+        "argv": [],
+        "pid": pid,
+        "children": [],
+        "python": "3.x",
+        "platform": "linux",
+        "elapsed_s": 2.0,
+        "cpu_sampling_rate_s": 0.01,
+        "malloc_sampling_rate_bytes": 1048576,
+        "memcpy_sampling_rate_bytes": 2097152,
+        "memory_profiled": bool(malloc_mb),
+        "total_cpu_s": cpu + 1.0,
+        "total_malloc_mb": malloc_mb,
+        "total_free_mb": 0.0,
+        "max_footprint_mb": malloc_mb,
+        "footprint": [[0.0, malloc_mb]],
+        "samples": {"records": 1, "signals": 1, "dropped": 0},
+        "overhead": {"CPU handler": {"count": 10, "total_s": 0.5}},
+    }
+    lines = []
+    if cpu:
+        lines.append(
+            {
+                "lineno": 2,
+                "function": ["f", 1],
+                "python_s": cpu,
+                "native_s": 0.0,
+                "utilization": {"samples": 4, "mean": 0.5, "sem": 0.0},
+                "malloc_mb": malloc_mb,
+                "python_malloc_mb": 0.0,
+                "free_mb": 0.0,
+                "malloc_count": 1 if malloc_mb else 0,
+                "free_count": 0,
+                "copy_bytes": 0.0,
+                "leak_score": 0.0,
+                "footprint": [[0.0, malloc_mb]],
+                "bytecode": [
+                    {
+                        "offset": 4,
+                        "malloc_mb": malloc_mb,
+                        "python_malloc_mb": 0.0,
+                        "free_mb": 0.0,
+                        "malloc_count": 1,
+                        "free_count": 0,
+                    }
+                ],
+                "native_symbols": [
+                    {"symbol": "memcpy", "object": "libc.so.6", "samples": 2}
+                ],
+            }
+        )
+    with open(path, "w") as out:
+        writer = ProfileWriter(out, metadata)
+        writer.add_file(
+            {
+                "filename": "%s/prog.py" % directory,
+                "cpu_s": cpu + 1.0,
+                "malloc_samples": 1.0,
+                "functions": [
+                    {
+                        "name": "f",
+                        "first_line": 1,
+                        "python_s": cpu,
+                        "native_s": 0.0,
+                        "net_mb": malloc_mb,
+                        "copy_bytes": 0.0,
+                    }
+                ],
+                "lines": lines,
+            }
+        )
+        writer.close()
+    return str(path)
+
+
+def merge(tmp_path, paths, name="merged.json", jobs=1):
+    out = str(tmp_path / name)
+    assert profilemerge.main(paths + ["-o", out, "-j", str(jobs)]) == 0
+    return out
+
+
+def read(path):
+    metadata, files = read_profile(path)
+    return metadata, list(files)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_merge(tmp_path, jobs):
+    # Runs from different checkouts; the last had no samples on line 2.
+    paths = [
+        write_run(tmp_path / "a.json", "/host1/job", 1, 1.0, 2.0),
+        write_run(tmp_path / "b.json", "/host2/job", 2, 3.0),
+        write_run(tmp_path / "c.json", "/host3/job", 3, 0.0),
+    ]
+    metadata, files = read(merge(tmp_path, paths, jobs=jobs))
+    assert metadata["runs"] == 3
+    assert [s["pid"] for s in metadata["sources"]] == [1, 2, 3]
+    assert metadata["children"] == [1, 2, 3]
+    assert metadata["total_cpu_s"] == 7.0
+    assert metadata["max_footprint_mb"] == 2.0
+    assert metadata["overhead"]["CPU handler"] == {"count": 30, "total_s": 1.5}
+    (profile,) = files
+    assert profile["filename"] == "prog.py"
+    assert profile["functions"][0]["python_s"] == 4.0
+    (line,) = profile["lines"]
+    assert line["python_s"] == 4.0
+    assert line["runs"] == 2
+    assert line["utilization"]["samples"] == 8
+    assert line["bytecode"][0]["malloc_mb"] == 2.0
+    assert line["native_symbols"][0]["samples"] == 4
+    # CPU time per run: 1, 3 and 0.
+    cpu = line["across_runs"]["cpu_s"]
+    assert cpu["mean"] == pytest.approx(4 / 3)
+    assert cpu["variance"] == pytest.approx(7 / 3)
+
+
+def test_diff_against_merged_runs(tmp_path, capsys):
+    run = write_run(tmp_path / "a.json", "/job", 1, 20.0, 2.0)
+    merged = merge(tmp_path, [run, run])
+    # Compared per run, a merge of a run with itself is the same run.
+    assert profilediff.main([run, merged]) == 0
+    assert profilediff.main([merged, run]) == 0
+    out = capsys.readouterr().out
+    assert "cpu     21.000s -> 21.000s" in out
+    assert "No regressions." in out
+
+
+def test_merge_merged(tmp_path):
+    paths = [
+        write_run(tmp_path / ("%d.json" % pid), "/job", pid, pid, pid)
+        for pid in range(1, 6)
+    ]
+    everything = read(merge(tmp_path, paths))
+    first = merge(tmp_path, paths[:2], "first.json")
+    rest = merge(tmp_path, paths[2:], "rest.json")
+    in_stages = read(merge(tmp_path, [first, rest], "stages.json"))
+    assert in_stages[0]["runs"] == 5
+    (line,) = everything[1][0]["lines"]
+    (staged,) = in_stages[1][0]["lines"]
+    assert staged["runs"] == line["runs"] == 5
+    for key, stats in line["across_runs"].items():
+        for stat, v in stats.items():
+            assert staged["across_runs"][key][stat] == pytest.approx(v)
+
+
+def test_mismatched_rates(tmp_path, capsys):
+    a = write_run(tmp_path / "a.json", "/job", 1, 1.0)
+    b = write_run(tmp_path / "b.json", "/job", 2, 1.0)
+    with open(b) as f:
+        text = f.read().replace(
+            '"cpu_sampling_rate_s": 0.01', '"cpu_sampling_rate_s": 0.02'
+        )
+    with open(b, "w") as f:
+        f.write(text)
+    merge(tmp_path, [a, b])
+    assert "cpu_sampling_rate_s" in capsys.readouterr().err
+
+
+def test_unreadable(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text(json.dumps({"schema": "nope"}))
+    assert profilemerge.main([str(path)]) == 2
@@ -0,0 +1,89 @@
+import ctypes
+import dis
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import sysconfig
+
+import pytest
+
+INCLUDE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "include")
+
+# Exposes PythonFrame::capture so we can call it from Python.
+SHIM = """\
+#include "pythonframe.hpp"
+extern "C" int capture(uint64_t *code, int32_t *line, int32_t *lasti) {
+  return PythonFrame::capture(*code, *line, *lasti);
+}
+"""
+
+COMPILER = shutil.which("c++") or shutil.which("clang++")
+
+
+def build_capture(build, includes):
+    if not COMPILER:
+        pytest.skip("needs a C++ compiler")
+    source = build / "shim.cpp"
+    source.write_text(SHIM)
+    shim = build / "shim.so"
+    subprocess.run(
+        [COMPILER, "-std=c++14", "-O2", "-fPIC", "-shared", "-I" + INCLUDE]
+        + ["-I" + include for include in includes]
+        + [str(source), "-o", str(shim), "-ldl"],
+        check=True,
+    )
+    # PyDLL: keep the GIL while we call it, as malloc would.
+    return ctypes.PyDLL(str(shim)).capture
+
+
+@pytest.fixture(scope="module")
+def capture(tmp_path_factory):
+    # Built against this Python's headers, as GNUmakefile does.
+    return build_capture(
+        tmp_path_factory.mktemp("pythonframe"),
+        [sysconfig.get_paths()["include"]],
+    )
+
+
+def captured(capture):
+    code, line, lasti = ctypes.c_uint64(), ctypes.c_int32(), ctypes.c_int32()
+    found = capture(
+        ctypes.byref(code), ctypes.byref(line), ctypes.byref(lasti)
+    )
+    return (found, code.value, line.value, lasti.value)
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 9) or sys.version_info >= (3, 12),
+    reason="PythonFrame only reads frames on Python 3.9 to 3.11",
+)
+def test_captures_the_calling_line(capture):
+    gc_enabled = gc.isenabled()
+    found, code, line, lasti = captured(capture)
+
+    assert found
+    assert code == id(captured.__code__)
+    # The line in captured() that calls capture().
+    assert line == captured.__code__.co_firstlineno + 2
+    if sys.version_info >= (3, 11):
+        instructions = {
+            i.offset: i for i in dis.get_instructions(captured)
+        }
+        assert instructions[lasti].opname == "CALL"
+        assert instructions[lasti].positions.lineno == line
+    else:
+        assert lasti == -1
+    assert gc.isenabled() == gc_enabled
+
+
+@pytest.mark.skipif(
+    sys.version_info[:2] != (3, 11),
+    reason="only 3.11 reads the interpreter's private frame layout",
+)
+def test_needs_the_headers_it_runs_with(tmp_path):
+    # Without Python's headers we can't tell which layout to read.
+    capture = build_capture(tmp_path, [])
+
+    assert not captured(capture)[0]
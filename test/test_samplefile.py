@@ -0,0 +1,192 @@
+import os
+
+import pytest
+
+from scalene.samplefile import (
+    ALLOCATION_SEQUENCE_FIELD,
+    NATIVE_SEQUENCE_FIELD,
+    NATIVE_STACK_DEPTH,
+    SAMPLEFILE_MAGIC,
+    SAMPLEFILE_VERSION,
+    SAMPLING_RATE_OFFSET,
+    TAIL_OFFSET,
+    SampleFile,
+    allocation_record,
+    header_struct,
+    native_record,
+    parse_legacy_allocation,
+    tail_struct,
+)
+
+CAPACITY = 4
+SIGNAL_SIZE = CAPACITY * allocation_record.size
+LOCK_SIZE = 4096
+
+
+@pytest.fixture(name="files")
+def sample_files():
+    pid = os.getpid()
+    signal_name = "/tmp/scalene-pytest-signal%d" % pid
+    lock_name = "/tmp/scalene-pytest-lock%d" % pid
+    for name, size in [(signal_name, SIGNAL_SIZE), (lock_name, LOCK_SIZE)]:
+        with open(name, "wb") as f:
+            f.write(b"\0" * size)
+    yield signal_name, lock_name
+    os.unlink(signal_name)
+    os.unlink(lock_name)
+
+
+def read_tail(files):
+    with open(files[1], "rb") as f:
+        return tail_struct.unpack_from(f.read(), TAIL_OFFSET)[0]
+
+
+def write_records(
+    files,
+    records,
+    version=SAMPLEFILE_VERSION,
+    overflows=0,
+    signals=0,
+    publish=True,
+):
+    """Append records to the ring the way libscalene does.
+
+    Records are given without their sequence numbers, which are filled
+    in with their position in the ring (plus one) when published, and
+    without a Python location unless they have one."""
+    signal_name, lock_name = files
+    with open(lock_name, "rb") as f:
+        (*_, head, tail, _overflows, _signals, _rate) = header_struct.unpack_from(f.read())
+    with open(signal_name, "r+b") as f:
+        for (action, *rest) in records:
+            sequence = head + 1 if publish else 0
+            location = [] if len(rest) > 3 else [0, 0, -1]
+            f.seek((head % CAPACITY) * allocation_record.size)
+            f.write(allocation_record.pack(action, sequence, *rest, *location))
+            head += 1
+    with open(lock_name, "r+b") as f:
+        f.write(
+            header_struct.pack(
+                SAMPLEFILE_MAGIC,
+                version,
+                allocation_record.size,
+                CAPACITY,
+                head,
+                tail,
+                overflows,
+                signals,
+                0,
+            )
+        )
+
+
+def new_samplefile():
+    return SampleFile(
+        "pytest",
+        allocation_record,
+        ALLOCATION_SEQUENCE_FIELD,
+        parse_legacy_allocation,
+    )
+
+
+def test_read_binary(files):
+    write_records(
+        files,
+        [(b"M", 1048576, 0.5, 17, 0x7F00DEADBEEF, 12, 34), (b"F", 4096, 1.0, 42)],
+    )
+    sf = new_samplefile()
+
+    assert sf.read() == [
+        (b"M", 1, 1048576, 0.5, 17, 0x7F00DEADBEEF, 12, 34),
+        (b"F", 2, 4096, 1.0, 42, 0, 0, -1),
+    ]
+    # Nothing new since the last read.
+    assert sf.read() == []
+
+
+def test_read_appended(files):
+    write_records(files, [(b"M", 1048576, 0.5, 17)])
+    sf = new_samplefile()
+    assert sf.read() == [(b"M", 1, 1048576, 0.5, 17, 0, 0, -1)]
+
+    write_records(files, [(b"F", 2048, 0.25, 17)])
+
+    assert sf.read() == [(b"F", 2, 2048, 0.25, 17, 0, 0, -1)]
+    assert read_tail(files) == 2
+
+
+def test_read_wraps_around(files):
+    sf = new_samplefile()
+    write_records(files, [(b"M", i, 0.0, 1) for i in range(3)])
+    assert len(sf.read()) == 3
+
+    # These straddle the end of the ring.
+    write_records(files, [(b"F", i, 0.0, 2) for i in range(3, 6)])
+
+    assert [r[1:3] for r in sf.read()] == [(4, 3), (5, 4), (6, 5)]
+    assert read_tail(files) == 6
+
+
+def test_read_stops_at_unpublished(files):
+    sf = new_samplefile()
+    write_records(files, [(b"M", 1, 0.0, 1)])
+    # A slot another thread has reserved but not yet filled in.
+    write_records(files, [(b"M", 2, 0.0, 2)], publish=False)
+
+    assert [r[2] for r in sf.read()] == [1]
+    assert read_tail(files) == 1
+    assert sf.read() == []
+
+
+def test_counters(files):
+    write_records(files, [(b"M", 1, 0.5, 1)] * 3, overflows=7, signals=2)
+
+    assert new_samplefile().counters() == (3, 2, 7)
+
+
+def test_set_sampling_rate(files):
+    write_records(files, [])
+
+    new_samplefile().set_sampling_rate(4 * 1048576)
+
+    with open(files[1], "rb") as f:
+        header = f.read()
+    assert tail_struct.unpack_from(header, SAMPLING_RATE_OFFSET)[0] == 4194304
+
+
+def test_version_mismatch(files, capsys):
+    write_records(files, [(b"M", 1, 0.5, 1)], version=SAMPLEFILE_VERSION + 1)
+    sf = new_samplefile()
+
+    assert sf.read() == []
+    assert "does not match" in capsys.readouterr().err
+
+
+def test_read_legacy_text(files):
+    signal_name, _ = files
+    with open(signal_name, "r+b") as f:
+        f.write(b"M,1,1048576,0.500000\nF,2,4096,1.000000\n\n")
+    sf = new_samplefile()
+
+    assert sf.read() == [
+        (b"M", 1, 1048576, 0.5, 0, 0, 0, -1),
+        (b"F", 2, 4096, 1.0, 0, 0, 0, -1),
+    ]
+
+
+def test_legacy_text_without_a_parser(files):
+    signal_name, _ = files
+    with open(signal_name, "r+b") as f:
+        f.write(b"1,2,3\n\n")
+
+    assert SampleFile("pytest", native_record, NATIVE_SEQUENCE_FIELD).read() == []
+
+
+def test_native_record_layout():
+    # sequence, thread id, depth, then the return addresses
+    # (struct NativeRecord in include/nativesampler.hpp).
+    assert native_record.size == 8 * (3 + NATIVE_STACK_DEPTH) == 152
+
+
+def test_missing_files():
+    assert new_samplefile().read() == []
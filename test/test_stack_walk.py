@@ -0,0 +1,73 @@
+import os
+import sys
+
+from scalene.scalene_profiler import Scalene
+
+LIBRARY = compile(
+    """
+def descend(depth, then):
+    if depth:
+        return descend(depth - 1, then)
+    return then()
+""",
+    "/usr/lib/python3/site-packages/library.py",
+    "exec",
+)
+
+
+def setup_module():
+    Scalene._Scalene__program_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def library_call(depth, then):
+    library = {}
+    exec(LIBRARY, library)
+    return library["descend"](depth, then)
+
+
+def test_walk_stops_at_profiled_code():
+    here = sys._getframe()
+    leaf = library_call(20, sys._getframe)
+
+    frame = Scalene.find_traced_frame(leaf)
+
+    assert frame.f_code is library_call.__code__
+    assert frame.f_back is here
+
+
+def test_eval_is_charged_to_its_caller():
+    leaf = eval(compile("sys._getframe()", "", "eval"))
+
+    assert Scalene.find_traced_frame(leaf) is leaf
+
+
+def test_decisions_are_cached_per_code_object():
+    code = compile("pass", "/usr/lib/python3/other.py", "exec")
+
+    assert not Scalene.should_trace_code(code)
+    key = id(code)
+    assert key in Scalene._Scalene__code_traced
+    del code
+    assert key not in Scalene._Scalene__code_traced
+
+
+def caller_position():
+    caller = sys._getframe(1)
+    return caller.f_code, caller.f_lasti
+
+
+class Widget:
+    def position(self):
+        return caller_position()
+
+
+def test_calls_are_recognized():
+    assert Scalene.is_call_function(*caller_position())
+    # A method call (CALL_METHOD before 3.11).
+    assert Scalene.is_call_function(*Widget().position())
+    assert not Scalene.is_call_function(
+        test_calls_are_recognized.__code__, 0
+    )
+    assert not Scalene.is_call_function(
+        test_calls_are_recognized.__code__, -1
+    )
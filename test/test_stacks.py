@@ -0,0 +1,87 @@
+import pickle
+import sys
+
+from scalene.scalene_profiler import Scalene
+from scalene.stacks import CPU, MALLOC, StackTable
+
+main = ("prog.py", "<module>", 10)
+a = ("prog.py", "a", 3)
+b = ("prog.py", "b", 6)
+helper = ("prog.py", "helper", 1)
+
+
+def test_shares_callers():
+    stacks = StackTable()
+    stacks.add(CPU, [main, a, helper], 1.0)
+    stacks.add(CPU, [main, b, helper], 3.0)
+    stacks.add(CPU, [main, a, helper], 1.0)
+    # <module>, a, b, helper (twice)
+    assert len(stacks.parents) == 5
+    assert len(stacks.frames) == 4
+    assert sorted(
+        (stacks.stack(i), v) for (i, v) in stacks.samples[CPU].items()
+    ) == [([main, a, helper], 2.0), ([main, b, helper], 3.0)]
+
+
+def test_collapsed():
+    stacks = StackTable()
+    stacks.add(CPU, [main, a, helper], 0.002)
+    stacks.add(MALLOC, [main, b], 4)
+    stacks.add(MALLOC, [main, a], -4)
+    assert stacks.collapsed(CPU, 1000) == [
+        "<module> (prog.py:10);a (prog.py:3);helper (prog.py:1) 2"
+    ]
+    # Only net allocation shows up.
+    assert stacks.collapsed(MALLOC, 1) == [
+        "<module> (prog.py:10);b (prog.py:6) 4"
+    ]
+
+
+def test_caller_tree():
+    stacks = StackTable()
+    stacks.add(CPU, [main, a, helper], 1.0)
+    stacks.add(CPU, [main, b, helper], 3.0)
+    stacks.add(CPU, [main], 4.0)
+    assert stacks.format_callers(CPU, roots=1, min_percent=0, max_depth=8) == [
+        " 50.0%  helper (prog.py:1)",
+        "   37.5%  b (prog.py:6)",
+        "     37.5%  <module> (prog.py:10)",
+        "   12.5%  a (prog.py:3)",
+        "     12.5%  <module> (prog.py:10)",
+    ]
+    assert stacks.format_callers(
+        CPU, roots=2, min_percent=20, max_depth=1
+    ) == [
+        " 50.0%  helper (prog.py:1)",
+        "   37.5%  b (prog.py:6)",
+        " 50.0%  <module> (prog.py:10)",
+    ]
+
+
+def test_merge():
+    parent, child = StackTable(), StackTable()
+    parent.add(CPU, [main, a], 1.0)
+    child.add(CPU, [main, b], 2.0)
+    child.add(CPU, [main, a], 1.0)
+    parent.merge(pickle.loads(pickle.dumps(child)))
+    assert sorted(parent.collapsed(CPU, 1)) == [
+        "<module> (prog.py:10);a (prog.py:3) 2",
+        "<module> (prog.py:10);b (prog.py:6) 2",
+    ]
+
+
+def test_stacks_flag_leaves_the_program(monkeypatch):
+    monkeypatch.setattr(
+        sys, "argv", ["scalene", "--cpu-only", "--stacks", "prog.py"]
+    )
+    args, left = Scalene.parse_args()
+    assert args.stacks
+    assert args.stacks_prefix == "scalene-stacks"
+    assert left == ["prog.py"]
+
+    monkeypatch.setattr(
+        sys, "argv", ["scalene", "--stacks", "--stacks-prefix=out", "prog.py"]
+    )
+    args, left = Scalene.parse_args()
+    assert args.stacks_prefix == "out"
+    assert left == ["prog.py"]
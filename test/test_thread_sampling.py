@@ -0,0 +1,113 @@
+import os
+import sys
+import threading
+from collections import defaultdict
+
+import pytest
+
+from scalene.scalene_profiler import Scalene
+
+# Scalene() installs this; it registers threads as they start.
+import scalene.replacement_thread_start
+
+
+def wait_for(event):
+    event.wait()
+
+
+@pytest.fixture
+def workers():
+    Scalene._Scalene__program_path = os.path.dirname(os.path.abspath(__file__))
+    done = threading.Event()
+    threads = [
+        threading.Thread(target=wait_for, args=(done,), name=name)
+        for name in ["worker-1", "worker-2", "idle-1"]
+    ]
+    for thread in threads:
+        thread.start()
+    yield {thread.name: thread.ident for thread in threads}
+    done.set()
+    for thread in threads:
+        thread.join()
+    Scalene._Scalene__thread_include = []
+    Scalene._Scalene__thread_exclude = []
+    Scalene.should_sample_thread.cache_clear()
+
+
+def sampled(include, exclude):
+    Scalene._Scalene__thread_include = Scalene.thread_patterns(include)
+    Scalene._Scalene__thread_exclude = Scalene.thread_patterns(exclude)
+    Scalene.should_sample_thread.cache_clear()
+    frames = Scalene.compute_frames_to_record(sys._getframe())
+    return [tident for (_frame, tident, _orig_frame) in frames]
+
+
+def test_samples_every_thread_main_first(workers):
+    tidents = sampled(None, None)
+
+    assert tidents[0] == threading.main_thread().ident
+    assert set(workers.values()) <= set(tidents)
+
+
+def test_thread_name_patterns(workers):
+    tidents = sampled("MainThread, worker-*", "worker-2")
+
+    assert threading.main_thread().ident in tidents
+    assert workers["worker-1"] in tidents
+    assert workers["worker-2"] not in tidents
+    assert workers["idle-1"] not in tidents
+
+
+def test_skips_scalene_threads(workers, monkeypatch):
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    monkeypatch.setattr(
+        Scalene, "_Scalene__sampler_thread", threads[workers["worker-1"]]
+    )
+    monkeypatch.setattr(
+        Scalene, "_Scalene__collector_thread", threads[workers["worker-2"]]
+    )
+    tidents = sampled(None, None)
+
+    assert workers["worker-1"] not in tidents
+    assert workers["worker-2"] not in tidents
+    assert workers["idle-1"] in tidents
+
+
+class Records:
+    def __init__(self, records):
+        self.records = records
+
+    def read(self):
+        records, self.records = self.records, []
+        return records
+
+
+def test_every_allocation_counts_towards_the_totals(workers, monkeypatch):
+    MB = 1024 * 1024
+    native_thread = 1
+    monkeypatch.setattr(Scalene, "_Scalene__total_memory_malloc_samples", 0.0)
+    monkeypatch.setattr(Scalene, "_Scalene__allocation_velocity", (0.0, 0.0))
+    malloc_samples = defaultdict(float)
+    monkeypatch.setattr(Scalene, "_Scalene__malloc_samples", malloc_samples)
+    monkeypatch.setattr(Scalene, "_Scalene__current_footprint", 0.0)
+    monkeypatch.setattr(Scalene, "_Scalene__max_footprint", 0.0)
+    # worker-2 isn't sampled, but its allocation still happened.
+    Scalene._Scalene__thread_exclude = Scalene.thread_patterns("worker-2")
+    Scalene.should_sample_thread.cache_clear()
+    monkeypatch.setattr(
+        Scalene,
+        "_Scalene__malloc_samplefile",
+        Records(
+            [
+                (b"M", 1, 2 * MB, 1.0, native_thread, 0, 0, -1),
+                (b"M", 2, 3 * MB, 1.0, workers["worker-2"], 0, 0, -1),
+            ]
+        ),
+    )
+    Scalene.allocation_signal_handler(None, sys._getframe())
+
+    assert Scalene._Scalene__total_memory_malloc_samples == 5.0
+    assert Scalene._Scalene__allocation_velocity == (5.0, 5.0)
+    assert Scalene._Scalene__current_footprint == 5.0
+    # The native thread's allocation is charged to the main thread.
+    assert malloc_samples == {__file__: 1}
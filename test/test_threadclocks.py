@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from scalene.threadclocks import ThreadClocks
+
+pytestmark = pytest.mark.skipif(
+    not ThreadClocks.available, reason="no per-thread CPU clocks"
+)
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_charges_each_thread_its_own_time():
+    clocks = ThreadClocks()
+    started = threading.Event()
+    done = threading.Event()
+
+    def sleeper():
+        started.set()
+        done.wait()
+
+    thread = threading.Thread(target=sleeper)
+    thread.start()
+    started.wait()
+    me = threading.get_ident()
+    clocks.tick()
+    assert clocks.elapsed(me) == 0.0
+    assert clocks.elapsed(thread.ident) == 0.0
+
+    spin(0.05)
+    clocks.tick()
+    busy = clocks.elapsed(me)
+    idle = clocks.elapsed(thread.ident)
+    done.set()
+    thread.join()
+
+    assert busy > 0.02
+    assert idle < 0.01
+
+
+def test_only_charges_since_the_previous_sample():
+    clocks = ThreadClocks()
+    me = threading.get_ident()
+    clocks.tick()
+    clocks.elapsed(me)
+    clocks.tick()
+    # Not seen at this sample.
+    spin(0.02)
+    clocks.tick()
+    assert clocks.elapsed(me) == 0.0
+
+
+def test_retain_forgets_exited_threads():
+    clocks = ThreadClocks()
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    clocks.tick()
+    clocks.elapsed(thread.ident)
+    thread.join()
+
+    clocks.retain([threading.get_ident()])
+    clocks.tick()
+    assert clocks.elapsed(threading.get_ident()) == 0.0